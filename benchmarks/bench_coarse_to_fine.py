@@ -0,0 +1,91 @@
+"""
+Accuracy vs latency of coarse-to-fine registration (refine.coarse_to_fine) on
+large synthetic clouds: the network on a farthest point sampled subset,
+followed by 0..k nearest-neighbour refinement steps on the full cloud, and
+the network on the full cloud where it still fits (--full_max).
+
+Source and target are drawn independently from the surface of the same
+random union of ellipsoids, so no point has an exact partner.
+
+    python benchmarks/bench_coarse_to_fine.py --model_path registration/checkpoints/dcp_v2/models/model.best.t7 \
+        --num_points 4096 8192 16384 --coarse 256 512 --out results/coarse_to_fine.json
+"""
+import argparse
+import numpy as np
+import torch
+from common import registration_data, timeit, write_results, print_table
+from export import add_model_args
+from util import rotation_error, translation_error
+from refine import coarse_to_fine
+
+
+def synthetic_pairs(batch_size, num_points, rng):
+    """(src, tgt, R_ab, t_ab) float tensors, tgt ~ R_ab src + t_ab with both clouds sampled independently."""
+    clouds = []
+    for _ in range(batch_size):
+        centers = rng.uniform(-0.5, 0.5, size=(4, 1, 3))
+        axes = rng.uniform(0.1, 0.5, size=(4, 1, 3))
+        directions = rng.normal(size=(4, 2 * num_points, 3))
+        directions /= np.linalg.norm(directions, axis=2, keepdims=True)
+        surface = (centers + axes * directions).reshape(-1, 3)
+        clouds.append(surface[rng.choice(len(surface), 2 * num_points, replace=False)])
+    clouds = np.stack(clouds).astype('float32')
+    angles = rng.uniform(0, np.pi / 4, size=(3, batch_size))
+    R_ab = registration_data().rotation_matrices(*angles).astype('float32')
+    t_ab = rng.uniform(-0.5, 0.5, size=(batch_size, 3)).astype('float32')
+    src = clouds[:, :num_points].transpose(0, 2, 1)
+    tgt = R_ab @ clouds[:, num_points:].transpose(0, 2, 1) + t_ab[:, :, None]
+    return [torch.from_numpy(np.ascontiguousarray(x)) for x in (src, tgt, R_ab, t_ab)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Coarse-to-fine registration accuracy vs latency')
+    add_model_args(parser)
+    parser.add_argument('--num_points', type=int, nargs='+', default=[4096, 8192, 16384])
+    parser.add_argument('--coarse', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('--refine_iters', type=int, nargs='+', default=[0, 1, 3])
+    parser.add_argument('--full_max', type=int, default=4096,
+                        help='Also run the network on the full cloud up to this many points')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--block_size', type=int, default=4096)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--out', type=str, default='')
+    args = parser.parse_args()
+    args.model = 'reg'
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device('cuda' if args.cuda else 'cpu')
+
+    from export import build_inference_model
+    net = build_inference_model(args, device).reg_model
+    rng = np.random.RandomState(args.seed)
+    rows = []
+    for num_points in args.num_points:
+        src, tgt, R_ab, t_ab = [x.to(device) for x in synthetic_pairs(args.batch_size, num_points, rng)]
+        variants = [('coarse%d+refine%d' % (c, i), c, i) for c in args.coarse for i in args.refine_iters]
+        if num_points <= args.full_max:
+            variants.append(('full', None, 0))
+        for name, num_coarse, iterations in variants:
+            def run():
+                with torch.inference_mode():
+                    if num_coarse is None:
+                        return net(src, tgt)[:2]
+                    return coarse_to_fine(net, src, tgt, num_coarse, iterations, args.block_size)
+            R_pred, t_pred = run()
+            stats = timeit(run, warmup=args.warmup, iters=args.iters, device=device)
+            row = dict(variant=name, num_points=num_points,
+                       rot_error_deg=rotation_error(R_pred, R_ab).mean().item(),
+                       trans_error=translation_error(t_pred, t_ab).mean().item(),
+                       ms_per_pair=stats['mean_ms'] / args.batch_size, **stats)
+            rows.append(row)
+            print('%(num_points)d points, %(variant)s: %(rot_error_deg).2f deg, %(trans_error).4f, '
+                  '%(ms_per_pair).1f ms/pair' % row)
+    print()
+    print_table(rows, ['num_points', 'variant', 'rot_error_deg', 'trans_error', 'ms_per_pair'])
+    if args.out:
+        write_results(args.out, 'coarse_to_fine', rows, args)
+
+
+if __name__ == '__main__':
+    main()
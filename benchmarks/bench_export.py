@@ -0,0 +1,67 @@
+"""
+Inference latency of FM3D / RegModel in eager mode, as traced TorchScript
+(export.script_model) and under torch.compile, per batch size.
+
+    python benchmarks/bench_export.py --model fm3d --batch_sizes 1 8 --num_points 1024 --out results/export.json
+"""
+import argparse
+import torch
+from common import timeit, write_results, print_table
+from export import add_model_args, build_inference_model, example_inputs, script_model, compile_model, max_abs_diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Eager vs TorchScript vs torch.compile latency')
+    add_model_args(parser)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0: torch default)')
+    parser.add_argument('--variants', type=str, nargs='+', default=['eager', 'script', 'compile'],
+                        choices=['eager', 'script', 'compile'])
+    parser.add_argument('--compile_mode', type=str, default='default')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--out', type=str, default='')
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cuda' if args.cuda else 'cpu')
+
+    eager = build_inference_model(args, device)
+    rows = []
+    for batch_size in args.batch_sizes:
+        inputs = example_inputs(args, device, batch_size)
+        with torch.no_grad():
+            reference = eager(*inputs)
+        for variant in args.variants:
+            if variant == 'eager':
+                module = eager
+            elif variant == 'script':
+                module = script_model(eager, inputs)
+            else:
+                module = compile_model(eager, args.compile_mode)
+
+            def run():
+                with torch.inference_mode():
+                    return module(*inputs)
+            with torch.no_grad():
+                diff = max_abs_diff(reference, module(*inputs))
+            stats = timeit(run, warmup=args.warmup, iters=args.iters, device=device)
+            row = dict(model=args.model, variant=variant, batch_size=batch_size, num_points=args.num_points,
+                       max_abs_diff=diff, pairs_per_sec=batch_size * 1000.0 / stats['mean_ms'], **stats)
+            rows.append(row)
+            print('%(variant)s, batch %(batch_size)d: %(mean_ms).2f ms, %(pairs_per_sec).1f pairs/sec' % row)
+        eager_ms = [r['mean_ms'] for r in rows if r['batch_size'] == batch_size and r['variant'] == 'eager']
+        for row in rows:
+            if row['batch_size'] == batch_size and eager_ms:
+                row['speedup'] = eager_ms[0] / row['mean_ms']
+    print()
+    print_table(rows, ['model', 'variant', 'batch_size', 'mean_ms', 'p50_ms', 'pairs_per_sec', 'speedup',
+                       'max_abs_diff'])
+    if args.out:
+        write_results(args.out, 'export', rows, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+Micro-benchmarks of the hot kernels at CLI-selectable sizes, CPU by default.
+Results go to JSON (common.write_results, with the commit) so runs on two
+commits can be compared.
+
+    python benchmarks/bench_kernels.py --batch_sizes 8 --num_points 1024 --k 20 --emb_dims 512 \
+        --out results/kernels_$(git rev-parse --short HEAD).json
+    python benchmarks/bench_kernels.py --kernels knn get_graph_feature --num_points 512 1024 2048
+
+The dataset kernels index the real ModelNet40 files and are skipped when the
+data is not there.
+"""
+import os
+import argparse
+import itertools
+import numpy as np
+import torch
+from common import ROOT_DIR, registration_data, timeit, write_results, print_table
+import model as fm3d_model
+from RegModel import MultiHeadedAttention, SVDHead
+from util import quat2mat
+
+
+def _points(size, device, dims=3):
+    return torch.randn(size['batch_size'], dims, size['num_points'], device=device)
+
+
+def bench_knn(size, args, device):
+    x = _points(size, device)
+    return lambda: fm3d_model.knn(x, size['k'])
+
+
+def bench_get_graph_feature(size, args, device):
+    x = _points(size, device, 64)
+    return lambda: fm3d_model.get_graph_feature(x, size['k'])
+
+
+def _model_args(size, args):
+    return argparse.Namespace(k=size['k'], emb_dims=size['emb_dims'], dropout=0.0, alpha1=0.1, alpha2=0.1,
+                              similarity_metric=args.similarity_metric, n_blocks=1, n_heads=args.n_heads,
+                              ff_dims=size['emb_dims'], cycle=False)
+
+
+def bench_dgcnn_forward(size, args, device):
+    net = fm3d_model.DGCNN(_model_args(size, args)).to(device).eval()
+    x = _points(size, device)
+    return lambda: net(x)
+
+
+def bench_kfnn(size, args, device):
+    net = fm3d_model.FM3D(_model_args(size, args)).to(device).eval()
+    x, y = _points(size, device, size['emb_dims']), _points(size, device, size['emb_dims'])
+    return lambda: net._KFNN(x, y, k=size['k'])
+
+
+def bench_fm3d_forward(size, args, device):
+    net = fm3d_model.FM3D(_model_args(size, args)).to(device).eval()
+    src, tgt = _points(size, device), _points(size, device)
+    return lambda: net(src, tgt)
+
+
+def bench_fm3d_train_step(size, args, device):
+    """FM3D.forward + contrastive_loss + backward, as in main.train."""
+    model_args = _model_args(size, args)
+    net = fm3d_model.FM3D(model_args).to(device).train()
+    loss_function = fm3d_model.contrastive_loss(model_args).to(device)
+    src, tgt = _points(size, device), _points(size, device)
+
+    def step():
+        net.zero_grad(set_to_none=True)
+        loss = loss_function(*net(src, tgt))[0]
+        loss.backward()
+    return step
+
+
+def bench_contrastive_loss(size, args, device):
+    loss_function = fm3d_model.contrastive_loss(_model_args(size, args)).to(device)
+    b, d, n = size['batch_size'], size['emb_dims'], size['num_points']
+    fe = [torch.randn(b, d, n, device=device) for _ in range(4)]
+    M = torch.softmax(torch.randn(b, n, n, device=device), dim=1)
+    return lambda: loss_function(*fe, M)
+
+
+def bench_multi_headed_attention(size, args, device):
+    attention = MultiHeadedAttention(args.n_heads, size['emb_dims']).to(device).eval()
+    x = torch.randn(size['batch_size'], size['num_points'], size['emb_dims'], device=device)
+    y = torch.randn(size['batch_size'], size['num_points'], size['emb_dims'], device=device)
+    return lambda: attention(x, y, y)
+
+
+def bench_svd_head(size, args, device):
+    head = SVDHead(_model_args(size, args)).to(device).eval()
+    src_emb, tgt_emb = _points(size, device, size['emb_dims']), _points(size, device, size['emb_dims'])
+    src, tgt = _points(size, device), _points(size, device)
+    return lambda: head(src_emb, tgt_emb, src, tgt)
+
+
+def bench_quat2mat(size, args, device):
+    quat = torch.nn.functional.normalize(torch.randn(size['batch_size'] * size['num_points'], 4, device=device), dim=1)
+    return lambda: quat2mat(quat)
+
+
+def _fm3d_dataset(size):
+    from data import ModelNet40
+    cwd = os.getcwd()
+    os.chdir(ROOT_DIR)
+    try:
+        return ModelNet40(num_points=size['num_points'], partition='train')
+    finally:
+        os.chdir(cwd)
+
+
+def _dataset_items(dataset, size):
+    items = np.random.randint(len(dataset), size=size['batch_size'])
+
+    def run():
+        for item in items:
+            dataset[int(item)]
+    return run
+
+
+def bench_fm3d_getitem(size, args, device):
+    return _dataset_items(_fm3d_dataset(size), size)
+
+
+def bench_fm3d_get_batch(size, args, device):
+    dataset = _fm3d_dataset(size)
+    return lambda: dataset.get_batch(np.random.randint(len(dataset), size=size['batch_size']))
+
+
+def bench_reg_getitem(size, args, device):
+    return _dataset_items(registration_data().ModelNet40(num_points=size['num_points'], partition='train'), size)
+
+
+def bench_reg_get_batch(size, args, device):
+    dataset = registration_data().ModelNet40(num_points=size['num_points'], partition='train')
+    return lambda: dataset.get_batch(np.random.randint(len(dataset), size=size['batch_size']))
+
+
+KERNELS = {
+    'knn': bench_knn,
+    'get_graph_feature': bench_get_graph_feature,
+    'dgcnn_forward': bench_dgcnn_forward,
+    'fm3d_kfnn': bench_kfnn,
+    'fm3d_forward': bench_fm3d_forward,
+    'contrastive_loss': bench_contrastive_loss,
+    'fm3d_train_step': bench_fm3d_train_step,
+    'multi_headed_attention': bench_multi_headed_attention,
+    'svd_head': bench_svd_head,
+    'quat2mat': bench_quat2mat,
+    'fm3d_getitem': bench_fm3d_getitem,
+    'fm3d_get_batch': bench_fm3d_get_batch,
+    'reg_getitem': bench_reg_getitem,
+    'reg_get_batch': bench_reg_get_batch,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hot kernel micro-benchmarks')
+    parser.add_argument('--kernels', type=str, nargs='+', default=list(KERNELS), choices=list(KERNELS))
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8])
+    parser.add_argument('--num_points', type=int, nargs='+', default=[1024])
+    parser.add_argument('--k', type=int, nargs='+', default=[20])
+    parser.add_argument('--emb_dims', type=int, nargs='+', default=[512])
+    parser.add_argument('--n_heads', type=int, default=4)
+    parser.add_argument('--similarity_metric', type=str, default='exponential')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0: torch default)')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--out', type=str, default='')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    device = torch.device(args.device)
+
+    rows = []
+    for name in args.kernels:
+        for batch_size, num_points, k, emb_dims in itertools.product(args.batch_sizes, args.num_points, args.k,
+                                                                     args.emb_dims):
+            size = dict(batch_size=batch_size, num_points=num_points, k=k, emb_dims=emb_dims)
+            try:
+                fn = KERNELS[name](size, args, device)
+            except (OSError, ValueError) as e:
+                # the dataset kernels need the ModelNet40 files
+                print('%s skipped: %s' % (name, e))
+                break
+            if name != 'fm3d_train_step':
+                fn = torch.no_grad()(fn)
+            stats = timeit(fn, warmup=args.warmup, iters=args.iters, device=device)
+            row = dict(kernel=name, **size, **stats)
+            rows.append(row)
+            print('%(kernel)s b=%(batch_size)d n=%(num_points)d k=%(k)d d=%(emb_dims)d: %(mean_ms).3f ms' % row)
+    print()
+    print_table(rows, ['kernel', 'batch_size', 'num_points', 'k', 'emb_dims', 'mean_ms', 'std_ms', 'p50_ms'])
+    if args.out:
+        write_results(args.out, 'kernels', rows, args)
+
+
+if __name__ == '__main__':
+    main()
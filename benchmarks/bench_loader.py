@@ -0,0 +1,82 @@
+"""
+Input pipeline throughput (samples/sec) for every combination of the loader
+knobs in loader.add_loader_args.
+
+    python benchmarks/bench_loader.py --dataset fm3d --workers 0 4 8 --out results/loader.json
+"""
+import os
+import argparse
+import itertools
+import time
+from common import ROOT_DIR, registration_data, write_results, print_table
+from loader import build_loader
+
+
+def make_dataset(args):
+    if args.dataset == 'fm3d':
+        from data import ModelNet40
+        cwd = os.getcwd()
+        os.chdir(ROOT_DIR)  # load_data reads ./data relative to the repository
+        try:
+            return ModelNet40(num_points=args.num_points, partition=args.partition, debug=args.debug)
+        finally:
+            os.chdir(cwd)
+    return registration_data().ModelNet40(num_points=args.num_points, partition=args.partition)
+
+
+def run(dataset, config, args):
+    loader_args = argparse.Namespace(seed=args.seed, **config)
+    loader = build_loader(dataset, loader_args, args.batch_size, shuffle=True, drop_last=True)
+    epochs = []
+    for _ in range(args.epochs):
+        samples = 0
+        t0 = time.perf_counter()
+        for i, batch in enumerate(loader):
+            samples += batch[0].size(0)
+            if i + 1 >= args.batches:
+                break
+        epochs.append(samples / (time.perf_counter() - t0))
+    row = dict(config)
+    row['first_epoch_sps'] = epochs[0]
+    row['steady_sps'] = sum(epochs[1:]) / len(epochs[1:]) if len(epochs) > 1 else epochs[0]
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DataLoader throughput benchmark')
+    parser.add_argument('--dataset', type=str, default='fm3d', choices=['fm3d', 'reg'])
+    parser.add_argument('--partition', type=str, default='train')
+    parser.add_argument('--debug', action='store_true', default=False)
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--batch_size', type=int, default=24)
+    parser.add_argument('--batches', type=int, default=50, help='batches per epoch')
+    parser.add_argument('--epochs', type=int, default=3, help='epochs per configuration, the first includes worker start-up')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4, 8])
+    parser.add_argument('--prefetch', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--collate', type=str, nargs='+', default=['batch', 'sample'], choices=['batch', 'sample'],
+                        help='batch: dataset.get_batch via a BatchSampler, sample: per-item indexing + default_collate')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', type=str, default='')
+    args = parser.parse_args()
+
+    dataset = make_dataset(args)
+    rows = []
+    for collate, workers, pin, persistent in itertools.product(args.collate, args.workers, [False, True], [False, True]):
+        prefetches = args.prefetch if workers > 0 else [args.prefetch[0]]
+        if workers == 0 and persistent:
+            continue
+        for prefetch in prefetches:
+            config = dict(per_sample_collate=collate == 'sample', num_workers=workers, pin_memory=pin,
+                          persistent_workers=persistent, prefetch_factor=prefetch)
+            rows.append(run(dataset, config, args))
+            print('per-sample collate %(per_sample_collate)s, %(num_workers)d workers, pin %(pin_memory)s, '
+                  'persistent %(persistent_workers)s, prefetch %(prefetch_factor)d: '
+                  '%(steady_sps).1f samples/sec' % rows[-1])
+    print()
+    print_table(rows, list(rows[0].keys()))
+    if args.out:
+        write_results(args.out, 'loader', rows, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+One source against many targets: RegModel.register_many (source encoded once)
+vs the plain forward with the source repeated in every batch slot.
+
+    python benchmarks/bench_one_to_many.py --num_targets 16 64 256 --num_points 1024 --out results/one_to_many.json
+"""
+import argparse
+import torch
+from common import timeit, write_results, print_table
+from export import add_model_args
+
+
+def main():
+    parser = argparse.ArgumentParser(description='One-to-many registration throughput')
+    add_model_args(parser)
+    parser.add_argument('--num_targets', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--chunk_size', type=int, default=64)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--iters', type=int, default=5)
+    parser.add_argument('--out', type=str, default='')
+    args = parser.parse_args()
+    args.model = 'reg'
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device('cuda' if args.cuda else 'cpu')
+
+    from export import build_inference_model
+    net = build_inference_model(args, device).reg_model
+    src = torch.randn(1, 3, args.num_points, device=device)
+    rows = []
+    for num_targets in args.num_targets:
+        tgts = torch.randn(num_targets, 3, args.num_points, device=device)
+
+        def repeated():
+            with torch.inference_mode():
+                for start in range(0, num_targets, args.chunk_size):
+                    tgt = tgts[start:start + args.chunk_size]
+                    net(src.expand(tgt.size(0), -1, -1).contiguous(), tgt)
+
+        def shared():
+            with torch.inference_mode():
+                net.register_many(src, tgts, args.chunk_size)
+
+        with torch.inference_mode():
+            R_many, t_many, _ = net.register_many(src, tgts[:args.chunk_size], args.chunk_size)
+            R_ref, t_ref = net(src.expand(R_many.size(0), -1, -1).contiguous(), tgts[:args.chunk_size])[:2]
+        diff = max((R_many - R_ref).abs().max().item(), (t_many - t_ref).abs().max().item())
+        for variant, fn in (('repeated', repeated), ('register_many', shared)):
+            stats = timeit(fn, warmup=args.warmup, iters=args.iters, device=device)
+            row = dict(variant=variant, num_targets=num_targets, num_points=args.num_points,
+                       targets_per_sec=num_targets * 1000.0 / stats['mean_ms'], max_abs_diff=diff, **stats)
+            rows.append(row)
+            print('%(variant)s, %(num_targets)d targets: %(mean_ms).1f ms, %(targets_per_sec).1f targets/sec' % row)
+    print()
+    print_table(rows, ['variant', 'num_targets', 'mean_ms', 'targets_per_sec', 'max_abs_diff'])
+    if args.out:
+        write_results(args.out, 'one_to_many', rows, args)
+
+
+if __name__ == '__main__':
+    main()
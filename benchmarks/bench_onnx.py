@@ -0,0 +1,57 @@
+"""
+DGCNN encoder latency in torch vs onnxruntime on CPU across thread counts,
+with a parity check of every configuration.
+
+    python benchmarks/bench_onnx.py --threads 1 2 4 8 --batch_sizes 1 8 --out results/onnx.json
+"""
+import os
+import argparse
+import tempfile
+import torch
+from common import timeit, write_results, print_table
+from onnx_backend import load_dgcnn, export_dgcnn, ORTEncoder
+
+
+def main():
+    parser = argparse.ArgumentParser(description='torch vs onnxruntime DGCNN thread scaling')
+    parser.add_argument('--model_path', type=str, default='', help='FM3D or RegModel checkpoint (random weights if empty)')
+    parser.add_argument('--onnx', type=str, default='', help='Existing .onnx file, exported to a temp dir if empty')
+    parser.add_argument('--emb_dims', type=int, default=1024)
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--dropout', type=float, default=0.5)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--out', type=str, default='')
+    args = parser.parse_args()
+
+    dgcnn = load_dgcnn(args)
+    path = args.onnx or export_dgcnn(dgcnn, os.path.join(tempfile.mkdtemp(), 'dgcnn.onnx'), args.num_points)
+    rows = []
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        encoder = ORTEncoder(path, intra_op_threads=threads)
+        for batch_size in args.batch_sizes:
+            points = torch.randn(batch_size, 3, args.num_points)
+            with torch.inference_mode():
+                diff = (dgcnn(points) - encoder(points)).abs().max().item()
+            for backend, module in (('torch', dgcnn), ('onnxruntime', encoder)):
+                def run():
+                    with torch.inference_mode():
+                        return module(points)
+                stats = timeit(run, warmup=args.warmup, iters=args.iters)
+                row = dict(backend=backend, threads=threads, batch_size=batch_size, num_points=args.num_points,
+                           clouds_per_sec=batch_size * 1000.0 / stats['mean_ms'], max_abs_diff=diff, **stats)
+                rows.append(row)
+                print('%(backend)s, %(threads)d threads, batch %(batch_size)d: %(mean_ms).2f ms, '
+                      '%(clouds_per_sec).1f clouds/sec' % row)
+    print()
+    print_table(rows, ['backend', 'threads', 'batch_size', 'mean_ms', 'p50_ms', 'clouds_per_sec', 'max_abs_diff'])
+    if args.out:
+        write_results(args.out, 'onnx', rows, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Pose accuracy and time per pair of pose.py on FM3D matches, against the
+rotation/translation stored in the generated HDF5 files.
+
+    python benchmarks/bench_pose.py --model_path checkpoints/exp/models/50.pth --methods weighted ransac \
+        --k 128 256 --out results/pose.json
+"""
+import os
+import time
+import argparse
+import numpy as np
+import torch
+from common import ROOT_DIR, synchronize, write_results, print_table
+from export import add_model_args
+from infer import load_fm3d
+from pose import METHODS, estimate_pose, stored_to_ab
+from util import rotation_error, translation_error
+
+
+def load_pairs(args):
+    from data import load_data
+    cwd = os.getcwd()
+    os.chdir(ROOT_DIR)  # load_data reads ./data relative to the repository
+    try:
+        src, tgt, translation, rotation = load_data(args.partition, args.debug, with_transforms=True)
+    finally:
+        os.chdir(cwd)
+    count = min(args.num_pairs, len(src)) if args.num_pairs > 0 else len(src)
+    R_ab, t_ab = stored_to_ab(rotation[:count], translation[:count])
+    return src[:count], tgt[:count], R_ab, t_ab
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pose estimation from FM3D matches')
+    add_model_args(parser)
+    parser.add_argument('--methods', type=str, nargs='+', default=list(METHODS), choices=METHODS)
+    parser.add_argument('--k', type=int, nargs='+', default=[256], dest='num_matches',
+                        help='Most confident matches kept per pair')
+    parser.add_argument('--num_hypotheses', type=int, default=4096)
+    parser.add_argument('--inlier_threshold', type=float, default=0.05)
+    parser.add_argument('--partition', type=str, default='test')
+    parser.add_argument('--num_pairs', type=int, default=0, help='0: every pair of the partition')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--debug', type=bool, default=False)
+    parser.add_argument('--out', type=str, default='')
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device('cuda' if args.cuda else 'cpu')
+
+    model = load_fm3d(args, device)
+    src_all, tgt_all, R_all, t_all = load_pairs(args)
+    rows = []
+    for method in args.methods:
+        for num_matches in args.num_matches:
+            rotation_errors, translation_errors, seconds = [], [], 0.0
+            for start in range(0, len(src_all), args.batch_size):
+                stop = start + args.batch_size
+                src = torch.from_numpy(src_all[start:stop]).to(device).transpose(2, 1).contiguous()
+                tgt = torch.from_numpy(tgt_all[start:stop]).to(device).transpose(2, 1).contiguous()
+                with torch.inference_mode():
+                    M = model.correspondence(src, tgt)
+                    synchronize(device)
+                    begin = time.perf_counter()
+                    kwargs = {}
+                    if method == 'ransac':
+                        kwargs = dict(num_hypotheses=args.num_hypotheses, inlier_threshold=args.inlier_threshold)
+                    R, t = estimate_pose(M, src, tgt, method, num_matches, **kwargs)
+                    synchronize(device)
+                    seconds += time.perf_counter() - begin
+                rotation_errors.append(rotation_error(R.cpu(), torch.from_numpy(R_all[start:stop])))
+                translation_errors.append(translation_error(t.cpu(), torch.from_numpy(t_all[start:stop])))
+            rotation_errors = torch.cat(rotation_errors).numpy()
+            translation_errors = torch.cat(translation_errors).numpy()
+            row = dict(method=method, k=num_matches, pairs=len(rotation_errors),
+                       rot_error_deg=float(rotation_errors.mean()), rot_error_median=float(np.median(rotation_errors)),
+                       trans_error=float(translation_errors.mean()),
+                       ms_per_pair=seconds * 1000 / len(rotation_errors))
+            rows.append(row)
+            print('%(method)s, k=%(k)d: %(rot_error_deg).2f deg, %(trans_error).4f, %(ms_per_pair).3f ms/pair' % row)
+    print()
+    print_table(rows, ['method', 'k', 'rot_error_deg', 'rot_error_median', 'trans_error', 'ms_per_pair'])
+    if args.out:
+        write_results(args.out, 'pose', rows, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+End-to-end training throughput of FM3D (main.py) and RegModel
+(registration/main.py) on synthetic clouds, no dataset needed. Every step is
+split into data wait, forward (with the loss), backward and optimizer time;
+peak memory is the CUDA allocator peak on GPU and the process max RSS on CPU.
+
+    python benchmarks/bench_train.py --model fm3d --steps 50 --batch_sizes 8 24 --num_points 1024
+    python benchmarks/bench_train.py --model reg --no_cuda --steps 20 --out results/train_reg.json
+"""
+import time
+import argparse
+import resource
+import numpy as np
+import torch
+from common import registration_data, synchronize, write_results, print_table
+from export import add_model_args
+from loader import add_loader_args, build_loader
+
+STAGES = ('data', 'forward', 'backward', 'optimizer')
+
+
+def build(args, device):
+    """(model, dataset, forward(batch) -> loss) for args.model."""
+    if args.model == 'fm3d':
+        from data import SyntheticModelNet40
+        from model import FM3D, contrastive_loss
+        net = FM3D(args).to(device)
+        loss_function = contrastive_loss(args).to(device)
+        dataset = SyntheticModelNet40(args.num_points, 'train', args.num_samples, args.seed)
+
+        def forward(batch):
+            src, tgt = [x.to(device, non_blocking=True).permute(0, 2, 1) for x in batch]
+            return loss_function(*net(src, tgt))[0]
+        return net, dataset, forward
+    from RegModel import RegModel
+    from util import compute_loss
+    net = RegModel(args).to(device)
+    dataset = registration_data().SyntheticModelNet40(args.num_points, 'train', num_shapes=args.num_samples,
+                                                      seed=args.seed)
+
+    def forward(batch):
+        src, tgt, rotation_ab, translation_ab = [x.to(device, non_blocking=True) for x in batch[:4]]
+        return compute_loss(args, *net(src, tgt), rotation_ab, translation_ab)[0]
+    return net, dataset, forward
+
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(args, batch_size, device):
+    net, dataset, forward = build(args, device)
+    opt = torch.optim.Adam(net.parameters(), lr=1e-3, weight_decay=1e-4)
+    loader = build_loader(dataset, args, batch_size, shuffle=True, drop_last=True)
+    net.train()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    times = {stage: [] for stage in STAGES}
+    batches = iter(loader)
+    for step in range(args.warmup + args.steps):
+        t0 = time.perf_counter()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            batches = iter(loader)
+            batch = next(batches)
+        t1 = time.perf_counter()
+        opt.zero_grad()
+        loss = forward(batch)
+        synchronize(device)
+        t2 = time.perf_counter()
+        loss.backward()
+        synchronize(device)
+        t3 = time.perf_counter()
+        opt.step()
+        synchronize(device)
+        t4 = time.perf_counter()
+        if step >= args.warmup:
+            for stage, seconds in zip(STAGES, (t1 - t0, t2 - t1, t3 - t2, t4 - t3)):
+                times[stage].append(seconds * 1000)
+    step_ms = np.sum([times[stage] for stage in STAGES], axis=0)
+    row = dict(model=args.model, batch_size=batch_size, num_points=args.num_points, steps=args.steps,
+               samples_per_sec=batch_size * 1000.0 / step_ms.mean(), step_ms=float(step_ms.mean()),
+               peak_memory_mb=peak_memory_mb(device))
+    for stage in STAGES:
+        row[stage + '_ms'] = float(np.mean(times[stage]))
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Training throughput on synthetic data')
+    add_model_args(parser)
+    add_loader_args(parser, num_workers=0)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8])
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--num_samples', type=int, default=512, help='Synthetic clouds in the dataset')
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--alpha1', type=float, default=0.1)
+    parser.add_argument('--alpha2', type=float, default=0.1)
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0: torch default)')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--out', type=str, default='')
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    device = torch.device('cuda' if args.cuda else 'cpu')
+
+    rows = []
+    for batch_size in args.batch_sizes:
+        row = run(args, batch_size, device)
+        rows.append(row)
+        print('%(model)s, batch %(batch_size)d: %(samples_per_sec).1f samples/sec, step %(step_ms).1f ms '
+              '(data %(data_ms).1f, forward %(forward_ms).1f, backward %(backward_ms).1f, '
+              'optimizer %(optimizer_ms).1f), peak %(peak_memory_mb).0f MB' % row)
+    print()
+    print_table(rows, ['model', 'batch_size', 'samples_per_sec', 'step_ms', 'data_ms', 'forward_ms', 'backward_ms',
+                       'optimizer_ms', 'peak_memory_mb'])
+    if args.out:
+        write_results(args.out, 'train', rows, args)
+
+
+if __name__ == '__main__':
+    main()
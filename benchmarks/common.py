@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import importlib.util
+import numpy as np
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REG_DIR = os.path.join(ROOT_DIR, 'registration')
+# root first: data.py / main.py of the root package win over the registration ones
+for path in (ROOT_DIR, REG_DIR):
+    if path not in sys.path:
+        sys.path.append(path)
+
+
+def load_module(name, path):
+    """Import a file under an explicit module name, e.g. registration/data.py next to the root data.py."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def registration_data():
+    return load_module('registration_data', os.path.join(REG_DIR, 'data.py'))
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn, warmup=3, iters=10, device='cpu'):
+    """Wall-clock statistics of fn() in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    times = []
+    for _ in range(iters):
+        t0 = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append((time.perf_counter() - t0) * 1000)
+    times = np.asarray(times)
+    return {'mean_ms': float(times.mean()), 'std_ms': float(times.std()), 'min_ms': float(times.min()),
+            'p50_ms': float(np.percentile(times, 50)), 'iters': iters}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def write_results(path, name, results, args=None):
+    """Write benchmark results with enough metadata to compare runs across commits."""
+    report = {
+        'benchmark': name,
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'torch': torch.__version__,
+        'host': platform.node(),
+        'cpu_threads': torch.get_num_threads(),
+        'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else '',
+        'args': vars(args) if args is not None else {},
+        'results': results,
+    }
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    print('Results written to %s' % path)
+
+
+def print_table(rows, columns):
+    widths = [max(len(str(c)), max([len(_fmt(row.get(c))) for row in rows] or [0])) for c in columns]
+    print('  '.join(str(c).ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(_fmt(row.get(c)).ljust(w) for c, w in zip(columns, widths)))
+
+
+def _fmt(value):
+    if isinstance(value, float):
+        return '%.3f' % value
+    return str(value)
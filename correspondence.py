@@ -0,0 +1,92 @@
+import os
+import numpy as np
+import torch
+
+
+def select_correspondences(M, threshold=0.4, max_matches=100):
+    """
+    For every point i of the first cloud the most probable point j of the second
+    (argmax over the last axis of M, shape (..., n1, n2)), kept when its
+    probability exceeds threshold. At most max_matches pairs are kept per
+    sample, the most confident ones. Returns src_idx, tgt_idx, prob and a valid
+    mask, each of shape (..., K) with K = min(max_matches, n1).
+    """
+    prob, tgt_idx = M.max(dim=-1)
+    masked = prob.masked_fill(prob <= threshold, float('-inf'))
+    k = min(max_matches, prob.size(-1))
+    top, src_idx = masked.topk(k, dim=-1)
+    return src_idx, tgt_idx.gather(-1, src_idx), prob.gather(-1, src_idx), torch.isfinite(top)
+
+
+def point_colors(pc):
+    """Colours from the normalised coordinates of a (n, 3) cloud, in [0.5, 1]."""
+    return ((pc - pc.min()) / (pc.max() - pc.min())) * 0.5 + 0.5
+
+
+def correspondence_geometry(pc, trans_pc, M, threshold=0.4, max_matches=100):
+    """
+    Line set between two (n, 3) clouds from a (n1, n2) correspondence matrix, as
+    numpy arrays: points (n1+n2, 3), point_colors, lines (L, 2) indexing points,
+    line_colors (L, 3) and confidences (L,). Both clouds use the colours of the
+    first cloud's points (the clouds are expected to have the same size), a
+    line takes the colour of its end point in the second cloud.
+    """
+    pc, trans_pc, M = torch.as_tensor(pc), torch.as_tensor(trans_pc), torch.as_tensor(M)
+    src_idx, tgt_idx, prob, valid = select_correspondences(M, threshold, max_matches)
+    src_idx, tgt_idx, prob = src_idx[valid], tgt_idx[valid], prob[valid]
+    colors = point_colors(pc).to(torch.float64)
+    return {
+        'points': torch.cat((pc, trans_pc)).cpu().numpy(),
+        'point_colors': torch.cat((colors, colors[:trans_pc.size(0)])).cpu().numpy(),
+        'lines': torch.stack((src_idx, tgt_idx + pc.size(0)), dim=1).cpu().numpy(),
+        'line_colors': colors[tgt_idx].cpu().numpy(),
+        'confidences': prob.cpu().numpy(),
+    }
+
+
+def write_ply(path, geometry):
+    """Binary PLY with coloured vertices and coloured edges (the correspondence lines)."""
+    points, lines = geometry['points'], geometry['lines']
+    vertices = np.empty(len(points), dtype=[('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                                            ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+    vertices['x'], vertices['y'], vertices['z'] = points.T
+    colors = np.clip(np.round(geometry['point_colors'] * 255), 0, 255).astype('u1')
+    vertices['red'], vertices['green'], vertices['blue'] = colors.T
+    edges = np.empty(len(lines), dtype=[('vertex1', '<i4'), ('vertex2', '<i4'),
+                                        ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+    edges['vertex1'], edges['vertex2'] = lines.T
+    colors = np.clip(np.round(geometry['line_colors'] * 255), 0, 255).astype('u1')
+    edges['red'], edges['green'], edges['blue'] = colors.T
+    header = ('ply\nformat binary_little_endian 1.0\n'
+              'element vertex %d\nproperty float x\nproperty float y\nproperty float z\n'
+              'property uchar red\nproperty uchar green\nproperty uchar blue\n'
+              'element edge %d\nproperty int vertex1\nproperty int vertex2\n'
+              'property uchar red\nproperty uchar green\nproperty uchar blue\n'
+              'end_header\n' % (len(vertices), len(edges)))
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(vertices.tobytes())
+        f.write(edges.tobytes())
+
+
+def export_geometry(path, geometry):
+    """Write correspondence_geometry output to .ply or .npz, chosen by the extension."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    if path.endswith('.npz'):
+        np.savez_compressed(path, **geometry)
+    else:
+        write_ply(path, geometry)
+
+
+def draw_geometry(geometry):
+    import open3d as o3d
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(geometry['points'])
+    pcd.colors = o3d.utility.Vector3dVector(geometry['point_colors'])
+    line_set = o3d.geometry.LineSet()
+    line_set.points = o3d.utility.Vector3dVector(geometry['points'])
+    line_set.lines = o3d.utility.Vector2iVector(geometry['lines'])
+    line_set.colors = o3d.utility.Vector3dVector(geometry['line_colors'])
+    o3d.visualization.draw_geometries([pcd, line_set])
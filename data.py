@@ -3,7 +3,9 @@ import sys
 import glob
 import h5py
 import numpy as np
+import torch
 from torch.utils.data import Dataset
+from sampling import subsample
 
 
 def download():
@@ -19,7 +21,7 @@ def download():
         os.system('rm %s' % (zipfile))
 
 
-def load_data(partition, debug):
+def load_data(partition, debug, with_transforms=False):
     # download()
     if debug:
         DATA_DIR = './data/debug'
@@ -27,15 +29,24 @@ def load_data(partition, debug):
         DATA_DIR = './data'
     all_point_clouds = []
     all_transformed_point_clouds = []
+    all_translations = []
+    all_rotations = []
     for h5_name in glob.glob(os.path.join(DATA_DIR, '%sData_*.h5'%partition)):
         f = h5py.File(h5_name)
         point_clouds = f['point_clouds'][:].astype('float32')
         transformed_point_clouds = f['transformed_point_clouds'][:].astype('float32')
+        if with_transforms:
+            # translation_ba and euler_ba as written by generate_datasets.py, see pose.stored_to_ab
+            all_translations.append(f['translation'][:].astype('float32'))
+            all_rotations.append(f['rotation'][:].astype('float32'))
         f.close()
         all_point_clouds.append(point_clouds)
         all_transformed_point_clouds.append(transformed_point_clouds)
     all_point_clouds = np.concatenate(all_point_clouds, axis=0)
     all_transformed_point_clouds = np.concatenate(all_transformed_point_clouds, axis=0)
+    if with_transforms:
+        return all_point_clouds, all_transformed_point_clouds, \
+               np.concatenate(all_translations, axis=0), np.concatenate(all_rotations, axis=0)
     return all_point_clouds, all_transformed_point_clouds
 
 
@@ -53,12 +64,50 @@ def jitter_pointcloud(pointcloud, sigma=0.01, clip=0.02):
     return pointcloud
 
 
+def take(array, items):
+    """array[items] as a slice when items is a contiguous ascending range, fancy indexing otherwise."""
+    if len(items) > 0 and items[-1] - items[0] == len(items) - 1 and np.all(np.diff(items) == 1):
+        return array[items[0]:items[-1] + 1]
+    return array[items]
+
+
+def shuffle_points(pointclouds):
+    """Independent random point order for every cloud of a (B, N, C) batch."""
+    perm = np.argsort(np.random.rand(*pointclouds.shape[:2]), axis=1)
+    return np.take_along_axis(pointclouds, perm[:, :, None], axis=1)
+
+
+def sample_pairs(point_clouds, transformed_point_clouds, num_points, sampling, voxel_size=0.05):
+    """
+    Reduce index-aligned pairs to num_points with sampling.subsample. The indices
+    are computed on the first clouds and shared, so point i still matches point i.
+    """
+    idx = subsample(point_clouds, num_points, sampling, voxel_size)[:, :, None]
+    return np.take_along_axis(point_clouds, idx, axis=1), np.take_along_axis(transformed_point_clouds, idx, axis=1)
+
+
 class ModelNet40(Dataset):
-    def __init__(self, num_points, partition='train', debug = False):
+    def __init__(self, num_points, partition='train', debug = False, sampling='first', voxel_size=0.05):
         self.point_clouds, self.transformed_point_clouds = load_data(partition, debug)
         self.partition = partition
+        if sampling != 'first':
+            self.point_clouds, self.transformed_point_clouds = sample_pairs(
+                self.point_clouds, self.transformed_point_clouds, num_points, sampling, voxel_size)
+
+    def get_batch(self, items):
+        """Stacked tensors for a list of indices, used with a BatchSampler instead of per-item collate."""
+        items = np.asarray(items)
+        pointcloud = take(self.point_clouds, items)
+        transformed_point_cloud = take(self.transformed_point_clouds, items)
+        if self.partition == 'train':
+            pointcloud = shuffle_points(pointcloud)
+            transformed_point_cloud = shuffle_points(transformed_point_cloud)
+        return torch.from_numpy(np.ascontiguousarray(pointcloud)), \
+               torch.from_numpy(np.ascontiguousarray(transformed_point_cloud))
 
     def __getitem__(self, item):
+        if isinstance(item, (list, np.ndarray)):
+            return self.get_batch(item)
         pointcloud = self.point_clouds[item]
         transformed_point_cloud = self.transformed_point_clouds[item]
         if self.partition == 'train':
@@ -70,6 +119,23 @@ class ModelNet40(Dataset):
     def __len__(self):
         return self.point_clouds.shape[0]
 
+class SyntheticModelNet40(ModelNet40):
+    """
+    ModelNet40 stand-in without the HDF5 files: num_pairs random clouds and
+    randomly rotated, translated copies, same __getitem__/get_batch paths.
+    Used to measure training throughput (main.py --synthetic, benchmarks/bench_train.py).
+    """
+
+    def __init__(self, num_points, partition='train', num_pairs=1024, seed=0):
+        rng = np.random.RandomState(seed if partition == 'train' else seed + 1)
+        self.point_clouds = rng.uniform(-1, 1, size=(num_pairs, num_points, 3)).astype('float32')
+        rotations, _ = np.linalg.qr(rng.normal(size=(num_pairs, 3, 3)))
+        translations = rng.uniform(-0.5, 0.5, size=(num_pairs, 1, 3))
+        self.transformed_point_clouds = (np.einsum('bij,bnj->bni', rotations, self.point_clouds)
+                                         + translations).astype('float32')
+        self.partition = partition
+
+
 class ModelNet40WithSequence(Dataset):
     def __init__(self, num_points, partition='train', debug = False):
         self.point_clouds, self.transformed_point_clouds = load_data(partition, debug)
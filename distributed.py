@@ -0,0 +1,90 @@
+import os
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+# Helpers for torchrun launches, e.g.
+#   torchrun --nproc_per_node=4 main.py --distributed
+#   torchrun --nproc_per_node=2 main.py --distributed --no_cuda True   (gloo on CPU)
+
+def init_distributed(args):
+    """
+    Join the process group described by the torchrun environment variables and
+    return the device this process should use. Sets args.rank, args.world_size
+    and args.local_rank.
+    """
+    args.rank = int(os.environ.get('RANK', 0))
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    backend = args.dist_backend or ('nccl' if args.cuda else 'gloo')
+    if args.cuda:
+        torch.cuda.set_device(args.local_rank)
+        device = torch.device('cuda', args.local_rank)
+    else:
+        device = torch.device('cpu')
+    dist.init_process_group(backend=backend, init_method='env://')
+    return device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def convert_sync_batchnorm(module, memo=None):
+    """
+    nn.SyncBatchNorm.convert_sync_batchnorm that keeps shared submodules shared.
+    DGCNN and FM3D register each BatchNorm twice (self.bnX and inside the
+    nn.Sequential), the stock converter would split them into two copies.
+    """
+    if memo is None:
+        memo = {}
+    if id(module) in memo:
+        return memo[id(module)]
+    if isinstance(module, nn.modules.batchnorm._BatchNorm):
+        converted = nn.SyncBatchNorm.convert_sync_batchnorm(module)
+    else:
+        converted = module
+        for name, child in list(module._modules.items()):
+            if child is not None:
+                module._modules[name] = convert_sync_batchnorm(child, memo)
+    memo[id(module)] = converted
+    return converted
+
+
+def wrap_model(model, args):
+    """DistributedDataParallel (with SyncBatchNorm on CUDA) when args.distributed, else the plain model."""
+    if not getattr(args, 'distributed', False):
+        return model
+    if args.cuda:
+        # SyncBatchNorm only runs on CUDA tensors, the gloo/CPU path keeps per-process statistics
+        model = convert_sync_batchnorm(model)
+        return DistributedDataParallel(model, device_ids=[args.local_rank], output_device=args.local_rank)
+    return DistributedDataParallel(model)
+
+
+def unwrap_model(model):
+    if isinstance(model, (nn.DataParallel, DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def all_reduce_max(tensor):
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.MAX)
+    return tensor
@@ -0,0 +1,80 @@
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+class EmbeddingCache:
+    """
+    LRU cache of per-cloud encoder outputs, bounded by the bytes of the stored
+    tensors and keyed by a blake2b hash of the point array. Only valid for an
+    encoder in eval mode: with batch statistics an embedding would depend on
+    the rest of the batch. Use one cache per set of weights, or tell the
+    models apart with tag.
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(points, tag=''):
+        if isinstance(points, torch.Tensor):
+            points = points.detach().cpu().numpy()
+        points = np.ascontiguousarray(points)
+        digest = hashlib.blake2b(points.tobytes(), digest_size=16)
+        digest.update(('%s%s%s' % (points.dtype.str, points.shape, tag)).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        embedding = self.entries.get(key)
+        if embedding is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return embedding
+
+    def put(self, key, embedding):
+        size = embedding.numel() * embedding.element_size()
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= self._size(self.entries.pop(key))
+        # a copy: a slice of a batch output would keep the whole batch's storage alive
+        self.entries[key] = embedding.detach().clone()
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= self._size(evicted)
+
+    def embed(self, points, encoder, tag=''):
+        """
+        encoder(points) for a b*3*n batch, computing only the clouds that are not
+        cached (in one encoder call) and returning the stacked b*d*n embeddings.
+        """
+        keys = [self.key(cloud, tag) for cloud in points]
+        embeddings = [self.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            computed = encoder(points[missing])
+            for j, i in enumerate(missing):
+                embeddings[i] = computed[j]
+                self.put(keys[i], computed[j])
+        return torch.stack(embeddings)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    @staticmethod
+    def _size(embedding):
+        return embedding.numel() * embedding.element_size()
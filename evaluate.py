@@ -0,0 +1,178 @@
+"""
+Correspondence accuracy of FM3D checkpoints on the generated pairs, using the
+ground-truth transforms stored next to them (generate_datasets.saveH5).
+
+For every point j of the second cloud the predicted match is argmax_i M[i, j].
+A match is an inlier at threshold tau when the first cloud's point i, moved by
+the ground-truth (R_ab, t_ab), lies within tau of point j. Per threshold the
+harness reports the inlier ratio (mean fraction of inlier matches) and the
+correspondence recall (fraction of pairs whose inlier ratio reaches
+--recall_ratio), plus the exact index accuracy of the aligned pairs.
+
+    python evaluate.py --checkpoint_dir checkpoints/exp_use_exponential/models --workers 4 \
+        --out results/eval.jsonl
+"""
+import os
+import re
+import glob
+import json
+import argparse
+import multiprocessing
+import torch
+from data import load_data
+from metric_logger import MetricAccumulator
+from pose import stored_to_ab
+
+THRESHOLDS = (0.01, 0.02, 0.05, 0.1)
+
+
+def correspondence_metrics(M, src, tgt, R_ab, t_ab, thresholds=THRESHOLDS, recall_ratio=0.05):
+    """
+    Batch means of the metrics above for M (b*n1*n2), src (b*3*n1), tgt (b*3*n2)
+    and the ground truth R_ab (b*3*3), t_ab (b*3). All thresholds in one
+    (b, n2, len(thresholds)) comparison.
+    """
+    pred = M.argmax(dim=1)  # b*n2
+    moved = torch.matmul(R_ab, src) + t_ab.unsqueeze(2)
+    matched = torch.gather(moved, 2, pred.unsqueeze(1).expand(-1, 3, -1))
+    distances = (matched - tgt).norm(dim=1)
+    taus = torch.tensor(thresholds, device=M.device, dtype=distances.dtype)
+    inlier_ratio = (distances.unsqueeze(2) < taus).float().mean(dim=1)  # b*len(thresholds)
+    recall = (inlier_ratio >= recall_ratio).float()
+    stats = {'index_accuracy': (pred == torch.arange(pred.size(1), device=pred.device)).float().mean(),
+             'mean_match_distance': distances.mean()}
+    for i, tau in enumerate(thresholds):
+        stats['inlier_ratio@%g' % tau] = inlier_ratio[:, i].mean()
+        stats['recall@%g' % tau] = recall[:, i].mean()
+    return stats
+
+
+def load_pairs(partition='test', debug=False, limit=0):
+    """(src, tgt, R_ab, t_ab) numpy arrays of the generated pairs, clouds as (B, N, 3)."""
+    src, tgt, translation, rotation = load_data(partition, debug, with_transforms=True)
+    if limit > 0:
+        src, tgt, translation, rotation = src[:limit], tgt[:limit], translation[:limit], rotation[:limit]
+    R_ab, t_ab = stored_to_ab(rotation, translation)
+    return src, tgt, R_ab, t_ab
+
+
+def evaluate_model(model, pairs, args, device):
+    src_all, tgt_all, R_all, t_all = pairs
+    acc = MetricAccumulator()
+    with torch.inference_mode():
+        for start in range(0, len(src_all), args.batch_size):
+            stop = start + args.batch_size
+            src = torch.from_numpy(src_all[start:stop]).to(device).transpose(2, 1).contiguous()
+            tgt = torch.from_numpy(tgt_all[start:stop]).to(device).transpose(2, 1).contiguous()
+            R_ab = torch.from_numpy(R_all[start:stop]).to(device)
+            t_ab = torch.from_numpy(t_all[start:stop]).to(device)
+            M = model.correspondence(src, tgt)
+            acc.update(src.size(0), **correspondence_metrics(M, src, tgt, R_ab, t_ab, args.thresholds,
+                                                             args.recall_ratio))
+    return acc.sync()
+
+
+def checkpoint_epoch(path):
+    match = re.search(r'(\d+)\.pth$', path)
+    return int(match.group(1)) if match else -1
+
+
+def evaluate_checkpoint(path, args, pairs=None, device=None):
+    """Metrics of one FM3D checkpoint (main.py format), pairs loaded unless given."""
+    from infer import load_fm3d
+    device = device or torch.device('cpu')
+    if pairs is None:
+        pairs = load_pairs(args.partition, args.debug, args.limit)
+    checkpoint_args = argparse.Namespace(**vars(args))
+    checkpoint_args.model_path = path
+    stats = evaluate_model(load_fm3d(checkpoint_args, device), pairs, args, device)
+    stats.update(checkpoint=path, epoch=checkpoint_epoch(path))
+    return stats
+
+
+_worker = {}
+
+
+def _init_worker(args):
+    torch.set_num_threads(args.threads_per_worker)
+    _worker['args'] = args
+    _worker['pairs'] = load_pairs(args.partition, args.debug, args.limit)
+
+
+def _evaluate_in_worker(path):
+    return evaluate_checkpoint(path, _worker['args'], _worker['pairs'])
+
+
+def evaluate_directory(args):
+    """Every *.pth under args.checkpoint_dir, in args.workers processes (CPU), sorted by epoch."""
+    paths = sorted(glob.glob(os.path.join(args.checkpoint_dir, '*.pth')), key=checkpoint_epoch)
+    if args.every > 1:
+        paths = [p for p in paths if checkpoint_epoch(p) % args.every == 0]
+    if not paths:
+        raise SystemExit('no *.pth checkpoints in %s' % args.checkpoint_dir)
+    if args.workers <= 1:
+        _init_worker(args)
+        return [_evaluate_in_worker(path) for path in paths]
+    # spawn: forked workers would share the parent's OpenMP thread pool state
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(args.workers, initializer=_init_worker, initargs=(args,)) as pool:
+        return pool.map(_evaluate_in_worker, paths, chunksize=1)
+
+
+def print_results(results, thresholds):
+    columns = ['epoch', 'index_accuracy'] + ['inlier_ratio@%g' % t for t in thresholds] + \
+              ['recall@%g' % t for t in thresholds]
+    print('  '.join(columns))
+    for stats in results:
+        print('  '.join('%d' % stats[c] if c == 'epoch' else '%.4f' % stats[c] for c in columns))
+
+
+def add_eval_args(parser):
+    parser.add_argument('--thresholds', type=float, nargs='+', default=list(THRESHOLDS),
+                        help='Inlier distance thresholds')
+    parser.add_argument('--recall_ratio', type=float, default=0.05,
+                        help='Inlier ratio a pair needs to count towards the recall')
+    parser.add_argument('--partition', type=str, default='test',
+                        help='Generated pairs to evaluate on (train or test)')
+    parser.add_argument('--limit', type=int, default=0, metavar='N',
+                        help='Only evaluate the first N pairs (0: all)')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FM3D correspondence evaluation')
+    parser.add_argument('--checkpoint_dir', type=str, required=True,
+                        help='Directory with the <epoch>.pth files written by main.py')
+    parser.add_argument('--every', type=int, default=1, metavar='N',
+                        help='Only evaluate epochs divisible by N')
+    parser.add_argument('--workers', type=int, default=4, metavar='N',
+                        help='Checkpoints evaluated in parallel, one process each')
+    parser.add_argument('--threads_per_worker', type=int, default=1, metavar='N',
+                        help='torch intra-op threads of each worker')
+    parser.add_argument('--batch_size', type=int, default=16, metavar='batch_size',
+                        help='Pairs per forward pass')
+    parser.add_argument('--debug', type=bool, default=False,
+                        help='Debug mode (pairs from data/debug)')
+    parser.add_argument('--dropout', type=float, default=0.5,
+                        help='dropout rate')
+    parser.add_argument('--emb_dims', type=int, default=1024, metavar='N',
+                        help='Dimension of embeddings')
+    parser.add_argument('--k', type=int, default=20, metavar='N',
+                        help='Num of nearest neighbors to use')
+    parser.add_argument('--similarity_metric', type=str, default='exponential', metavar='N',
+                        help='how to measure similarity: exponential or reciprocal')
+    parser.add_argument('--out', type=str, default='',
+                        help='Append one JSON line per checkpoint to this file')
+    add_eval_args(parser)
+    args = parser.parse_args()
+
+    results = evaluate_directory(args)
+    print_results(results, args.thresholds)
+    if args.out:
+        out_dir = os.path.dirname(args.out)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        with open(args.out, 'a') as f:
+            for stats in results:
+                f.write(json.dumps(stats) + '\n')
+        print('Results written to %s' % args.out)
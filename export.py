@@ -0,0 +1,136 @@
+"""
+Standalone inference artifacts for FM3D and RegModel. The inference graph is
+traced at a fixed batch size and point count, frozen and optimised, and saved
+as TorchScript; the .pt file loads with torch.jit.load and needs no code from
+this repository.
+
+    python export.py --model fm3d --model_path checkpoints/exp/models/50.pth --out exports/fm3d_1024.pt
+    python export.py --model reg --model_path registration/checkpoints/dcp_v2/models/model.best.t7 \
+        --out exports/reg_1024.pt
+
+FM3D artifacts map (src, tgt) b*3*n to the correspondence matrix M, RegModel
+artifacts map them to (rotation_ab, translation_ab).
+"""
+import os
+import sys
+import argparse
+import torch
+import torch.nn as nn
+from fuse import fuse_for_inference
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'registration'))
+
+
+class FM3DCorrespondence(nn.Module):
+    def __init__(self, fm3d):
+        super(FM3DCorrespondence, self).__init__()
+        self.fm3d = fm3d
+
+    def forward(self, src, tgt):
+        return self.fm3d.correspondence(src, tgt)
+
+
+class RegPose(nn.Module):
+    def __init__(self, reg_model):
+        super(RegPose, self).__init__()
+        self.reg_model = reg_model
+
+    def forward(self, src, tgt):
+        rotation_ab, translation_ab, _, _ = self.reg_model(src, tgt)
+        return rotation_ab, translation_ab
+
+
+def build_inference_model(args, device, fuse=True):
+    """
+    Eager inference module (eval mode) for args.model, loaded from args.model_path
+    when given, with BatchNorm folded into the convolutions unless fuse is False.
+    """
+    if args.model == 'fm3d':
+        from infer import load_fm3d
+        return FM3DCorrespondence(load_fm3d(args, device, fuse)).eval()
+    from RegModel import RegModel
+    net = RegModel(args).to(device)
+    if args.model_path:
+        net.load_state_dict(torch.load(args.model_path, map_location=device), strict=False)
+    return RegPose(fuse_for_inference(net) if fuse else net).eval()
+
+
+def example_inputs(args, device, batch_size=None):
+    batch_size = batch_size or args.batch_size
+    return (torch.randn(batch_size, 3, args.num_points, device=device),
+            torch.randn(batch_size, 3, args.num_points, device=device))
+
+
+def script_model(module, inputs):
+    """Trace under no_grad (Modified_softmax then takes its plain-op path), freeze and optimise."""
+    with torch.no_grad():
+        traced = torch.jit.trace(module, inputs)
+    return torch.jit.optimize_for_inference(traced)
+
+
+def compile_model(module, mode='default'):
+    """torch.compile with static shapes."""
+    return torch.compile(module, mode=mode, dynamic=False)
+
+
+def max_abs_diff(a, b):
+    if isinstance(a, torch.Tensor):
+        return (a - b).abs().max().item()
+    return max(max_abs_diff(x, y) for x, y in zip(a, b))
+
+
+def export(args):
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    module = build_inference_model(args, device)
+    inputs = example_inputs(args, device)
+    scripted = script_model(module, inputs)
+    check_inputs = example_inputs(args, device)
+    with torch.no_grad():
+        diff = max_abs_diff(module(*check_inputs), scripted(*check_inputs))
+    print('max |eager - scripted| on fresh inputs: %.3g' % diff)
+    out_dir = os.path.dirname(args.out)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    torch.jit.save(scripted, args.out)
+    print('TorchScript %s model for batch %d x %d points written to %s'
+          % (args.model, args.batch_size, args.num_points, args.out))
+
+
+def add_model_args(parser):
+    parser.add_argument('--model', type=str, default='fm3d', choices=['fm3d', 'reg'],
+                        help='fm3d: correspondence matrix, reg: RegModel pose')
+    parser.add_argument('--model_path', type=str, default='', metavar='N',
+                        help='Checkpoint, FM3D (main.py) or RegModel (registration/main.py)')
+    parser.add_argument('--emb_dims', type=int, default=1024, metavar='N',
+                        help='Dimension of embeddings')
+    parser.add_argument('--k', type=int, default=20, metavar='N',
+                        help='Num of nearest neighbors to use')
+    parser.add_argument('--dropout', type=float, default=0.0,
+                        help='dropout rate')
+    parser.add_argument('--similarity_metric', type=str, default='exponential', metavar='N',
+                        help='FM3D: how to measure similarity, exponential or reciprocal')
+    parser.add_argument('--n_blocks', type=int, default=1, metavar='N',
+                        help='RegModel: num of blocks of encoder&decoder')
+    parser.add_argument('--n_heads', type=int, default=4, metavar='N',
+                        help='RegModel: num of heads in multiheadedattention')
+    parser.add_argument('--ff_dims', type=int, default=1024, metavar='N',
+                        help='RegModel: num of dimensions of fc in transformer')
+    parser.add_argument('--cycle', type=bool, default=False, metavar='N',
+                        help='RegModel: whether to use cycle consistency')
+    parser.add_argument('--no_cuda', action='store_true', default=False,
+                        help='Run on the CPU even if CUDA is available')
+    return parser
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export FM3D / RegModel for inference')
+    add_model_args(parser)
+    parser.add_argument('--batch_size', type=int, default=1, metavar='batch_size',
+                        help='Batch size the artifact is traced for')
+    parser.add_argument('--num_points', type=int, default=1024, metavar='N',
+                        help='Points per cloud the artifact is traced for')
+    parser.add_argument('--out', type=str, required=True,
+                        help='Output .pt file')
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    export(args)
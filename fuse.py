@@ -0,0 +1,175 @@
+"""
+BatchNorm folding for inference. fuse_for_inference returns an eval-only copy
+of a module in which every BatchNorm that directly follows a Conv1d/Conv2d or
+Linear is folded into that layer's weight and bias and replaced by Identity:
+
+- inside an nn.Sequential (model.DGCNN conv1..conv5, FM3D.predictor, the
+  classification DGCNN),
+- for attribute pairs convN / bnN applied as bnN(convN(x)) (registration
+  _model.PointNet), or any explicit (layer, bn) attribute names passed in pairs.
+
+DGCNN and FM3D register each BatchNorm twice (self.bnX and inside the
+Sequential); every reference to a folded BatchNorm is replaced.
+
+    python fuse.py    # numeric check (float64) and timing (float32) on random weights
+"""
+import os
+import re
+import sys
+import copy
+import argparse
+import importlib.util
+from time import perf_counter
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
+
+
+def _is_bn(module):
+    return isinstance(module, nn.modules.batchnorm._BatchNorm) and module.track_running_stats
+
+
+def _fold(layer, bn):
+    if isinstance(layer, (nn.Conv1d, nn.Conv2d)):
+        return fuse_conv_bn_eval(layer, bn)
+    if isinstance(layer, nn.Linear):
+        return fuse_linear_bn_eval(layer, bn)
+    return None
+
+
+def _fold_sequentials(module, folded):
+    for child in module.modules():
+        if not isinstance(child, nn.Sequential):
+            continue
+        for i in range(len(child) - 1):
+            if _is_bn(child[i + 1]):
+                fused = _fold(child[i], child[i + 1])
+                if fused is not None:
+                    folded.add(id(child[i + 1]))
+                    child[i] = fused
+                    child[i + 1] = nn.Identity()
+
+
+def _fold_attribute_pairs(module, pairs, folded):
+    for child in list(module.modules()):
+        names = list(pairs)
+        for name in child._modules:
+            match = re.fullmatch(r'conv(\d+)', name)
+            if match:
+                names.append((name, 'bn' + match.group(1)))
+        for layer_name, bn_name in names:
+            layer, bn = child._modules.get(layer_name), child._modules.get(bn_name)
+            if layer is None or bn is None or not _is_bn(bn) or id(bn) in folded:
+                continue
+            fused = _fold(layer, bn)
+            if fused is not None:
+                folded.add(id(bn))
+                child._modules[layer_name] = fused
+                child._modules[bn_name] = nn.Identity()
+
+
+def _drop_folded(module, folded):
+    for child in module.modules():
+        for name, grandchild in child._modules.items():
+            if grandchild is not None and id(grandchild) in folded:
+                child._modules[name] = nn.Identity()
+
+
+def fuse_for_inference(module, pairs=()):
+    """Eval-mode copy of module with BatchNorm folded into the preceding conv/linear layers."""
+    fused = copy.deepcopy(module).eval()
+    folded = set()
+    _fold_sequentials(fused, folded)
+    _fold_attribute_pairs(fused, pairs, folded)
+    _drop_folded(fused, folded)
+    for parameter in fused.parameters():
+        parameter.requires_grad_(False)
+    return fused
+
+
+def max_fusion_error(module, fused, *inputs):
+    """
+    Largest difference between the outputs of module (in eval mode) and its
+    fused copy, relative to the largest output magnitude. float32 rounding
+    through a whole DGCNN is around 1e-3 absolute, run the check in float64
+    to see the folding error itself.
+    """
+    module.eval()
+    with torch.no_grad():
+        out, out_fused = module(*inputs), fused(*inputs)
+    if isinstance(out, torch.Tensor):
+        out, out_fused = (out,), (out_fused,)
+    return max(((a - b).abs().max() / a.abs().max().clamp(min=1e-12)).item() for a, b in zip(out, out_fused))
+
+
+def _randomize_bn(module):
+    # freshly built BatchNorms are the identity, give them statistics so the check means something
+    for child in module.modules():
+        if _is_bn(child):
+            child.running_mean.uniform_(-0.5, 0.5)
+            child.running_var.uniform_(0.5, 2.0)
+            if child.affine:
+                child.weight.data.uniform_(0.5, 1.5)
+                child.bias.data.uniform_(-0.5, 0.5)
+    return module
+
+
+def _time(module, inputs, iters=10):
+    with torch.no_grad():
+        module(*inputs)
+        start = perf_counter()
+        for _ in range(iters):
+            module(*inputs)
+    return (perf_counter() - start) * 1000 / iters
+
+
+def check_cases(args):
+    """(name, module, inputs) for every model the folding supports, random BatchNorm statistics."""
+    from model import DGCNN, FM3D
+    root = os.path.dirname(os.path.abspath(__file__))
+    if os.path.join(root, 'registration') not in sys.path:
+        sys.path.append(os.path.join(root, 'registration'))
+    from _model import PointNet
+    spec = importlib.util.spec_from_file_location('classfication_model',
+                                                  os.path.join(root, 'classification', 'classfication_model.py'))
+    classification = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(classification)
+
+    x = torch.randn(args.batch_size, 3, args.num_points)
+    y = torch.randn(args.batch_size, 3, args.num_points)
+    cases = [('model.DGCNN', DGCNN(args), (x,)),
+             ('FM3D', FM3D(args), (x, y)),
+             ('classification DGCNN', classification.DGCNN(args), (x,)),
+             ('_model.PointNet', PointNet(emb_dims=args.emb_dims), (x,))]
+    return [(name, _randomize_bn(module).eval(), inputs) for name, module, inputs in cases]
+
+
+def check_fusion(module, inputs):
+    """(relative error in float64, BatchNorms left) of fuse_for_inference(module)."""
+    module = copy.deepcopy(module).double()
+    fused = fuse_for_inference(module)
+    remaining = sum(_is_bn(m) for m in fused.modules())
+    return max_fusion_error(module, fused, *[x.double() for x in inputs]), remaining
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check BatchNorm folding numerically')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--emb_dims', type=int, default=1024)
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--rtol', type=float, default=1e-9,
+                        help='Largest relative output difference allowed, checked in float64')
+    args = parser.parse_args()
+    args.dropout = 0.5
+    args.similarity_metric = 'exponential'
+
+    failed = False
+    for name, module, inputs in check_cases(args):
+        error, remaining = check_fusion(module, inputs)
+        failed = failed or error > args.rtol or remaining > 0
+        fused = fuse_for_inference(module)
+        print('%-22s max rel error %.2e (float64), BatchNorms left %d, %.1f ms -> %.1f ms (float32)'
+              % (name, error, remaining, _time(module, inputs), _time(fused, inputs)))
+    if failed:
+        raise SystemExit('fusion check failed (rtol %g)' % args.rtol)
@@ -5,6 +5,7 @@ import numpy as np
 from sklearn.neighbors import NearestNeighbors
 from scipy.spatial.distance import minkowski
 from scipy.spatial.transform import Rotation
+from sampling import subsample
 
 
 def load_data(partition):
@@ -95,15 +96,17 @@ def transformPointcloud(partial_cloud, rot_factor=4, d=0.5):
     return pointcloud_, translation_ba, euler_ba
 
 
-def pairing(start_index, end_index):
+def pairing(start_index, end_index, num_points=1024, sampling='fps'):
     data, label = load_data('train')
+    # one batched pass over the range instead of keeping the first num_points of every shape
+    idx = subsample(data[start_index:end_index], num_points, sampling)
     # transformed_partial_clouds = list()
     translation_list = list()
     rotation_list = list()
     point_clouds_list = list()
     transformed_point_clouds_list = list()
     for cloud_index in range(start_index, end_index):  # data.shape[0]
-        pointcloud = data[cloud_index][:1024]
+        pointcloud = data[cloud_index][idx[cloud_index - start_index]]
         pointcloud = translate_pointcloud(pointcloud)
         point_clouds_list.append(pointcloud)
         transformed_pointcloud, translation_ba, euler_ba = transformPointcloud(pointcloud)
@@ -0,0 +1,197 @@
+"""
+Headless batched FM3D inference. Reads point cloud pairs from an HDF5 or npz
+file, runs FM3D.correspondence under torch.inference_mode and streams, for
+every point of the second cloud, the top-k matching points of the first cloud
+and their probabilities to an HDF5 (or npz) file. With --num_points, larger
+clouds are sampled down first (sampling.py); the written indices still refer
+to the input points and 'points' holds the input index of every row.
+
+    python infer.py --model_path checkpoints/exp/models/50.pth \
+        --input data/testData_0.h5 --output results/test0_matches.h5 --topk 5
+"""
+import os
+import argparse
+from time import time
+import h5py
+import numpy as np
+import torch
+from model import FM3D
+from fuse import fuse_for_inference
+from sampling import METHODS, sample_points, gather_points
+
+
+def load_fm3d(args, device, fuse=True):
+    """FM3D in eval mode, with BatchNorm folded into the convolutions unless fuse is False."""
+    model = FM3D(args).to(device)
+    if args.model_path:
+        checkpoint = torch.load(args.model_path, map_location=device)
+        model.DGCNN.load_state_dict(checkpoint['DGCNN_state_dict'])
+        model.predictor.load_state_dict(checkpoint['predictor_state_dict'])
+        print("=> loaded checkpoint '{}' (epoch {})".format(args.model_path, checkpoint['epoch']))
+    return fuse_for_inference(model) if fuse else model.eval()
+
+
+class PairReader:
+    """Batches of (src, tgt) float32 arrays, read lazily from HDF5 or loaded from npz."""
+
+    def __init__(self, path, src_key='point_clouds', tgt_key='transformed_point_clouds', limit=0):
+        if path.endswith('.npz'):
+            self.file = None
+            arrays = np.load(path)
+            self.src, self.tgt = arrays[src_key], arrays[tgt_key]
+        else:
+            self.file = h5py.File(path, 'r')
+            self.src, self.tgt = self.file[src_key], self.file[tgt_key]
+        self.num_pairs = self.src.shape[0] if limit <= 0 else min(limit, self.src.shape[0])
+        self.num_points = self.src.shape[1]
+
+    def batches(self, batch_size):
+        for start in range(0, self.num_pairs, batch_size):
+            stop = min(start + batch_size, self.num_pairs)
+            yield start, np.asarray(self.src[start:stop], dtype='float32'), \
+                  np.asarray(self.tgt[start:stop], dtype='float32')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class MatchWriter:
+    """
+    Top-k indices (uint16 when the clouds allow it) and float16 confidences of
+    shape (num_pairs, num_points, k). HDF5 output is written batch by batch, npz
+    output is filled in memory and saved on close.
+    """
+
+    def __init__(self, path, num_pairs, num_points, k, attrs=None, sampled=False):
+        self.path = path
+        index_dtype = 'uint16' if num_points <= np.iinfo('uint16').max else 'int32'
+        shape = (num_pairs, num_points, k)
+        if path.endswith('.npz'):
+            self.file = None
+            self.indices = np.empty(shape, dtype=index_dtype)
+            self.confidences = np.empty(shape, dtype='float16')
+            self.points = np.empty(shape[:2], dtype=index_dtype) if sampled else None
+        else:
+            self.file = h5py.File(path, 'w')
+            chunks = (min(num_pairs, 64), num_points, k)
+            self.indices = self.file.create_dataset('indices', shape, dtype=index_dtype, chunks=chunks,
+                                                    compression='lzf')
+            self.confidences = self.file.create_dataset('confidences', shape, dtype='float16', chunks=chunks,
+                                                        compression='lzf')
+            self.points = None
+            if sampled:
+                self.points = self.file.create_dataset('points', shape[:2], dtype=index_dtype, chunks=chunks[:2],
+                                                       compression='lzf')
+            for key, value in (attrs or {}).items():
+                self.file.attrs[key] = value
+        self.attrs = attrs or {}
+
+    def write(self, start, indices, confidences, points=None):
+        stop = start + indices.shape[0]
+        self.indices[start:stop] = indices
+        self.confidences[start:stop] = confidences
+        if points is not None:
+            self.points[start:stop] = points
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        else:
+            arrays = {} if self.points is None else {'points': self.points}
+            np.savez(self.path, indices=self.indices, confidences=self.confidences, **arrays, **self.attrs)
+
+
+def topk_matches(M, k):
+    """For every point j of the second cloud, the k most probable points of the first, (b, n, k) each."""
+    confidences, indices = M.topk(k, dim=1)
+    return indices.transpose(1, 2), confidences.transpose(1, 2)
+
+
+def infer(args):
+    device = torch.device("cuda" if args.cuda else "cpu")
+    model = load_fm3d(args, device)
+    reader = PairReader(args.input, args.src_key, args.tgt_key, args.limit)
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    sampled = 0 < args.num_points < reader.num_points
+    writer = MatchWriter(args.output, reader.num_pairs, args.num_points if sampled else reader.num_points, args.topk,
+                         attrs={'topk': args.topk, 'input': args.input, 'model_path': args.model_path,
+                                'sampling': args.sampling if sampled else 'none'}, sampled=sampled)
+
+    model_time = 0.0
+    start_time = time()
+    with torch.inference_mode():
+        for i, (start, src, tgt) in enumerate(reader.batches(args.batch_size)):
+            src = torch.from_numpy(src).to(device, non_blocking=True).permute(0, 2, 1)  # b*3*n
+            tgt = torch.from_numpy(tgt).to(device, non_blocking=True).permute(0, 2, 1)
+            batch_start = time()
+            points = None
+            if sampled:
+                src_idx = sample_points(src, args.num_points, args.sampling, args.voxel_size)
+                # the pairs are index-aligned unless --independent_sampling, so reuse the source indices
+                tgt_idx = sample_points(tgt, args.num_points, args.sampling, args.voxel_size) \
+                    if args.independent_sampling else src_idx
+                src, tgt = gather_points(src, src_idx), gather_points(tgt, tgt_idx)
+            M = model.correspondence(src, tgt)
+            indices, confidences = topk_matches(M, args.topk)
+            if sampled:
+                indices = torch.gather(src_idx.unsqueeze(1).expand(-1, indices.size(1), -1), 2, indices)
+                points = tgt_idx.to(torch.int32).cpu().numpy()
+            indices = indices.to(torch.int32).cpu().numpy()
+            confidences = confidences.to(torch.float16).cpu().numpy()
+            model_time += time() - batch_start
+            writer.write(start, indices, confidences, points)
+            if args.log_interval > 0 and (i + 1) % args.log_interval == 0:
+                done = start + src.size(0)
+                print("%d/%d pairs, %.1f pairs/sec" % (done, reader.num_pairs, done / (time() - start_time)))
+    writer.close()
+    reader.close()
+    total_time = time() - start_time
+    print("%d pairs in %.2fs: %.1f pairs/sec end to end, %.1f pairs/sec model only"
+          % (reader.num_pairs, total_time, reader.num_pairs / total_time, reader.num_pairs / max(model_time, 1e-9)))
+    print("Correspondences written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='FM3D batch inference')
+    parser.add_argument('--input', type=str, required=True,
+                        help='HDF5 or npz file with the point cloud pairs')
+    parser.add_argument('--src_key', type=str, default='point_clouds',
+                        help='Dataset/array holding the first cloud of every pair')
+    parser.add_argument('--tgt_key', type=str, default='transformed_point_clouds',
+                        help='Dataset/array holding the second cloud of every pair')
+    parser.add_argument('--output', type=str, required=True,
+                        help='Output file, .h5 (streamed) or .npz')
+    parser.add_argument('--topk', type=int, default=5, metavar='N',
+                        help='Matches kept per point')
+    parser.add_argument('--limit', type=int, default=0, metavar='N',
+                        help='Only process the first N pairs (0: all)')
+    parser.add_argument('--batch_size', type=int, default=32, metavar='batch_size',
+                        help='Pairs per forward pass')
+    parser.add_argument('--num_points', type=int, default=0, metavar='N',
+                        help='Sample larger clouds down to N points first (0: use every point)')
+    parser.add_argument('--sampling', type=str, default='fps', choices=METHODS,
+                        help='Sampling method of --num_points')
+    parser.add_argument('--voxel_size', type=float, default=0.05,
+                        help='Grid cell size of --sampling voxel')
+    parser.add_argument('--independent_sampling', action='store_true', default=False,
+                        help='Sample the second clouds on their own instead of reusing the first clouds\' indices')
+    parser.add_argument('--log_interval', type=int, default=20, metavar='N',
+                        help='Print throughput every N batches (0: only at the end)')
+    parser.add_argument('--no_cuda', type=bool, default=False,
+                        help='Run on the CPU even if CUDA is available')
+    parser.add_argument('--dropout', type=float, default=0.5,
+                        help='dropout rate')
+    parser.add_argument('--emb_dims', type=int, default=1024, metavar='N',
+                        help='Dimension of embeddings')
+    parser.add_argument('--k', type=int, default=20, metavar='N',
+                        help='Num of nearest neighbors to use')
+    parser.add_argument('--model_path', type=str, default='', metavar='N',
+                        help='Pretrained model path')
+    parser.add_argument('--similarity_metric', type=str, default='exponential', metavar='N',
+                        help='how to measure similarity: exponential or reciprocal')
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    infer(args)
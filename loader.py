@@ -0,0 +1,63 @@
+import random
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler
+
+
+def add_loader_args(parser, num_workers=8):
+    parser.add_argument('--num_workers', type=int, default=num_workers, metavar='N',
+                        help='DataLoader worker processes')
+    parser.add_argument('--pin_memory', action='store_true', default=False,
+                        help='Pin host batches for faster, asynchronous copies to the GPU')
+    parser.add_argument('--prefetch_factor', type=int, default=2, metavar='N',
+                        help='Batches prefetched by each worker')
+    parser.add_argument('--persistent_workers', action='store_true', default=False,
+                        help='Keep workers alive between epochs')
+    parser.add_argument('--per_sample_collate', action='store_true', default=False,
+                        help='Index datasets one sample at a time and collate, instead of whole batches')
+    return parser
+
+
+def seed_worker(worker_id):
+    # torch gives every worker initial_seed() = base_seed + worker_id, reuse it for
+    # the numpy/random augmentation in the datasets so workers never repeat permutations
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def build_loader(dataset, args, batch_size, shuffle=False, drop_last=False, sampler=None):
+    """
+    DataLoader configured from the add_loader_args options, seeded from args.seed.
+    Datasets with a get_batch method receive whole index lists from a BatchSampler
+    and return stacked tensors, which skips the per-sample default_collate.
+    """
+    generator = torch.Generator()
+    generator.manual_seed(args.seed + 1000 * getattr(args, 'rank', 0))
+    if hasattr(dataset, 'get_batch') and not getattr(args, 'per_sample_collate', False):
+        if sampler is None:
+            sampler = RandomSampler(dataset, generator=generator) if shuffle else SequentialSampler(dataset)
+        kwargs = dict(batch_size=None,
+                      sampler=BatchSampler(sampler, batch_size, drop_last))
+    else:
+        kwargs = dict(batch_size=batch_size,
+                      shuffle=shuffle and sampler is None,
+                      sampler=sampler,
+                      drop_last=drop_last)
+    kwargs.update(num_workers=args.num_workers,
+                  pin_memory=args.pin_memory and torch.cuda.is_available(),
+                  worker_init_fn=seed_worker,
+                  generator=generator)
+    if args.num_workers > 0:
+        kwargs['prefetch_factor'] = args.prefetch_factor
+        kwargs['persistent_workers'] = args.persistent_workers
+    return DataLoader(dataset, **kwargs)
+
+
+def set_loader_epoch(loader, epoch):
+    """Forward the epoch to a DistributedSampler, also when it sits inside a BatchSampler."""
+    sampler = loader.sampler
+    if isinstance(sampler, BatchSampler):
+        sampler = sampler.sampler
+    if hasattr(sampler, 'set_epoch'):
+        sampler.set_epoch(epoch)
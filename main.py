@@ -2,19 +2,20 @@ from __future__ import print_function
 import os
 import argparse
 import torch
-import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.optim.lr_scheduler import CosineAnnealingLR
-from data import ModelNet40
-from model import FM3D, DGCNN, contrastive_loss
-import numpy as np
-from torch.utils.data import DataLoader
-import sklearn.metrics as metrics
+from data import ModelNet40, SyntheticModelNet40
+from model import FM3D, contrastive_loss
+from torch.utils.data.distributed import DistributedSampler
 from time import time
-import matplotlib.pyplot as plt
-import numpy as np
-from torchsummary import summary
+from metric_logger import MetricLogger, MetricAccumulator
+from loader import add_loader_args, build_loader
+from sampling import add_sampling_args
+import profiling
+from distributed import init_distributed, wrap_model, unwrap_model, is_main_process, cleanup
+from evaluate import evaluate_checkpoint, add_eval_args
+from memory import add_memory_args, auto_batch, accumulation_context
 
 
 def _init_():
@@ -30,17 +31,35 @@ def _init_():
     os.system('cp data.py checkpoints' + '/' + args.exp_name + '/' + 'data.py.backup')
 
 def train(args):
-    train_loader = DataLoader(ModelNet40(partition='train', num_points=args.num_points, debug = args.debug), num_workers=8,
-                              batch_size=args.batch_size, shuffle=True, drop_last=True)
-    test_loader = DataLoader(ModelNet40(partition='test', num_points=args.num_points, debug = args.debug), num_workers=8,
-                             batch_size=args.test_batch_size, shuffle=True, drop_last=False)
+    if args.distributed:
+        device = init_distributed(args)
+    else:
+        device = torch.device("cuda" if args.cuda else "cpu")
+    if args.memory_budget > 0:
+        # args.batch_size stays the effective batch, the loader gets the micro-batch
+        auto_batch(args, 'fm3d', device)
 
-    device = torch.device("cuda" if args.cuda else "cpu")
+    if args.synthetic > 0:
+        train_set = SyntheticModelNet40(args.num_points, 'train', args.synthetic, args.seed)
+        test_set = SyntheticModelNet40(args.num_points, 'test', max(args.synthetic // 4, 1), args.seed)
+    else:
+        train_set = ModelNet40(partition='train', num_points=args.num_points, debug = args.debug,
+                               sampling=args.sampling, voxel_size=args.voxel_size)
+        test_set = ModelNet40(partition='test', num_points=args.num_points, debug = args.debug,
+                              sampling=args.sampling, voxel_size=args.voxel_size)
+    train_sampler = DistributedSampler(train_set, shuffle=True) if args.distributed else None
+    test_sampler = DistributedSampler(test_set, shuffle=False) if args.distributed else None
+    train_loader = build_loader(train_set, args, args.batch_size, shuffle=True, drop_last=True, sampler=train_sampler)
+    test_loader = build_loader(test_set, args, args.test_batch_size, shuffle=True, drop_last=False, sampler=test_sampler)
+
+    if is_main_process() and not os.path.exists('checkpoints/' + args.exp_name + '/models'):
+        os.makedirs('checkpoints/' + args.exp_name + '/models')
 
     #Try to load models
     model = FM3D(args).to(device)
-    model = nn.DataParallel(model)
-    print("Let's use", torch.cuda.device_count(), "GPUs!")
+    model = wrap_model(model, args)
+    if args.distributed:
+        print("Process %d of %d on %s" % (args.rank, args.world_size, device))
 
     if args.use_sgd:
         print("Use SGD")
@@ -56,10 +75,10 @@ def train(args):
     if args.model_path:
         if os.path.isfile(args.model_path):
             print("=> loading checkpoint '{}'".format(args.model_path))
-            checkpoint = torch.load(args.model_path)
+            checkpoint = torch.load(args.model_path, map_location=device)
             args.start_epoch = checkpoint['epoch']
-            model.module.DGCNN.load_state_dict(checkpoint['DGCNN_state_dict'])
-            model.module.predictor.load_state_dict(checkpoint['predictor_state_dict'])
+            unwrap_model(model).DGCNN.load_state_dict(checkpoint['DGCNN_state_dict'])
+            unwrap_model(model).predictor.load_state_dict(checkpoint['predictor_state_dict'])
             # model.load_state_dict(checkpoint['state_dict'])
             opt.load_state_dict(checkpoint['optimizer'])
             scheduler.load_state_dict(checkpoint['scheduler'])
@@ -76,195 +95,103 @@ def train(args):
         start_epoch = args.start_epoch + 1
     else:
         start_epoch = 0
-    # train_loss_list = np.empty((0, 4)) ## 
-    # train_count_list = []
-    # total_count_train = 0
-    # total_count_test = 0
-    # test_loss_list = np.empty((0, 4))
-    # test_count_list = []
-
-    train_data = {
-        "Final_loss":[],
-        "FB_loss":[], 
-        "M_loss1":[], 
-        "M_loss2":[]
-    }
-    test_data = {
-        "Final_loss":[],
-        "FB_loss":[], 
-        "M_loss1":[], 
-        "M_loss2":[]
-    }
+    logger = MetricLogger('checkpoints/' + args.exp_name + '/metrics.jsonl') if is_main_process() else None
+    loss_names = ["Final_loss", "FB_loss", "M_loss1", "M_loss2"]
+    step = start_epoch * len(train_loader)
+    profiler = profiling.enable() if args.profile_stages else None
     for epoch in range(start_epoch, args.epochs):
-        count = 0
-        epoch_time = 0
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         model.train()
-        train_epoch_data = {
-            "Final_loss":0,
-            "FB_loss":0, 
-            "M_loss1":0, 
-            "M_loss2":0
-        }
-        test_epoch_data = {
-            "Final_loss":0,
-            "FB_loss":0, 
-            "M_loss1":0, 
-            "M_loss2":0
-        }
-        for pointcloud, transformed_point_cloud in train_loader:
-            t0 = time()
-            pointcloud = pointcloud.to(device)  #b*1024*3
-            transformed_point_cloud = transformed_point_cloud.to(device)
+        train_acc = MetricAccumulator(distributed=args.distributed)
+        step_acc = MetricAccumulator()
+        t0 = time()
+        for i, (pointcloud, transformed_point_cloud) in enumerate(train_loader):
+            pointcloud = pointcloud.to(device, non_blocking=True)  #b*1024*3
+            transformed_point_cloud = transformed_point_cloud.to(device, non_blocking=True)
             pointcloud = pointcloud.permute(0, 2, 1) #b*3*1024
             transformed_point_cloud = transformed_point_cloud.permute(0, 2, 1)
             batch_size = pointcloud.size()[0]
-            opt.zero_grad()
-            fe1_nograd, fe2_nograd, fe1_final, fe2_final, M = model(pointcloud, transformed_point_cloud)
-            final_loss, FB_loss, M_loss1,M_loss2 = loss_function(fe1_nograd, fe2_nograd, fe1_final, fe2_final, M)
-            final_loss.backward()
-            ## stack the lose into storge
-            # train_loss_list = np.vstack((train_loss_list, np.array([final_loss.item(), FB_loss.item(), M_loss1.item(),M_loss2.item()])))
-            opt.step()
-            count += 1
-            # total_count_train += batch_size
-            # train_count_list.append(total_count_train)
-            batch_time = time() - t0
-            epoch_time += batch_time
-            train_epoch_data["Final_loss"] += final_loss.item()
-            train_epoch_data["FB_loss"] += FB_loss.item()
-            train_epoch_data["M_loss1"] += M_loss1.item()
-            train_epoch_data["M_loss2"] += M_loss2.item()
-        train_data["Final_loss"].append(train_epoch_data["Final_loss"]/count)
-        train_data["FB_loss"].append(train_epoch_data["FB_loss"]/count)
-        train_data["M_loss1"].append(train_epoch_data["M_loss1"]/count)
-        train_data["M_loss2"].append(train_epoch_data["M_loss2"]/count)
+            if i % args.accumulation_steps == 0:
+                opt.zero_grad()
+                # the last group of an epoch can hold fewer micro-batches
+                group_size = min(args.accumulation_steps, len(train_loader) - i)
+            sync = (i + 1) % args.accumulation_steps == 0 or i + 1 == len(train_loader)
+            with accumulation_context(model, args, sync):
+                fe1_nograd, fe2_nograd, fe1_final, fe2_final, M = model(pointcloud, transformed_point_cloud)
+                final_loss, FB_loss, M_loss1,M_loss2 = loss_function(fe1_nograd, fe2_nograd, fe1_final, fe2_final, M)
+                (final_loss / group_size).backward()
+            if sync:
+                opt.step()
+            step += 1
+            # running sums stay on the device, the host only syncs at logging intervals
+            losses = dict(zip(loss_names, (final_loss, FB_loss, M_loss1, M_loss2)))
+            train_acc.update(**losses)
+            step_acc.update(**losses)
+            if logger is not None and step % args.log_interval == 0:
+                logger.log('train', epoch, step=step, **step_acc.sync())
+                step_acc.reset()
+        train_epoch_data = train_acc.sync()
+        if profiler is not None:
+            if is_main_process():
+                print(profiler.format())
+                profiler.export('checkpoints/' + args.exp_name + '/stages.jsonl', epoch)
+            profiler.reset()
+        epoch_time = time() - t0
         scheduler.step()            
+        if not is_main_process():
+            test_one_epoch(model, test_loader, loss_function, device, loss_names, args)
+            continue
+        logger.log('train', epoch, **train_epoch_data)
         outstr = 'Train epoch %d: final_loss: %.6f, FB_loss: %.6f, M_loss1: %.6f, M_loss2: %.6f, epoch training time: %.3f' \
-                    % (epoch, train_data["Final_loss"][-1], train_data["FB_loss"][-1], train_data["M_loss1"][-1], train_data["M_loss2"][-1], epoch_time)     
+                    % (epoch, train_epoch_data["Final_loss"], train_epoch_data["FB_loss"], train_epoch_data["M_loss1"], train_epoch_data["M_loss2"], epoch_time)     
         total_time += epoch_time
         print(outstr)
         checkpoint = {
-            "DGCNN_state_dict": model.module.DGCNN.state_dict(), 
-            "predictor_state_dict": model.module.predictor.state_dict(),
+            "DGCNN_state_dict": unwrap_model(model).DGCNN.state_dict(), 
+            "predictor_state_dict": unwrap_model(model).predictor.state_dict(),
             "epoch": epoch,
             "optimizer": opt.state_dict(),
             "scheduler": scheduler.state_dict()
         }
         filename = 'checkpoints/'+args.exp_name+'/'+'models/'+f'{epoch}.pth'
         torch.save(checkpoint, filename)
-        epoch_time = 0
 
-        count = 0
-        model.eval()
-        with torch.no_grad():
-            for pointcloud, transformed_point_cloud in test_loader:
-                t0 = time()
-                pointcloud = pointcloud.to(device)  # b*1024*3
-                transformed_point_cloud = transformed_point_cloud.to(device)
-                pointcloud = pointcloud.permute(0, 2, 1)  # b*3*1024
-                transformed_point_cloud = transformed_point_cloud.permute(0, 2, 1)
-                batch_size = pointcloud.size()[0]
-                fe1_nograd, fe2_nograd, fe1_final, fe2_final, M = model(pointcloud, transformed_point_cloud)
-                final_loss, FB_loss, M_loss1, M_loss2 = loss_function(fe1_nograd, fe2_nograd, fe1_final, fe2_final, M)
-                # test_loss_list = np.vstack((test_loss_list, np.array([final_loss.item(), FB_loss.item(), M_loss1.item(),M_loss2.item()])))
-                count += 1
-                # total_count_test += batch_size
-                # test_count_list.append(total_count_test)
-                batch_time = time() - t0
-                epoch_time += batch_time
-                test_epoch_data["Final_loss"] += final_loss.item()
-                test_epoch_data["FB_loss"] += FB_loss.item()
-                test_epoch_data["M_loss1"] += M_loss1.item()
-                test_epoch_data["M_loss2"] += M_loss2.item()
-        test_data["Final_loss"].append(test_epoch_data["Final_loss"]/count)
-        test_data["FB_loss"].append(test_epoch_data["FB_loss"]/count)
-        test_data["M_loss1"].append(test_epoch_data["M_loss1"]/count)
-        test_data["M_loss2"].append(test_epoch_data["M_loss2"]/count)
-        outstr = 'Train epoch %d: final_loss: %.6f, FB_loss: %.6f, M_loss1: %.6f, M_loss2: %.6f, epoch training time: %.3f' \
-                    % (epoch, test_data["Final_loss"][-1], test_data["FB_loss"][-1], test_data["M_loss1"][-1], test_data["M_loss2"][-1], epoch_time)     
+        t0 = time()
+        test_epoch_data = test_one_epoch(model, test_loader, loss_function, device, loss_names, args)
+        epoch_time = time() - t0
+        logger.log('test', epoch, **test_epoch_data)
+        outstr = 'Test epoch %d: final_loss: %.6f, FB_loss: %.6f, M_loss1: %.6f, M_loss2: %.6f, epoch testing time: %.3f' \
+                    % (epoch, test_epoch_data["Final_loss"], test_epoch_data["FB_loss"], test_epoch_data["M_loss1"], test_epoch_data["M_loss2"], epoch_time)     
         total_time += epoch_time
         print(outstr)  
         print("############################################################")
-        # print('Finish epoch %d, training loss is: %.6f, testing loss is: %.6f, total time is: %.3f'\
-        #         %(epoch, train_loss_list[-1, 0], test_loss_list[-1, 0], total_time))
-        
-        save_loss([train_data["Final_loss"], train_data["FB_loss"], train_data["M_loss1"], train_data["M_loss2"]],
-                  [test_data["Final_loss"], test_data["FB_loss"], test_data["M_loss1"], test_data["M_loss2"]],
-                  epoch+1
-                  )
-        print("Save loss figure.")
-        print("############################################################")
         print("\n\n\n")
-        
-
-def save_loss(train_list, test_list, epoch):
-    h = len(train_list)
-    fig = plt.figure(figsize=(20, 20))
-    loss_name = ["Final_loss", "FB_loss", "M_loss1", "M_loss2"]
-    for i in range(h):
-        ax = fig.add_subplot(h,2, 2 * i + 1)
-        ax.plot(range(epoch), train_list[i])
-        ax.set_title(loss_name[i] + ' for training')
-        ax.set_xlabel("epoch")
-        ax.set_ylabel("loss")
-    for i in range(h):
-        ax = fig.add_subplot(h,2, 2 * i + 2)
-        ax.plot(range(epoch), test_list[i])
-        ax.set_title(loss_name[i] + ' for testing')   
-        ax.set_xlabel("epoch")     
-        ax.set_ylabel("loss")
-    # Save the full figure...
-    if os.path.exists('Loss.jpg'):
-        os.remove('Loss.jpg')
-    fig.savefig('Loss.jpg')
-    plt.close()
+    if logger is not None:
+        logger.close()
+    cleanup()
 
-def test(args):  #not written
-    # test_loader = DataLoader(ModelNet40(partition='test', num_points=args.num_points, debug=args.debug),
-    #                          batch_size=args.test_batch_size, shuffle=True, drop_last=False)
 
-    # device = torch.device("cuda" if args.cuda else "cpu")
-    device = torch.device("cpu")
-
-    #Try to load models
-    model = DGCNN(args).to(device)
-
-    print(summary(model, (24, 3, 1024) ) )
-
-    exit(1)
-
-    model = nn.DataParallel(model)
-    # ximin
-    checkpoint = torch.load(args.model_path, map_location=device )
-    # model.module.load_state_dict(checkpoint['DGCNN_state_dict'])
-    # model.load_state_dict(torch.load(args.model_path))
-
-    print(checkpoint['state_dict'].keys() )
-
-    model = model.eval()
-    test_acc = 0.0
-    count = 0.0
-    test_true = []
-    test_pred = []
-    for data, label in test_loader:
-
-        data, label = data.to(device), label.to(device).squeeze()
-        data = data.permute(0, 2, 1)
-        batch_size = data.size()[0]
-        logits = model(data)
-        preds = logits.max(dim=1)[1]
-        test_true.append(label.cpu().numpy())
-        test_pred.append(preds.detach().cpu().numpy())
-    test_true = np.concatenate(test_true)
-    test_pred = np.concatenate(test_pred)
+def test_one_epoch(model, test_loader, loss_function, device, loss_names, args):
+    model.eval()
+    test_acc = MetricAccumulator(distributed=args.distributed)
+    with torch.no_grad():
+        for pointcloud, transformed_point_cloud in test_loader:
+            pointcloud = pointcloud.to(device, non_blocking=True)  # b*1024*3
+            transformed_point_cloud = transformed_point_cloud.to(device, non_blocking=True)
+            pointcloud = pointcloud.permute(0, 2, 1)  # b*3*1024
+            transformed_point_cloud = transformed_point_cloud.permute(0, 2, 1)
+            fe1_nograd, fe2_nograd, fe1_final, fe2_final, M = model(pointcloud, transformed_point_cloud)
+            final_loss, FB_loss, M_loss1, M_loss2 = loss_function(fe1_nograd, fe2_nograd, fe1_final, fe2_final, M)
+            test_acc.update(**dict(zip(loss_names, (final_loss, FB_loss, M_loss1, M_loss2))))
+    return test_acc.sync()
 
-    # ximin
-    print(test_true.shape)
-    print(test_pred.shape)
 
-    test_acc = metrics.accuracy_score(test_true, test_pred)
-    avg_per_class_acc = metrics.balanced_accuracy_score(test_true, test_pred)
-    outstr = 'Test :: test acc: %.6f, test avg acc: %.6f'%(test_acc, avg_per_class_acc)
+def test(args):
+    device = torch.device("cuda" if args.cuda else "cpu")
+    stats = evaluate_checkpoint(args.model_path, args, device=device)
+    print('Test :: ' + ', '.join('%s: %.6f' % (key, value) for key, value in stats.items()
+                                 if isinstance(value, float)))
 
 
 if __name__ == "__main__":
@@ -313,6 +240,20 @@ if __name__ == "__main__":
                         help='Pretrained model path')
     parser.add_argument('--debug', type=bool, default=False,
                         help='Debug mode')
+    parser.add_argument('--log_interval', type=int, default=50, metavar='N',
+                        help='Log per-step losses every N steps')
+    parser.add_argument('--synthetic', type=int, default=0, metavar='N',
+                        help='Train on N random pairs instead of the HDF5 files (0: off)')
+    parser.add_argument('--profile_stages', action='store_true', default=False,
+                        help='Time the named forward stages and print/export a table per training epoch')
+    add_loader_args(parser)
+    add_sampling_args(parser)
+    add_eval_args(parser)
+    add_memory_args(parser)
+    parser.add_argument('--distributed', action='store_true', default=False,
+                        help='DistributedDataParallel training, launch with torchrun')
+    parser.add_argument('--dist_backend', type=str, default='', metavar='N',
+                        help='Process group backend, default nccl on GPU and gloo on CPU')
     parser.add_argument('--similarity_metric', type=str, default='exponential', metavar='N',
                         help='how to measure similarity: exponential or reciprocal')
     args = parser.parse_args()
@@ -0,0 +1,283 @@
+"""
+Memory footprint of an FM3D / RegModel training step, and the automatic batch
+size that fits a budget.
+
+The analytical model counts the float32 activations each stage keeps for the
+backward pass (saved) and the largest temporary buffer (transient), plus the
+weights, gradients and Adam state. The n*n terms (knn distances, the FM3D
+similarity/M/MM^T chain, attention maps, SVDHead scores) make it quadratic
+in num_points. On CUDA the per-sample cost is measured instead, from the
+allocator peak of real steps at batch 1 and 2, and compare_stages() checks
+each stage against the profiling.stage ranges of a real forward pass. Stage
+keys are '<profiling stage>/<detail>'.
+
+    python memory.py --model fm3d --batch_size 24 --num_points 2048 --memory_budget 16
+
+main.py and registration/main.py take --memory_budget (GB): the requested
+--batch_size is kept as the effective batch and split into micro-batches with
+gradient accumulation when it does not fit, or with --largest_batch the batch
+is raised (or lowered) to the most samples that fit.
+"""
+import argparse
+from collections import OrderedDict
+from contextlib import nullcontext
+import torch
+import profiling
+
+FLOAT = 4
+INDEX = 8
+GB = 2 ** 30
+
+
+def _dgcnn(b, n, k, emb_dims, cloud):
+    saved, transient = OrderedDict(), OrderedDict()
+    channels = [(3, 64), (64, 64), (64, 128), (128, 256)]
+    for i, (c_in, c_out) in enumerate(channels):
+        # inner product and distance matrix of knn, freed after topk
+        transient['dgcnn.knn/%s%d' % (cloud, i + 1)] = 2 * b * n * n * FLOAT
+        # gathered neighbours, centred copy and repeated centre before the concat
+        transient['dgcnn.edge_gather/%s%d' % (cloud, i + 1)] = 2 * b * n * k * c_in * FLOAT
+        saved['dgcnn.edge_gather/%s%d' % (cloud, i + 1)] = 2 * b * n * k * c_in * FLOAT
+        # conv, bn and LeakyReLU outputs, then the max and its indices
+        saved['dgcnn.conv/%s%d' % (cloud, i + 1)] = 3 * b * c_out * n * k * FLOAT + b * c_out * n * (FLOAT + INDEX)
+    saved['dgcnn.conv/%s5' % cloud] = b * 512 * n * FLOAT + 3 * b * emb_dims * n * FLOAT
+    return saved, transient
+
+
+def fm3d_stages(batch_size, num_points, k=20, emb_dims=1024):
+    """(saved, transient) bytes per stage of FM3D.forward + contrastive_loss."""
+    b, n, d = batch_size, num_points, emb_dims
+    saved, transient = OrderedDict(), OrderedDict()
+    for cloud in ('src', 'tgt'):
+        s, t = _dgcnn(b, n, k, d, cloud)
+        saved.update(s)
+        transient.update(t)
+    # pairwise distance, its normalisation (mean/std/output) and exp
+    saved['fm3d.similarity'] = 6 * b * n * n * FLOAT
+    # transposed copy, norm, *8, softmax, transposed back
+    saved['fm3d.desmooth'] = 7 * b * n * n * FLOAT
+    saved['fm3d.permute'] = b * n * n * FLOAT + 2 * b * d * n * FLOAT
+    saved['fm3d.predictor'] = 2 * 3 * b * (d // 2 + d) * n * FLOAT
+    # MM^T, the repeated identity and their difference
+    saved['loss.mmt'] = 3 * b * n * n * FLOAT
+    return saved, transient
+
+
+def reg_stages(batch_size, num_points, k=20, emb_dims=512, ff_dims=1024, n_heads=4, n_blocks=1):
+    """(saved, transient) bytes per stage of RegModel.forward and its loss."""
+    b, n, d = batch_size, num_points, emb_dims
+    saved, transient = OrderedDict(), OrderedDict()
+    for cloud in ('src', 'tgt'):
+        s, t = _dgcnn(b, n, k, d, cloud)
+        saved.update(s)
+        transient.update(t)
+    # the transformer runs twice (src->tgt, tgt->src); each run has one self-attention per
+    # encoder block and a self- plus a cross-attention per decoder block
+    attentions = 2 * 3 * n_blocks
+    saved['reg.attention/maps'] = attentions * 2 * b * n_heads * n * n * FLOAT
+    saved['reg.attention/linear'] = attentions * 5 * b * n * d * FLOAT
+    saved['reg.attention/feed_forward'] = 2 * 2 * n_blocks * (2 * b * n * ff_dims + 3 * b * n * d) * FLOAT
+    saved['reg.scores'] = 2 * b * n * n * FLOAT
+    return saved, transient
+
+
+def parameter_bytes(model):
+    """Weights, gradients and the two Adam moments."""
+    return 4 * sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+
+
+def build_model(args, model_name):
+    if model_name == 'fm3d':
+        from model import FM3D
+        return FM3D(args)
+    from RegModel import RegModel
+    return RegModel(args)
+
+
+def estimate(args, model_name, batch_size, model=None):
+    """Analytical bytes of one training step: per-stage activations, parameters and the total."""
+    if model_name == 'fm3d':
+        saved, transient = fm3d_stages(batch_size, args.num_points, args.k, args.emb_dims)
+    else:
+        saved, transient = reg_stages(batch_size, args.num_points, args.k, args.emb_dims, args.ff_dims,
+                                      args.n_heads, args.n_blocks)
+    parameters = parameter_bytes(model if model is not None else build_model(args, model_name))
+    total = parameters + sum(saved.values()) + max(transient.values())
+    return {'saved': saved, 'transient': transient, 'parameters': parameters, 'total': total}
+
+
+def by_stage(values, reduce=sum):
+    """Fold '<stage>/<detail>' keys into one value per profiling stage."""
+    grouped = OrderedDict()
+    for key, value in values.items():
+        grouped.setdefault(key.split('/')[0], []).append(value)
+    return OrderedDict((name, reduce(group)) for name, group in grouped.items())
+
+
+def _training_step(args, model_name, batch_size, device):
+    """One forward + backward on random clouds, returns the model."""
+    model = build_model(args, model_name).to(device).train()
+    src = torch.randn(batch_size, 3, args.num_points, device=device)
+    tgt = torch.randn(batch_size, 3, args.num_points, device=device)
+    if model_name == 'fm3d':
+        from model import contrastive_loss
+        loss = contrastive_loss(args)(*model(src, tgt))[0]
+    else:
+        rotation_ab, translation_ab = model(src, tgt)[:2]
+        loss = rotation_ab.pow(2).mean() + translation_ab.pow(2).mean()
+    loss.backward()
+    return model
+
+
+def measure(args, model_name, batch_size, device):
+    """Allocator peak of one forward + backward on CUDA, plus the Adam moments the step would add."""
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    model = _training_step(args, model_name, batch_size, device)
+    torch.cuda.synchronize(device)
+    peak = torch.cuda.max_memory_allocated(device) + parameter_bytes(model) // 2
+    del model
+    torch.cuda.empty_cache()
+    return peak
+
+
+def measure_stages(args, model_name, batch_size, device):
+    """
+    {stage: (retained, peak)} bytes of one training step on CUDA from the
+    profiling.stage ranges: memory still allocated after the stage (summed
+    over its calls) and the largest peak above the memory at entry.
+    """
+    profiler = profiling.enable()
+    try:
+        _training_step(args, model_name, batch_size, device)
+    finally:
+        profiling.disable()
+    torch.cuda.empty_cache()
+    return OrderedDict((name, (memory, peak)) for name, (calls, seconds, memory, peak) in profiler.totals.items())
+
+
+def compare_stages(args, model_name, batch_size, device):
+    """
+    Rows of analytical vs measured MB per profiling stage: the saved
+    activations against the retained memory, and the largest transient
+    buffer of one call against the measured peak (which also holds that
+    call's outputs).
+    """
+    report = estimate(args, model_name, batch_size)
+    saved = by_stage(report['saved'])
+    transient = by_stage(report['transient'], max)
+    measured = measure_stages(args, model_name, batch_size, device)
+    rows = []
+    for name in OrderedDict.fromkeys(list(saved) + list(transient)):
+        retained, peak = measured.get(name, (0, 0))
+        rows.append({'stage': name, 'saved_mb': saved.get(name, 0) / 2 ** 20, 'retained_mb': retained / 2 ** 20,
+                     'transient_mb': transient.get(name, 0) / 2 ** 20, 'peak_mb': peak / 2 ** 20})
+    return rows
+
+
+def per_sample_cost(args, model_name, device):
+    """(fixed, per_sample) bytes, measured on CUDA and analytical elsewhere."""
+    if torch.device(device).type == 'cuda':
+        one, two = measure(args, model_name, 1, device), measure(args, model_name, 2, device)
+    else:
+        model = build_model(args, model_name)
+        one = estimate(args, model_name, 1, model)['total']
+        two = estimate(args, model_name, 2, model)['total']
+    per_sample = max(two - one, 1)
+    return one - per_sample, per_sample
+
+
+def largest_batch(budget_bytes, fixed, per_sample):
+    """Most samples per step that fit budget_bytes."""
+    largest = int((budget_bytes - fixed) // per_sample)
+    if largest < 1:
+        raise RuntimeError('a single sample needs %.2f GB, more than the %.2f GB budget'
+                           % ((fixed + per_sample) / GB, budget_bytes / GB))
+    return largest
+
+
+def plan_batch(target_batch, budget_bytes, fixed, per_sample):
+    """
+    (micro_batch, accumulation_steps) with micro_batch * accumulation_steps ==
+    target_batch: the whole batch when it fits, otherwise the largest divisor
+    of target_batch that fits. A target with no large divisor (e.g. a prime)
+    can need many more steps than the memory alone would.
+    """
+    largest = largest_batch(budget_bytes, fixed, per_sample)
+    micro_batch = max(d for d in range(1, min(largest, target_batch) + 1) if target_batch % d == 0)
+    return micro_batch, target_batch // micro_batch
+
+
+def auto_batch(args, model_name, device):
+    """
+    Set args.batch_size and args.accumulation_steps for args.memory_budget GB.
+    With args.largest_batch the batch becomes the most samples that fit (up
+    to args.max_batch_size) without accumulation; otherwise the requested
+    args.batch_size stays the effective batch, split into micro-batches.
+    """
+    fixed, per_sample = per_sample_cost(args, model_name, device)
+    budget = args.memory_budget * GB * args.memory_headroom
+    largest = largest_batch(budget, fixed, per_sample)
+    if args.largest_batch:
+        micro_batch, accumulation_steps = min(largest, args.max_batch_size), 1
+    else:
+        micro_batch, accumulation_steps = plan_batch(args.batch_size, budget, fixed, per_sample)
+    print('Auto batch: %.1f MB fixed + %.1f MB per sample, budget %.2f GB -> batch %d x %d accumulation steps'
+          % (fixed / 2 ** 20, per_sample / 2 ** 20, budget / GB, micro_batch, accumulation_steps))
+    if not args.largest_batch and micro_batch < largest and accumulation_steps > 1:
+        print('Auto batch: up to %d samples fit, %d is the largest divisor of --batch_size %d'
+              % (largest, micro_batch, args.batch_size))
+    args.batch_size, args.accumulation_steps = micro_batch, accumulation_steps
+    return micro_batch, accumulation_steps
+
+
+def accumulation_context(model, args, sync):
+    """DDP's no_sync() for the micro-batches that do not step the optimizer."""
+    if args.distributed and not sync:
+        return model.no_sync()
+    return nullcontext()
+
+
+def add_memory_args(parser):
+    parser.add_argument('--memory_budget', type=float, default=0, metavar='GB',
+                        help='Pick the micro-batch and accumulation steps for this much device memory (0: off)')
+    parser.add_argument('--memory_headroom', type=float, default=0.9,
+                        help='Share of --memory_budget the plan may use')
+    parser.add_argument('--largest_batch', action='store_true', default=False,
+                        help='With --memory_budget, train on the largest batch that fits instead of --batch_size')
+    parser.add_argument('--max_batch_size', type=int, default=256, metavar='N',
+                        help='Upper bound of the --largest_batch batch size')
+    parser.add_argument('--accumulation_steps', type=int, default=1, metavar='N',
+                        help='Micro-batches per optimizer step (set by --memory_budget)')
+    return parser
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'registration'))
+    from export import add_model_args
+    parser = argparse.ArgumentParser(description='Training memory estimate and batch plan')
+    add_model_args(parser)
+    add_memory_args(parser)
+    parser.add_argument('--batch_size', type=int, default=24)
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--alpha1', type=float, default=0.1)
+    parser.add_argument('--alpha2', type=float, default=0.1)
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+    report = estimate(args, args.model, args.batch_size)
+    for kind in ('saved', 'transient'):
+        for name, value in report[kind].items():
+            print('%-10s %-28s %10.1f MB' % (kind, name, value / 2 ** 20))
+    print('parameters, gradients and Adam state: %.1f MB' % (report['parameters'] / 2 ** 20))
+    print('estimated total at batch %d x %d points: %.2f GB' % (args.batch_size, args.num_points, report['total'] / GB))
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    if args.cuda:
+        print()
+        print('%-20s %10s %12s %13s %10s' % ('stage', 'saved_mb', 'retained_mb', 'transient_mb', 'peak_mb'))
+        for row in compare_stages(args, args.model, args.batch_size, device):
+            print('%(stage)-20s %(saved_mb)10.1f %(retained_mb)12.1f %(transient_mb)13.1f %(peak_mb)10.1f' % row)
+    if args.memory_budget > 0:
+        auto_batch(args, args.model, device)
@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import torch
+import torch.distributed as dist
+
+
+class MetricLogger:
+    """
+    Append-only JSONL sink for training metrics. Every call to log() writes one
+    record, so nothing is redrawn or rewritten while training; plots are produced
+    offline with plot_metrics.py.
+    """
+
+    def __init__(self, path, writer=None, flush_every=100):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.path = path
+        self.writer = writer  # optional tensorboard SummaryWriter
+        self.flush_every = flush_every
+        self.pending = 0
+        self.f = open(path, 'a')
+
+    def log(self, split, epoch, step=None, **values):
+        record = {'time': time.time(), 'split': split, 'epoch': epoch}
+        if step is not None:
+            record['step'] = step
+        for key, value in values.items():
+            record[key] = float(value)
+        self.f.write(json.dumps(record) + '\n')
+        if self.writer is not None:
+            if step is None:
+                for key, value in values.items():
+                    self.writer.add_scalar('%s/%s' % (split, key), float(value), epoch)
+            else:
+                for key, value in values.items():
+                    self.writer.add_scalar('%s_step/%s' % (split, key), float(value), step)
+        self.pending += 1
+        if step is None or self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.f.flush()
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+def read_metrics(path, split=None, per_step=False):
+    """Yield records from a MetricLogger file, epoch records by default."""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if split is not None and record['split'] != split:
+                continue
+            if ('step' in record) != per_step:
+                continue
+            yield record
+
+
+class MetricAccumulator:
+    """
+    Running sums of scalar loss tensors kept on their own device. update() never
+    copies to the host, sync() moves every sum in one transfer and returns the
+    weighted means as python floats. With distributed=True the sums are reduced
+    across all processes of the default process group first.
+    """
+
+    def __init__(self, distributed=False):
+        self.sums = {}
+        self.weight = 0
+        self.distributed = distributed
+
+    def update(self, weight=1, **values):
+        for key, value in values.items():
+            if torch.is_tensor(value):
+                value = value.detach().float() * weight
+            else:
+                value = float(value) * weight
+            if key in self.sums:
+                self.sums[key] = self.sums[key] + value
+            else:
+                self.sums[key] = value
+        self.weight += weight
+
+    def sync(self):
+        keys = list(self.sums.keys())
+        device = torch.device('cpu')
+        for value in self.sums.values():
+            if torch.is_tensor(value):
+                device = value.device
+                break
+        packed = [torch.as_tensor(self.sums[key], dtype=torch.float32, device=device).reshape(()) for key in keys]
+        packed.append(torch.tensor(float(self.weight), device=device))
+        packed = torch.stack(packed)
+        if self.distributed and dist.is_available() and dist.is_initialized():
+            dist.all_reduce(packed)
+        host = packed.cpu().tolist()
+        weight = host[-1]
+        if weight == 0:
+            return {}
+        return {key: value / weight for key, value in zip(keys, host[:-1])}
+
+    def reset(self):
+        self.sums = {}
+        self.weight = 0
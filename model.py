@@ -6,6 +6,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from profiling import stage
 #import pytorch_lightning as pl
 
 def knn(x, k):
@@ -22,18 +23,19 @@ def get_graph_feature(x, k=20, idx=None):
     num_points = x.size(2)
     x = x.view(batch_size, -1, num_points)
     if idx is None:
-        idx = knn(x, k=k)   # (batch_size, num_points, k)
-    # ximin
-    device = torch.device('cuda')
-    # device = torch.device("cpu")
+        with stage('dgcnn.knn'):
+            idx = knn(x, k=k)   # (batch_size, num_points, k)
+    with stage('dgcnn.edge_gather'):
+        return _gather_edges(x, idx, k)
 
-    idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1)*num_points
+
+def _gather_edges(x, idx, k):
+    batch_size, num_dims, num_points = x.size()
+    idx_base = torch.arange(0, batch_size, device=x.device).view(-1, 1, 1)*num_points
 
     idx = idx + idx_base
 
     idx = idx.view(-1)
- 
-    _, num_dims, _ = x.size()
 
     x = x.transpose(2, 1).contiguous()   # (batch_size, num_points, num_dims)  -> (batch_size*num_points, num_dims) #   batch_size * num_points * k + range(0, batch_size*num_points)
     feature = x.view(batch_size*num_points, -1)[idx, :]
@@ -83,24 +85,29 @@ class DGCNN(nn.Module):
     def forward(self, x):
         batch_size = x.size(0)
         x = get_graph_feature(x, k=self.k)
-        x = self.conv1(x)
-        x1 = x.max(dim=-1, keepdim=False)[0]
+        with stage('dgcnn.conv'):
+            x = self.conv1(x)
+            x1 = x.max(dim=-1, keepdim=False)[0]
 
         x = get_graph_feature(x1, k=self.k)
-        x = self.conv2(x)
-        x2 = x.max(dim=-1, keepdim=False)[0]
+        with stage('dgcnn.conv'):
+            x = self.conv2(x)
+            x2 = x.max(dim=-1, keepdim=False)[0]
 
         x = get_graph_feature(x2, k=self.k)
-        x = self.conv3(x)
-        x3 = x.max(dim=-1, keepdim=False)[0]
+        with stage('dgcnn.conv'):
+            x = self.conv3(x)
+            x3 = x.max(dim=-1, keepdim=False)[0]
 
         x = get_graph_feature(x3, k=self.k)
-        x = self.conv4(x)
-        x4 = x.max(dim=-1, keepdim=False)[0]
+        with stage('dgcnn.conv'):
+            x = self.conv4(x)
+            x4 = x.max(dim=-1, keepdim=False)[0]
 
         x = torch.cat((x1, x2, x3, x4), dim=1)
 
-        x = self.conv5(x)   #batch*1024*1024
+        with stage('dgcnn.conv'):
+            x = self.conv5(x)   #batch*1024*1024
         '''
         x1 = F.adaptive_max_pool1d(x, 1).view(batch_size, -1)
         x2 = F.adaptive_avg_pool1d(x, 1).view(batch_size, -1)
@@ -143,7 +150,11 @@ class Modified_softmax(nn.Module):
         self.norm = norm(axis = axis)
     def forward(self, x):
         x = self.norm(x)
-        x = Gradient.apply(x)
+        if not torch.jit.is_scripting() and torch.is_grad_enabled():
+            x = Gradient.apply(x)
+        else:
+            # Gradient only changes the backward pass, plain ops keep the graph traceable/compilable
+            x = x * 8
         x = F.softmax(x, dim=self.axis)
         return x
 
@@ -172,42 +183,62 @@ class FM3D(nn.Module):
                                         nn.Conv1d(args.emb_dims//2, args.emb_dims, kernel_size=1, bias=False),
                                         self.bn2,
                                         nn.LeakyReLU(negative_slope=0.2))
+    @staticmethod
+    def _pairwise_distance(a, b):
+        # squared distances between the columns of a (b*d*n1) and b (b*d*n2), b*n1*n2
+        x, y = a.float().permute(0, 2, 1), b.float().permute(0, 2, 1)
+        xx = torch.pow(x, 2).sum(2)
+        yy = torch.pow(y, 2).sum(2)
+        zz = torch.bmm(x, y.transpose(2, 1))   #bmm: multiple (b,w,h) with (b,h,w)
+        return xx.unsqueeze(2) + yy.unsqueeze(1) - 2 * zz
+
     def _KFNN(self, x, y, k=10):
-        def batched_pairwise_dist(a, b):
-            x, y = a.float(), b.float()
-            bs, num_points_x, points_dim = x.size()
-            bs, num_points_y, points_dim = y.size()
-            assert(num_points_x==1024 or num_points_x==256)
-
-            xx = torch.pow(x, 2).sum(2)
-            yy = torch.pow(y, 2).sum(2)
-            zz = torch.bmm(x, y.transpose(2, 1))   #bmm: multiple (b,w,h) with (b,h,w)
-            rx = xx.unsqueeze(1).expand(bs, num_points_y, num_points_x)
-            ry = yy.unsqueeze(1).expand(bs, num_points_x, num_points_y)
-            P = rx.transpose(2, 1) + ry - 2 * zz
-            return P
-
-        pairwise_distance = batched_pairwise_dist(x.permute(0,2,1), y.permute(0,2,1))
+        pairwise_distance = self._pairwise_distance(x, y)
         similarity=-pairwise_distance
         idx = similarity.topk(k=k, dim=-1)[1]
         return pairwise_distance, idx
 
+    def match(self, fe1, fe2):
+        # soft correspondence matrix, M[b, i, j] is the probability that point j of
+        # the second cloud matches point i of the first (normalised over i)
+        with stage('fm3d.similarity'):
+            pairwise_distance = self._pairwise_distance(fe1, fe2)
+            if self.similarity_metric =="reciprocal":
+                similarity = 1 / (pairwise_distance + 1e-6) #b*n*n
+            elif self.similarity_metric =="exponential":
+                pairwise_distance = self.normalization(pairwise_distance)
+                similarity = torch.exp(-pairwise_distance)
+        with stage('fm3d.desmooth'):
+            M = self.DeSmooth(similarity.transpose(1, 2).contiguous()).transpose(1, 2).contiguous()  #b*n*n
+        return M
+
+    def embed(self, pointcloud, cache=None):
+        """DGCNN features b*d*n, reused from an EmbeddingCache (eval mode only) when one is given."""
+        if cache is None:
+            return self.DGCNN(pointcloud)
+        return cache.embed(pointcloud, self.DGCNN, tag='fm3d')
+
+    def correspondence(self, pointcloud, transformed_pointcloud, cache=None):
+        """M only, skips the predictor head that is needed for the loss alone."""
+        return self.match(self.embed(pointcloud, cache), self.embed(transformed_pointcloud, cache))
+
     def forward(self,pointcloud,transformed_pointcloud):
-        fe1 = self.DGCNN(pointcloud)
-        fe2 = self.DGCNN(transformed_pointcloud)   #b*d*n
-        pairwise_distance,_ = self._KFNN(fe1,fe2)
-        if self.similarity_metric =="reciprocal":
-            similarity = 1 / (pairwise_distance + 1e-6) #b*n*n
-        elif self.similarity_metric =="exponential":
-            pairwise_distance = self.normalization(pairwise_distance)
-            similarity = torch.exp(-pairwise_distance)
-        M = self.DeSmooth(similarity.transpose(1, 2).contiguous()).transpose(1, 2).contiguous()  #b*n*n
-        M_t = M.transpose(2, 1).contiguous()  #which one is which one?
-        fe1_permuted = torch.bmm(fe1, M)
-        fe2_permuted = torch.bmm(fe2, M_t)  #batch*num_points*feature_dimension
-
-        fe1_final = self.predictor(fe1_permuted)
-        fe2_final = self.predictor(fe2_permuted) #b*d*n
+        with stage('fm3d.encoder'):
+            fe1 = self.DGCNN(pointcloud)
+            fe2 = self.DGCNN(transformed_pointcloud)   #b*d*n
+        return self.forward_embeddings(fe1, fe2)
+
+    def forward_embeddings(self, fe1, fe2):
+        # forward from precomputed DGCNN features, see embed()
+        M = self.match(fe1, fe2)
+        with stage('fm3d.permute'):
+            M_t = M.transpose(2, 1).contiguous()  #which one is which one?
+            fe1_permuted = torch.bmm(fe1, M)
+            fe2_permuted = torch.bmm(fe2, M_t)  #batch*num_points*feature_dimension
+
+        with stage('fm3d.predictor'):
+            fe1_final = self.predictor(fe1_permuted)
+            fe2_final = self.predictor(fe2_permuted) #b*d*n
 
         fe1_nograd = fe1.detach()
         fe2_nograd = fe2.detach()
@@ -228,16 +259,15 @@ class contrastive_loss(nn.Module):
 
     def forward(self, fe1_nograd, fe2_nograd, fe1_final, fe2_final, M):
         batch_size = fe1_final.shape[0]
-        bmean_loss_F1 = torch.mean(self._batch_frobenius_norm(fe1_nograd, fe2_final))
-        bmean_loss_F2 = torch.mean(self._batch_frobenius_norm(fe2_nograd, fe1_final))
-        # ximin
-        I_N1 = torch.eye(n=M.shape[2]).cuda()
-        # I_N1 = torch.eye(n=M.shape[2])
-        
-        I_N1 = I_N1.unsqueeze(0).repeat(batch_size, 1, 1)
-        M_loss1 = torch.mean(
-            self._batch_frobenius_norm(torch.bmm(M, M.transpose(2, 1).contiguous()), I_N1.float()))
-        M_loss2 = torch.mean(torch.norm(M,dim=(1,2)))
+        with stage('loss.feature'):
+            bmean_loss_F1 = torch.mean(self._batch_frobenius_norm(fe1_nograd, fe2_final))
+            bmean_loss_F2 = torch.mean(self._batch_frobenius_norm(fe2_nograd, fe1_final))
+        with stage('loss.mmt'):
+            I_N1 = torch.eye(n=M.shape[2], device=M.device)
+            I_N1 = I_N1.unsqueeze(0).repeat(batch_size, 1, 1)
+            M_loss1 = torch.mean(
+                self._batch_frobenius_norm(torch.bmm(M, M.transpose(2, 1).contiguous()), I_N1.float()))
+            M_loss2 = torch.mean(torch.norm(M,dim=(1,2)))
         FB_loss = (bmean_loss_F1+bmean_loss_F2)/2
         final_loss = FB_loss + self.alpha1*M_loss1 +self.alpha2*M_loss2
 
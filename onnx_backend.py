@@ -0,0 +1,124 @@
+"""
+ONNX export of the shared DGCNN encoder and an onnxruntime CPU backend for it.
+
+    python onnx_backend.py --model_path checkpoints/exp/models/50.pth --out exports/dgcnn.onnx --check
+
+The exported graph has dynamic batch and point dimensions; knn's topk and the
+neighbour gather in get_graph_feature become TopK/Gather nodes. ORTEncoder
+is a drop-in replacement for the torch module, e.g. fm3d.DGCNN = ORTEncoder(path)
+or reg_model.emb_nn = ORTEncoder(path) for CPU-only inference.
+onnxruntime is only needed for ORTEncoder, not for the export.
+"""
+import os
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from model import DGCNN
+from fuse import fuse_for_inference
+
+
+def load_dgcnn(args, device='cpu'):
+    """
+    DGCNN with weights from an FM3D checkpoint (DGCNN_state_dict) or a RegModel
+    one (emb_nn.*), BatchNorm folded into the convolutions.
+    """
+    dgcnn = DGCNN(args).to(device)
+    if args.model_path:
+        checkpoint = torch.load(args.model_path, map_location=device)
+        if 'DGCNN_state_dict' in checkpoint:
+            state_dict = checkpoint['DGCNN_state_dict']
+        else:
+            state_dict = {key[len('emb_nn.'):]: value for key, value in checkpoint.items()
+                          if key.startswith('emb_nn.')}
+        dgcnn.load_state_dict(state_dict)
+    return fuse_for_inference(dgcnn)
+
+
+def export_dgcnn(dgcnn, path, num_points=1024, opset=17):
+    """Export to ONNX with dynamic batch and point count."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    points = torch.randn(2, 3, num_points, device=next(dgcnn.parameters()).device)
+    with torch.no_grad():
+        torch.onnx.export(dgcnn.eval(), (points,), path,
+                          input_names=['points'], output_names=['features'],
+                          dynamic_axes={'points': {0: 'batch', 2: 'num_points'},
+                                        'features': {0: 'batch', 2: 'num_points'}},
+                          opset_version=opset, do_constant_folding=True)
+    return path
+
+
+class ORTEncoder(nn.Module):
+    """
+    onnxruntime session behind the DGCNN interface: b*3*n tensor in, b*emb_dims*n
+    tensor out, on the device of the input. Inference only.
+    """
+
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+        super(ORTEncoder, self).__init__()
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError('ORTEncoder needs onnxruntime: pip install onnxruntime')
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+        if inter_op_threads > 0:
+            options.inter_op_num_threads = inter_op_threads
+        self.path = path
+        self.session = ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+    def forward(self, x):
+        points = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        features = self.session.run(['features'], {'points': points})[0]
+        return torch.from_numpy(features).to(x.device)
+
+
+def check_parity(dgcnn, encoder, batch_sizes=(1, 4), point_counts=(512, 1024), atol=1e-4):
+    """Max abs difference between torch and ORT outputs for several input shapes, and whether all are within atol."""
+    results = []
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            for num_points in point_counts:
+                points = torch.randn(batch_size, 3, num_points)
+                diff = (dgcnn(points) - encoder(points)).abs().max().item()
+                results.append({'batch_size': batch_size, 'num_points': num_points, 'max_abs_diff': diff})
+    return results, all(r['max_abs_diff'] <= atol for r in results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export DGCNN to ONNX')
+    parser.add_argument('--model_path', type=str, default='', metavar='N',
+                        help='FM3D or RegModel checkpoint holding the DGCNN weights')
+    parser.add_argument('--out', type=str, required=True,
+                        help='Output .onnx file')
+    parser.add_argument('--emb_dims', type=int, default=1024, metavar='N',
+                        help='Dimension of embeddings')
+    parser.add_argument('--k', type=int, default=20, metavar='N',
+                        help='Num of nearest neighbors to use')
+    parser.add_argument('--dropout', type=float, default=0.5,
+                        help='dropout rate')
+    parser.add_argument('--num_points', type=int, default=1024, metavar='N',
+                        help='Points per cloud of the example input')
+    parser.add_argument('--opset', type=int, default=17, metavar='N',
+                        help='ONNX opset version')
+    parser.add_argument('--check', action='store_true', default=False,
+                        help='Compare onnxruntime against torch for several batch sizes and point counts')
+    parser.add_argument('--atol', type=float, default=1e-4,
+                        help='Tolerance of --check')
+    args = parser.parse_args()
+
+    dgcnn = load_dgcnn(args)
+    export_dgcnn(dgcnn, args.out, args.num_points, args.opset)
+    print('DGCNN exported to %s' % args.out)
+    if args.check:
+        results, ok = check_parity(dgcnn, ORTEncoder(args.out), atol=args.atol)
+        for r in results:
+            print('batch %(batch_size)d, %(num_points)d points: max |torch - ort| %(max_abs_diff).3g' % r)
+        if not ok:
+            raise SystemExit('onnxruntime output differs from torch by more than %g' % args.atol)
+        print('parity OK (atol %g)' % args.atol)
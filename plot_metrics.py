@@ -0,0 +1,64 @@
+import argparse
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from metric_logger import read_metrics
+
+
+RESERVED_KEYS = ('time', 'split', 'epoch', 'step')
+
+
+def collect(path, split, per_step):
+    records = list(read_metrics(path, split=split, per_step=per_step))
+    # a resumed run appends the same epochs again, keep the latest value
+    x_key = 'step' if per_step else 'epoch'
+    latest = {}
+    for record in records:
+        latest[record[x_key]] = record
+    xs = sorted(latest.keys())
+    series = {}
+    for x in xs:
+        for key, value in latest[x].items():
+            if key in RESERVED_KEYS:
+                continue
+            series.setdefault(key, ([], []))
+            series[key][0].append(x)
+            series[key][1].append(value)
+    return series
+
+
+def plot(path, out, keys=None, per_step=False):
+    splits = ['train', 'test']
+    data = [collect(path, split, per_step) for split in splits]
+    if keys is None:
+        keys = []
+        for series in data:
+            for key in series:
+                if key not in keys:
+                    keys.append(key)
+    h = len(keys)
+    fig = plt.figure(figsize=(20, 5 * h))
+    for i, key in enumerate(keys):
+        for j, split in enumerate(splits):
+            ax = fig.add_subplot(h, 2, 2 * i + j + 1)
+            if key in data[j]:
+                ax.plot(*data[j][key])
+            ax.set_title(key + ' for ' + ('training' if split == 'train' else 'testing'))
+            ax.set_xlabel('step' if per_step else 'epoch')
+            ax.set_ylabel('loss')
+    fig.savefig(out)
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plot metrics written by MetricLogger')
+    parser.add_argument('--log', type=str, required=True,
+                        help='metrics.jsonl written during training')
+    parser.add_argument('--out', type=str, default='Loss.jpg',
+                        help='output figure')
+    parser.add_argument('--keys', type=str, nargs='*', default=None,
+                        help='metrics to plot, default all')
+    parser.add_argument('--per_step', action='store_true', default=False,
+                        help='plot per-step records instead of epoch averages')
+    args = parser.parse_args()
+    plot(args.log, args.out, args.keys, args.per_step)
@@ -0,0 +1,105 @@
+"""
+Rigid pose (R, t) with tgt ~ R src + t from the FM3D correspondence matrix M.
+
+For every point j of the second cloud the most probable point i of the first
+(argmax of M[:, :, j]) is a match with confidence M[i, j]; the k most
+confident matches are kept. weighted_procrustes fits them with a confidence
+weighted Kabsch solve. ransac draws thousands of minimal 3-match samples per
+pair, solves all of them in one batched SVD, scores every hypothesis against
+every match in one tensor op and refits on the inliers of the best one.
+"""
+import os
+import sys
+import numpy as np
+import torch
+from scipy.spatial.transform import Rotation
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'registration'))
+from util import kabsch
+
+METHODS = ('weighted', 'ransac')
+
+
+def top_matches(M, k=256):
+    """Source indices, target indices and confidences (b*k each) of the k most confident matches."""
+    confidences, src_idx = M.max(dim=1)
+    k = min(k, confidences.size(1))
+    confidences, tgt_idx = confidences.topk(k, dim=1)
+    return torch.gather(src_idx, 1, tgt_idx), tgt_idx, confidences
+
+
+def gather_matches(src, tgt, src_idx, tgt_idx):
+    """Matched points b*3*k of src and tgt (b*3*n)."""
+    src_points = torch.gather(src, 2, src_idx.unsqueeze(1).expand(-1, 3, -1))
+    tgt_points = torch.gather(tgt, 2, tgt_idx.unsqueeze(1).expand(-1, 3, -1))
+    return src_points, tgt_points
+
+
+def weighted_procrustes(src_points, tgt_points, weights):
+    """Kabsch solve over matches b*3*k weighted by their confidences (b*k)."""
+    return kabsch(src_points, tgt_points, weights)
+
+
+def ransac(src_points, tgt_points, weights, num_hypotheses=4096, inlier_threshold=0.05, chunk_size=1024,
+           generator=None):
+    """
+    Hypothesis-parallel RANSAC over matches b*3*k. Minimal samples are drawn in
+    proportion to the confidences; each chunk of hypotheses is solved with one
+    batched Kabsch and scored with one (b, h, k) residual tensor. The score is
+    the confidence mass of the inliers. Returns R (b*3*3), t (b*3) refitted on
+    the inliers of the best hypothesis, and the inlier mask (b*k).
+    """
+    batch_size = src_points.size(0)
+    best_score = torch.full((batch_size,), -1.0, device=src_points.device)
+    best_R = torch.eye(3, device=src_points.device).repeat(batch_size, 1, 1)
+    best_t = torch.zeros(batch_size, 3, device=src_points.device)
+    probabilities = weights.clamp(min=1e-12)
+    for start in range(0, num_hypotheses, chunk_size):
+        count = min(chunk_size, num_hypotheses - start)
+        samples = torch.multinomial(probabilities, count * 3, replacement=True, generator=generator)
+        samples = samples.view(batch_size, count, 3)
+        index = samples.view(batch_size, 1, count * 3).expand(-1, 3, -1)
+        minimal_src = torch.gather(src_points, 2, index).view(batch_size, 3, count, 3).permute(0, 2, 1, 3)
+        minimal_tgt = torch.gather(tgt_points, 2, index).view(batch_size, 3, count, 3).permute(0, 2, 1, 3)
+        R, t = kabsch(minimal_src.reshape(-1, 3, 3), minimal_tgt.reshape(-1, 3, 3))
+        R, t = R.view(batch_size, count, 3, 3), t.view(batch_size, count, 3, 1)
+        moved = torch.matmul(R, src_points.unsqueeze(1)) + t  # b*h*3*k
+        residuals = (moved - tgt_points.unsqueeze(1)).norm(dim=2)
+        scores = ((residuals < inlier_threshold).float() * weights.unsqueeze(1)).sum(dim=2)
+        score, best = scores.max(dim=1)
+        better = score > best_score
+        batch = torch.arange(batch_size, device=src_points.device)
+        best_score = torch.where(better, score, best_score)
+        best_R = torch.where(better.view(-1, 1, 1), R[batch, best], best_R)
+        best_t = torch.where(better.view(-1, 1), t[batch, best].squeeze(2), best_t)
+    moved = torch.matmul(best_R, src_points) + best_t.unsqueeze(2)
+    inliers = (moved - tgt_points).norm(dim=1) < inlier_threshold
+    # pairs whose best hypothesis has fewer than three inliers keep it as is
+    enough = inliers.sum(dim=1) >= 3
+    refit_R, refit_t = kabsch(src_points, tgt_points, weights * inliers.float())
+    R = torch.where(enough.view(-1, 1, 1), refit_R, best_R)
+    t = torch.where(enough.view(-1, 1), refit_t, best_t)
+    return R, t, inliers
+
+
+def estimate_pose(M, src, tgt, method='weighted', k=256, **kwargs):
+    """(R, t) from M (b*n1*n2) and the clouds src (b*3*n1), tgt (b*3*n2), with one of METHODS."""
+    src_idx, tgt_idx, confidences = top_matches(M, k)
+    src_points, tgt_points = gather_matches(src, tgt, src_idx, tgt_idx)
+    if method == 'weighted':
+        return weighted_procrustes(src_points, tgt_points, confidences)
+    if method == 'ransac':
+        return ransac(src_points, tgt_points, confidences, **kwargs)[:2]
+    raise ValueError('unknown pose method %s, expected one of %s' % (method, ', '.join(METHODS)))
+
+
+def stored_to_ab(rotation, translation):
+    """
+    Ground truth R_ab (B, 3, 3), t_ab (B, 3) with transformed = R_ab point + t_ab,
+    from the 'rotation' (euler_ba) and 'translation' (translation_ba) arrays that
+    generate_datasets.py stores.
+    """
+    euler_ab = -np.asarray(rotation)[:, ::-1]
+    R_ab = Rotation.from_euler('zyx', euler_ab).as_matrix()
+    t_ab = -np.einsum('bij,bj->bi', R_ab, np.asarray(translation))
+    return R_ab.astype('float32'), t_ab.astype('float32')
@@ -0,0 +1,113 @@
+"""
+Opt-in per-stage instrumentation of the forward passes.
+
+Model code marks its stages with `with stage('dgcnn.knn'):`. While no profiler
+is enabled stage() returns one shared null context, so the hooks cost a
+global lookup per stage. enable() installs a StageProfiler: every stage then
+becomes a torch.profiler.record_function range (visible in torch.profiler
+traces) and accumulates call count, wall-clock time and, on CUDA, the change
+in allocated memory and the peak above the memory at entry (this resets the
+allocator's peak counter, so do not read max_memory_allocated around a
+profiled region). Stages nest and a parent's time and peak include its children.
+Only forward passes are covered; backward time shows up in the step totals.
+
+    profiler = profiling.enable()
+    ...train an epoch...
+    print(profiler.format())
+    profiler.export('checkpoints/exp/stages.jsonl', epoch)
+    profiler.reset()
+"""
+import os
+import json
+import time
+import contextlib
+from collections import OrderedDict
+import torch
+
+_NULL = contextlib.nullcontext()
+_active = None
+
+
+def stage(name):
+    if _active is None:
+        return _NULL
+    return _active.range(name)
+
+
+class StageProfiler:
+    def __init__(self, sync=True):
+        # without synchronising, asynchronous CUDA kernels are charged to whichever stage waits on them
+        self.sync = sync and torch.cuda.is_available()
+        self.totals = OrderedDict()
+        self._peaks = []  # allocator peak seen so far by every open range, innermost last
+
+    @contextlib.contextmanager
+    def range(self, name):
+        with torch.profiler.record_function(name):
+            if self.sync:
+                torch.cuda.synchronize()
+                memory = torch.cuda.memory_allocated()
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], torch.cuda.max_memory_allocated())
+                torch.cuda.reset_peak_memory_stats()
+                self._peaks.append(memory)
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                if self.sync:
+                    torch.cuda.synchronize()
+                entry = self.totals.setdefault(name, [0, 0.0, 0, 0])
+                entry[0] += 1
+                entry[1] += time.perf_counter() - start
+                if self.sync:
+                    peak = max(self._peaks.pop(), torch.cuda.max_memory_allocated())
+                    if self._peaks:
+                        self._peaks[-1] = max(self._peaks[-1], peak)
+                    entry[2] += torch.cuda.memory_allocated() - memory
+                    entry[3] = max(entry[3], peak - memory)
+
+    def summary(self):
+        """One row per stage, slowest first."""
+        rows = []
+        for name, (calls, seconds, memory, peak) in self.totals.items():
+            rows.append({'stage': name, 'calls': calls, 'total_ms': seconds * 1000,
+                         'mean_ms': seconds * 1000 / calls, 'mem_delta_mb': memory / calls / 2 ** 20,
+                         'peak_mb': peak / 2 ** 20})
+        return sorted(rows, key=lambda row: -row['total_ms'])
+
+    def format(self):
+        rows = self.summary()
+        lines = ['%-24s %8s %12s %10s %13s %10s' % ('stage', 'calls', 'total_ms', 'mean_ms', 'mem_delta_mb',
+                                                     'peak_mb')]
+        for row in rows:
+            lines.append('%(stage)-24s %(calls)8d %(total_ms)12.1f %(mean_ms)10.3f %(mem_delta_mb)13.2f '
+                         '%(peak_mb)10.2f' % row)
+        return '\n'.join(lines)
+
+    def export(self, path, epoch=None):
+        """Append the summary as one JSON line."""
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(path, 'a') as f:
+            f.write(json.dumps({'epoch': epoch, 'stages': self.summary()}) + '\n')
+
+    def reset(self):
+        self.totals.clear()
+        self._peaks = []
+
+
+def enable(sync=True):
+    global _active
+    _active = StageProfiler(sync)
+    return _active
+
+
+def disable():
+    global _active
+    _active = None
+
+
+def active():
+    return _active
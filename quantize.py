@@ -0,0 +1,226 @@
+"""
+Post-training static int8 quantisation of the 1x1 convolution blocks of the
+DGCNN encoder and the FM3D predictor (eager mode, CPU).
+
+Every Conv+BatchNorm(+LeakyReLU) group becomes a QuantBlock: BN is folded into
+the convolution, the convolution runs in int8 between a QuantStub and a
+DeQuantStub, and the activation stays in float. knn, the neighbour gather and
+the max-pooling between the blocks stay in float as well. Observers are
+calibrated on ModelNet40 pairs, then the script reports the drift against the
+float model and the CPU speedup.
+
+    python quantize.py --model fm3d --model_path checkpoints/exp/models/50.pth --out exports/fm3d_int8.pt
+    python quantize.py --model reg --model_path registration/checkpoints/dcp_v2/models/model.best.t7
+"""
+import os
+import copy
+import argparse
+import importlib.util
+from time import perf_counter
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert, fuse_modules
+from export import add_model_args
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class QuantBlock(nn.Module):
+    """Conv with BN folded in, int8 between the stubs; the activation runs on the dequantised output."""
+
+    def __init__(self, conv, bn, act):
+        super(QuantBlock, self).__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.bn = bn
+        self.dequant = DeQuantStub()
+        self.act = act
+
+    def forward(self, x):
+        return self.act(self.dequant(self.bn(self.conv(self.quant(x)))))
+
+
+def _is_conv(module):
+    return isinstance(module, (nn.Conv1d, nn.Conv2d))
+
+
+def _is_bn(module):
+    return isinstance(module, nn.modules.batchnorm._BatchNorm)
+
+
+def _quant_sequential(seq):
+    """Sequential with every Conv, BN[, activation] run replaced by a QuantBlock; None if there is none."""
+    layers, i, found = [], 0, False
+    while i < len(seq):
+        if _is_conv(seq[i]) and i + 1 < len(seq) and _is_bn(seq[i + 1]):
+            act = nn.Identity()
+            step = 2
+            if i + 2 < len(seq) and isinstance(seq[i + 2], (nn.LeakyReLU, nn.ReLU)):
+                act, step = seq[i + 2], 3
+            layers.append(QuantBlock(seq[i], seq[i + 1], act))
+            found = True
+            i += step
+        else:
+            layers.append(seq[i])
+            i += 1
+    return nn.Sequential(*layers) if found else None
+
+
+def insert_quant_blocks(module):
+    """Replace the Conv/BN groups of every nn.Sequential under module, in place."""
+    for name, child in module.named_children():
+        if isinstance(child, nn.Sequential):
+            replaced = _quant_sequential(child)
+            if replaced is not None:
+                setattr(module, name, replaced)
+                continue
+        insert_quant_blocks(child)
+    return module
+
+
+def quantize(model, calibrate, backend='x86'):
+    """
+    int8 copy of an eval-mode float model. calibrate(prepared_model) runs the
+    calibration forward passes. The original model is left untouched.
+    """
+    torch.backends.quantized.engine = backend
+    qmodel = insert_quant_blocks(copy.deepcopy(model).cpu().eval())
+    qconfig = get_default_qconfig(backend)
+    for module in qmodel.modules():
+        if isinstance(module, QuantBlock):
+            fuse_modules(module, [['conv', 'bn']], inplace=True)
+            module.qconfig = qconfig
+    prepare(qmodel, inplace=True)
+    with torch.no_grad():
+        calibrate(qmodel)
+    convert(qmodel, inplace=True)
+    return qmodel
+
+
+def _registration_data():
+    spec = importlib.util.spec_from_file_location('registration_data', os.path.join(ROOT_DIR, 'registration', 'data.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def fm3d_batches(args, partition, count):
+    """(src, tgt) b*3*n float tensors from the FM3D pairs, in dataset order so point i matches point i."""
+    from data import ModelNet40
+    cwd = os.getcwd()
+    os.chdir(ROOT_DIR)
+    try:
+        dataset = ModelNet40(num_points=args.num_points, partition=partition, debug=args.debug)
+    finally:
+        os.chdir(cwd)
+    count = min(count, len(dataset))
+    for start in range(0, count, args.batch_size):
+        src, tgt = dataset.get_batch(np.arange(start, min(start + args.batch_size, count)))
+        yield src.permute(0, 2, 1).contiguous(), tgt.permute(0, 2, 1).contiguous()
+
+
+def reg_batches(args, partition, count):
+    """Registration test pairs: (src, tgt, R_ab, t_ab) with the fixed per-item transforms."""
+    dataset = _registration_data().ModelNet40(num_points=args.num_points, partition=partition)
+    count = min(count, len(dataset))
+    for start in range(0, count, args.batch_size):
+        src, tgt, R_ab, t_ab = dataset.get_batch(np.arange(start, min(start + args.batch_size, count)))[:4]
+        yield src, tgt, R_ab, t_ab
+
+
+def fm3d_drift(float_model, int8_model, batches):
+    """Correspondence accuracy (argmax == ground-truth index) of both models and their argmax agreement."""
+    correct_fp, correct_q, agree, total = 0, 0, 0, 0
+    with torch.no_grad():
+        for src, tgt in batches:
+            pred_fp = float_model.correspondence(src, tgt).argmax(dim=1)
+            pred_q = int8_model.correspondence(src, tgt).argmax(dim=1)
+            gt = torch.arange(src.size(2)).expand_as(pred_fp)
+            correct_fp += (pred_fp == gt).sum().item()
+            correct_q += (pred_q == gt).sum().item()
+            agree += (pred_fp == pred_q).sum().item()
+            total += gt.numel()
+    return {'corr_acc_float': correct_fp / total, 'corr_acc_int8': correct_q / total,
+            'argmax_agreement': agree / total}
+
+
+def reg_drift(float_model, int8_model, batches):
+    """Mean geodesic rotation error (degrees) and translation error of both models on the test pairs."""
+    from util import rotation_error, translation_error
+    errors = {'rot_error_float': [], 'rot_error_int8': [], 'trans_error_float': [], 'trans_error_int8': []}
+    with torch.no_grad():
+        for src, tgt, R_ab, t_ab in batches:
+            for name, net in (('float', float_model), ('int8', int8_model)):
+                R_pred, t_pred = net(src, tgt)[:2]
+                errors['rot_error_' + name].append(rotation_error(R_pred, R_ab))
+                errors['trans_error_' + name].append(translation_error(t_pred, t_ab))
+    return {key: torch.cat(value).mean().item() for key, value in errors.items()}
+
+
+def time_forward(forward, inputs, iters=10):
+    with torch.no_grad():
+        forward(*inputs)
+        start = perf_counter()
+        for _ in range(iters):
+            forward(*inputs)
+    return (perf_counter() - start) * 1000 / iters
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Post-training int8 quantisation')
+    add_model_args(parser)
+    parser.add_argument('--num_points', type=int, default=1024, metavar='N',
+                        help='Num of points to use')
+    parser.add_argument('--batch_size', type=int, default=8, metavar='batch_size',
+                        help='Pairs per calibration/evaluation batch')
+    parser.add_argument('--calib_pairs', type=int, default=256, metavar='N',
+                        help='Training pairs used to calibrate the observers')
+    parser.add_argument('--eval_pairs', type=int, default=256, metavar='N',
+                        help='Test pairs used to measure the drift')
+    parser.add_argument('--backend', type=str, default='x86', choices=['x86', 'fbgemm', 'qnnpack'],
+                        help='Quantised engine')
+    parser.add_argument('--debug', type=bool, default=False,
+                        help='Debug mode (FM3D data from data/debug)')
+    parser.add_argument('--out', type=str, default='',
+                        help='Save the quantised model as TorchScript')
+    args = parser.parse_args()
+    args.no_cuda = True
+    args.cuda = False
+
+    from export import build_inference_model
+    # unfused, QuantBlock folds the BatchNorms itself
+    wrapper = build_inference_model(args, torch.device('cpu'), fuse=False)
+    float_model = wrapper.fm3d if args.model == 'fm3d' else wrapper.reg_model
+    batches = fm3d_batches if args.model == 'fm3d' else reg_batches
+
+    def calibrate(qmodel):
+        for batch in batches(args, 'train', args.calib_pairs):
+            qmodel(batch[0], batch[1])
+
+    int8_model = quantize(float_model, calibrate, args.backend)
+    if args.model == 'fm3d':
+        drift = fm3d_drift(float_model, int8_model, batches(args, 'test', args.eval_pairs))
+    else:
+        drift = reg_drift(float_model, int8_model, batches(args, 'test', args.eval_pairs))
+    for key, value in drift.items():
+        print('%s: %.4f' % (key, value))
+
+    inputs = (torch.randn(args.batch_size, 3, args.num_points), torch.randn(args.batch_size, 3, args.num_points))
+    float_ms = time_forward(float_model, inputs)
+    int8_ms = time_forward(int8_model, inputs)
+    print('CPU forward, batch %d: float %.1f ms, int8 %.1f ms, speedup %.2fx'
+          % (args.batch_size, float_ms, int8_ms, float_ms / int8_ms))
+
+    if args.out:
+        out_dir = os.path.dirname(args.out)
+        if out_dir and not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        export_wrapper = type(wrapper)(int8_model).eval()
+        with torch.no_grad():
+            torch.jit.save(torch.jit.trace(export_wrapper, inputs), args.out)
+        print('Quantised model written to %s' % args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from util import quat2mat
+from util import quat2mat, kabsch
 
 # todo: comment
 # os.chdir("../")
@@ -23,6 +23,7 @@ from util import quat2mat
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 # print(sys.path)
 import model 
+from profiling import stage
 
 
 # Part of the code is referred from: http://nlp.seas.harvard.edu/2018/04/03/attention.html#positional-encoding
@@ -62,9 +63,7 @@ def get_graph_feature(x, k=20):
     # x = x.squeeze()
     idx = knn(x, k=k)  # (batch_size, num_points, k)
     batch_size, num_points, _ = idx.size()
-    device = torch.device('cuda')
-
-    idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1) * num_points
+    idx_base = torch.arange(0, batch_size, device=x.device).view(-1, 1, 1) * num_points
 
     idx = idx + idx_base
 
@@ -285,13 +284,28 @@ class Transformer(nn.Module):
         src_embedding = self.model(tgt, src, None, None).transpose(2, 1).contiguous()
         return src_embedding, tgt_embedding
 
+    def memory(self, embedding):
+        """Encoder half for one side, b*n*d; it depends on that cloud only and can be shared."""
+        return self.model.encode(embedding.transpose(2, 1).contiguous(), None)
+
+    def decode(self, memory, embedding):
+        """Decoder half: embedding (b*d*n) attending to the other cloud's memory, b*d*n."""
+        return self.model.decode(memory, None, embedding.transpose(2, 1).contiguous(), None).transpose(2, 1).contiguous()
+
 class SVDHead(nn.Module):
     def __init__(self, args):
         super(SVDHead, self).__init__()
         self.emb_dims = args.emb_dims
+        # unused since the SVD is batched (see util.svd_rotation), kept so old checkpoints still load
         self.reflect = nn.Parameter(torch.eye(3), requires_grad=False)
         self.reflect[2, 2] = -1
 
+    def scores(self, src_embedding, tgt_embedding):
+        # soft assignment of every source point to the target points, b*n_src*n_tgt
+        d_k = src_embedding.size(1)
+        scores = torch.matmul(src_embedding.transpose(2, 1).contiguous(), tgt_embedding) / math.sqrt(d_k)
+        return torch.softmax(scores, dim=2)
+
     def forward(self, *input):
         src_embedding = input[0]
         tgt_embedding = input[1]
@@ -299,42 +313,13 @@ class SVDHead(nn.Module):
         tgt = input[3]
         batch_size = src.size(0)
 
-        d_k = src_embedding.size(1)
-        scores = torch.matmul(src_embedding.transpose(2, 1).contiguous(), tgt_embedding) / math.sqrt(d_k)
-        scores = torch.softmax(scores, dim=2)
-
-        src_corr = torch.matmul(tgt, scores.transpose(2, 1).contiguous())
-
-        src_centered = src - src.mean(dim=2, keepdim=True)
+        with stage('reg.scores'):
+            scores = self.scores(src_embedding, tgt_embedding)
+            src_corr = torch.matmul(tgt, scores.transpose(2, 1).contiguous())
 
-        src_corr_centered = src_corr - src_corr.mean(dim=2, keepdim=True)
-
-        H = torch.matmul(src_centered, src_corr_centered.transpose(2, 1).contiguous())
-
-        U, S, V = [], [], []
-        R = []
-
-        for i in range(src.size(0)):
-            u, s, v = torch.svd(H[i])
-            r = torch.matmul(v, u.transpose(1, 0).contiguous())
-            r_det = torch.det(r)
-            if r_det < 0:
-                u, s, v = torch.svd(H[i])
-                v = torch.matmul(v, self.reflect)
-                r = torch.matmul(v, u.transpose(1, 0).contiguous())
-                # r = r * self.reflect
-            R.append(r)
-
-            U.append(u)
-            S.append(s)
-            V.append(v)
-
-        U = torch.stack(U, dim=0)
-        V = torch.stack(V, dim=0)
-        S = torch.stack(S, dim=0)
-        R = torch.stack(R, dim=0)
-
-        t = torch.matmul(-R, src.mean(dim=2, keepdim=True)) + src_corr.mean(dim=2, keepdim=True)
+        # one batched SVD with the reflection fix instead of a per-sample loop
+        with stage('reg.svd'):
+            R, t = kabsch(src, src_corr)
         return R, t.view(batch_size, 3)
 
 
@@ -351,20 +336,67 @@ class RegModel(nn.Module):
 
         
 
+    def encode(self, x, cache=None):
+        """emb_nn features b*d*n, reused from an EmbeddingCache (eval mode only) when one is given."""
+        if cache is None:
+            return self.emb_nn(x)
+        return cache.embed(x, self.emb_nn, tag='reg')
+
+    def embed(self, src, tgt, cache=None):
+        return self.attend(self.encode(src, cache), self.encode(tgt, cache))
+
+    def attend(self, src_embedding, tgt_embedding):
+        # the transformer depends on both clouds, so only encode() is cacheable
+        with stage('reg.attention'):
+            src_embedding_p, tgt_embedding_p = self.pointer(src_embedding, tgt_embedding)
+        return src_embedding + src_embedding_p, tgt_embedding + tgt_embedding_p
+
+    def correspondence(self, src, tgt, cache=None):
+        """Soft correspondences b*n_src*n_tgt used by the SVD head, each row sums to one."""
+        src_embedding, tgt_embedding = self.embed(src, tgt, cache)
+        return self.head.scores(src_embedding, tgt_embedding)
+
+    def register_many(self, src, tgts, chunk_size=64, cache=None):
+        """
+        Register one source cloud (3*n or 1*3*n) against m targets (m*3*n_t).
+        emb_nn and the transformer encoder run once on the source, whose
+        features are broadcast over chunks of chunk_size targets, so the cost
+        grows linearly with m. Returns R_ab (m*3*3), t_ab (m*3) and a residual
+        (m): mean distance from the transformed source points to their nearest
+        target point, lower is a better fit. Eval mode only.
+        """
+        if src.dim() == 2:
+            src = src.unsqueeze(0)
+        src_embedding = self.encode(src, cache)
+        src_memory = self.pointer.memory(src_embedding)
+        rotations, translations, residuals = [], [], []
+        for start in range(0, tgts.size(0), chunk_size):
+            tgt = tgts[start:start + chunk_size]
+            count = tgt.size(0)
+            tgt_embedding = self.encode(tgt, cache)
+            src_batch = src.expand(count, -1, -1)
+            src_embedding_b = src_embedding.expand(count, -1, -1)
+            tgt_embedding_p = self.pointer.decode(src_memory.expand(count, -1, -1), tgt_embedding)
+            src_embedding_p = self.pointer.decode(self.pointer.memory(tgt_embedding), src_embedding_b)
+            rotation_ab, translation_ab = self.head(src_embedding_b + src_embedding_p,
+                                                    tgt_embedding + tgt_embedding_p, src_batch, tgt)
+            transformed = torch.matmul(rotation_ab, src_batch) + translation_ab.unsqueeze(2)
+            distances = torch.cdist(transformed.transpose(2, 1), tgt.transpose(2, 1))
+            rotations.append(rotation_ab)
+            translations.append(translation_ab)
+            residuals.append(distances.min(dim=2)[0].mean(dim=1))
+        return torch.cat(rotations), torch.cat(translations), torch.cat(residuals)
+
     def forward(self, *input):
         src = input[0]
         tgt = input[1]
-        src_embedding = self.emb_nn(src)
-        tgt_embedding = self.emb_nn(tgt)
-
-        # stop gradient
-        src_embedding.detach()
-        tgt_embedding.detach()
-
-        src_embedding_p, tgt_embedding_p = self.pointer(src_embedding, tgt_embedding)
+        with stage('reg.encoder'):
+            src_embedding, tgt_embedding = self.emb_nn(src), self.emb_nn(tgt)
+        return self.forward_embeddings(src, tgt, src_embedding, tgt_embedding)
 
-        src_embedding = src_embedding + src_embedding_p
-        tgt_embedding = tgt_embedding + tgt_embedding_p
+    def forward_embeddings(self, src, tgt, src_embedding, tgt_embedding):
+        """forward() from precomputed emb_nn features, e.g. encode(src, cache)."""
+        src_embedding, tgt_embedding = self.attend(src_embedding, tgt_embedding)
 
         rotation_ab, translation_ab = self.head(src_embedding, tgt_embedding, src, tgt)
         if self.cycle:
@@ -13,7 +13,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from util import quat2mat
+from util import quat2mat, kabsch
 
 
 # Part of the code is referred from: http://nlp.seas.harvard.edu/2018/04/03/attention.html#positional-encoding
@@ -53,9 +53,7 @@ def get_graph_feature(x, k=20):
     # x = x.squeeze()
     idx = knn(x, k=k)  # (batch_size, num_points, k)
     batch_size, num_points, _ = idx.size()
-    device = torch.device('cuda')
-
-    idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1) * num_points
+    idx_base = torch.arange(0, batch_size, device=x.device).view(-1, 1, 1) * num_points
 
     idx = idx + idx_base
 
@@ -377,6 +375,7 @@ class SVDHead(nn.Module):
     def __init__(self, args):
         super(SVDHead, self).__init__()
         self.emb_dims = args.emb_dims
+        # unused since the SVD is batched (see util.svd_rotation), kept so old checkpoints still load
         self.reflect = nn.Parameter(torch.eye(3), requires_grad=False)
         self.reflect[2, 2] = -1
 
@@ -393,36 +392,8 @@ class SVDHead(nn.Module):
 
         src_corr = torch.matmul(tgt, scores.transpose(2, 1).contiguous())
 
-        src_centered = src - src.mean(dim=2, keepdim=True)
-
-        src_corr_centered = src_corr - src_corr.mean(dim=2, keepdim=True)
-
-        H = torch.matmul(src_centered, src_corr_centered.transpose(2, 1).contiguous())
-
-        U, S, V = [], [], []
-        R = []
-
-        for i in range(src.size(0)):
-            u, s, v = torch.svd(H[i])
-            r = torch.matmul(v, u.transpose(1, 0).contiguous())
-            r_det = torch.det(r)
-            if r_det < 0:
-                u, s, v = torch.svd(H[i])
-                v = torch.matmul(v, self.reflect)
-                r = torch.matmul(v, u.transpose(1, 0).contiguous())
-                # r = r * self.reflect
-            R.append(r)
-
-            U.append(u)
-            S.append(s)
-            V.append(v)
-
-        U = torch.stack(U, dim=0)
-        V = torch.stack(V, dim=0)
-        S = torch.stack(S, dim=0)
-        R = torch.stack(R, dim=0)
-
-        t = torch.matmul(-R, src.mean(dim=2, keepdim=True)) + src_corr.mean(dim=2, keepdim=True)
+        # one batched SVD with the reflection fix instead of a per-sample loop
+        R, t = kabsch(src, src_corr)
         return R, t.view(batch_size, 3)
 
 
@@ -7,9 +7,13 @@ import sys
 import glob
 import h5py
 import numpy as np
+import torch
 from scipy.spatial.transform import Rotation
 from torch.utils.data import Dataset
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sampling import subsample
+
 
 # Part of the code is referred from: https://github.com/charlesq34/pointnet
 
@@ -58,8 +62,27 @@ def jitter_pointcloud(pointcloud, sigma=0.01, clip=0.05):
     return pointcloud
 
 
+def rotation_matrices(anglex, angley, anglez):
+    """Batched Rx.dot(Ry).dot(Rz) for (B,) angle arrays, (B, 3, 3)."""
+    cosx, cosy, cosz = np.cos(anglex), np.cos(angley), np.cos(anglez)
+    sinx, siny, sinz = np.sin(anglex), np.sin(angley), np.sin(anglez)
+    zeros, ones = np.zeros_like(anglex), np.ones_like(anglex)
+    Rx = np.stack([ones, zeros, zeros, zeros, cosx, -sinx, zeros, sinx, cosx], axis=1).reshape(-1, 3, 3)
+    Ry = np.stack([cosy, zeros, siny, zeros, ones, zeros, -siny, zeros, cosy], axis=1).reshape(-1, 3, 3)
+    Rz = np.stack([cosz, -sinz, zeros, sinz, cosz, zeros, zeros, zeros, ones], axis=1).reshape(-1, 3, 3)
+    return Rx @ Ry @ Rz
+
+
+def take(array, items):
+    """array[items] as a slice when items is a contiguous ascending range, fancy indexing otherwise."""
+    if len(items) > 0 and items[-1] - items[0] == len(items) - 1 and np.all(np.diff(items) == 1):
+        return array[items[0]:items[-1] + 1]
+    return array[items]
+
+
 class ModelNet40(Dataset):
-    def __init__(self, num_points, partition='train', gaussian_noise=False, unseen=False, factor=4):
+    def __init__(self, num_points, partition='train', gaussian_noise=False, unseen=False, factor=4,
+                 sampling='first', voxel_size=0.05):
         self.data, self.label = load_data(partition)
         self.num_points = num_points
         self.partition = partition
@@ -75,8 +98,61 @@ class ModelNet40(Dataset):
             elif self.partition == 'train':
                 self.data = self.data[self.label<20]
                 self.label = self.label[self.label<20]
+        if sampling != 'first':
+            # once per dataset instead of the [:num_points] prefix, the target is transformed from the sample
+            idx = subsample(self.data, num_points, sampling, voxel_size)
+            self.data = np.take_along_axis(self.data, idx[:, :, None], axis=1)
+
+    def _sample_transforms(self, items, num_points):
+        if self.partition != 'train':
+            # same per-item seeding and draw order as __getitem__, so the test set is unchanged
+            angles, translations, perm1, perm2 = [], [], [], []
+            for item in items:
+                rng = np.random.RandomState(item)
+                angles.append([rng.uniform() for _ in range(3)])
+                translations.append([rng.uniform(-0.5, 0.5) for _ in range(3)])
+                perm1.append(rng.permutation(num_points))
+                perm2.append(rng.permutation(num_points))
+            return np.array(angles) * np.pi / self.factor, np.array(translations), np.stack(perm1), np.stack(perm2)
+        batch_size = len(items)
+        angles = np.random.uniform(size=(batch_size, 3)) * np.pi / self.factor
+        translations = np.random.uniform(-0.5, 0.5, size=(batch_size, 3))
+        perm1 = np.argsort(np.random.rand(batch_size, num_points), axis=1)
+        perm2 = np.argsort(np.random.rand(batch_size, num_points), axis=1)
+        return angles, translations, perm1, perm2
+
+    def get_batch(self, items):
+        """
+        Vectorised __getitem__ over a list of indices, returning the eight fields
+        as stacked tensors. Used with a BatchSampler instead of per-item collate.
+        """
+        items = np.asarray(items)
+        pointcloud = take(self.data, items)[:, :self.num_points]
+        if self.gaussian_noise:
+            pointcloud = pointcloud + np.clip(0.01 * np.random.randn(*pointcloud.shape), -0.05, 0.05)
+        num_points = pointcloud.shape[1]
+        angles, translation_ab, perm1, perm2 = self._sample_transforms(items, num_points)
+        anglex, angley, anglez = angles[:, 0], angles[:, 1], angles[:, 2]
+
+        R_ab = rotation_matrices(anglex, angley, anglez)
+        R_ba = R_ab.transpose(0, 2, 1)
+        translation_ba = -np.einsum('bij,bj->bi', R_ba, translation_ab)
+
+        pointcloud1 = pointcloud.transpose(0, 2, 1)
+        pointcloud2 = np.einsum('bij,bjn->bin', R_ab, pointcloud1) + translation_ab[:, :, None]
+
+        euler_ab = np.stack([anglez, angley, anglex], axis=1)
+        euler_ba = -euler_ab[:, ::-1]
+
+        pointcloud1 = np.take_along_axis(pointcloud1, perm1[:, None, :], axis=2)
+        pointcloud2 = np.take_along_axis(pointcloud2, perm2[:, None, :], axis=2)
+
+        fields = (pointcloud1, pointcloud2, R_ab, translation_ab, R_ba, translation_ba, euler_ab, euler_ba)
+        return tuple(torch.from_numpy(np.ascontiguousarray(f, dtype='float32')) for f in fields)
 
     def __getitem__(self, item):
+        if isinstance(item, (list, np.ndarray)):
+            return self.get_batch(item)
         pointcloud = self.data[item][:self.num_points]
         if self.gaussian_noise:
             pointcloud = jitter_pointcloud(pointcloud)
@@ -126,6 +202,24 @@ class ModelNet40(Dataset):
         return self.data.shape[0]
 
 
+class SyntheticModelNet40(ModelNet40):
+    """
+    ModelNet40 stand-in without data_raw: num_shapes random clouds of 2048
+    points, transformed and indexed by the inherited __getitem__/get_batch.
+    Used to measure training throughput (main.py --synthetic, benchmarks/bench_train.py).
+    """
+
+    def __init__(self, num_points, partition='train', gaussian_noise=False, factor=4, num_shapes=1024, seed=0):
+        rng = np.random.RandomState(seed if partition == 'train' else seed + 1)
+        self.data = rng.uniform(-1, 1, size=(num_shapes, max(num_points, 2048), 3)).astype('float32')
+        self.label = np.zeros(num_shapes, dtype='int64')
+        self.num_points = num_points
+        self.partition = partition
+        self.gaussian_noise = gaussian_noise
+        self.unseen = False
+        self.factor = factor
+
+
 if __name__ == '__main__':
     train = ModelNet40(1024)
     test = ModelNet40(1024, 'test')
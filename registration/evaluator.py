@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import os
+import sys
+import numpy as np
+import torch
+from util import transform_point_cloud, mat2euler, rotation_error, translation_error
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metric_logger import MetricAccumulator
+from distributed import all_reduce_max
+
+
+SAMPLE_DTYPE = np.dtype([('rotation_ab_pred', 'f4', (3, 3)), ('translation_ab_pred', 'f4', (3,)),
+                         ('euler_ab_pred', 'f4', (3,)), ('rot_error_ab', 'f4'), ('trans_error_ab', 'f4'),
+                         ('rotation_ba_pred', 'f4', (3, 3)), ('translation_ba_pred', 'f4', (3,)),
+                         ('euler_ba_pred', 'f4', (3,)), ('rot_error_ba', 'f4'), ('trans_error_ba', 'f4')])
+
+
+class RegistrationEvaluator:
+    """
+    Streaming registration metrics. update() folds one batch into running sums
+    that stay on the device, so memory does not grow with the size of the test
+    set. When dump_path is given, per-sample predictions and errors are written
+    to a memory-mapped .npy file of SAMPLE_DTYPE records (single process only).
+    """
+
+    def __init__(self, num_samples=None, dump_path=None, distributed=False):
+        self.acc = MetricAccumulator(distributed=distributed)
+        self.max_rot_error = {'ab': None, 'ba': None}
+        self.num_examples = 0
+        self.dump = None
+        if dump_path is not None:
+            if distributed:
+                # every rank would truncate the same file and write its own rows at overlapping offsets
+                raise ValueError('dump_path is single process only, it cannot be combined with distributed')
+            self.dump = np.lib.format.open_memmap(dump_path, mode='w+', dtype=SAMPLE_DTYPE,
+                                                  shape=(num_samples,))
+
+    def _direction(self, name, src, target, rotation, translation, euler, rotation_pred, translation_pred, seq):
+        transformed_src = transform_point_cloud(src, rotation_pred, translation_pred)
+        euler_pred = mat2euler(rotation_pred.detach(), seq)
+        euler_error = euler_pred - torch.rad2deg(euler)
+        translation_diff = translation_pred.detach() - translation
+        rot_error = rotation_error(rotation_pred.detach(), rotation)
+        trans_error = translation_error(translation_pred.detach(), translation)
+        batch_max = rot_error.max()
+        if self.max_rot_error[name] is None:
+            self.max_rot_error[name] = batch_max
+        else:
+            self.max_rot_error[name] = torch.max(self.max_rot_error[name], batch_max)
+        stats = {
+            'mse_' + name: torch.mean((transformed_src - target) ** 2),
+            'mae_' + name: torch.mean(torch.abs(transformed_src - target)),
+            'rot_mse_' + name: torch.mean(euler_error ** 2),
+            'rot_mae_' + name: torch.mean(torch.abs(euler_error)),
+            'trans_mse_' + name: torch.mean(translation_diff ** 2),
+            'trans_mae_' + name: torch.mean(torch.abs(translation_diff)),
+            'rot_geodesic_' + name: rot_error.mean(),
+            'trans_error_' + name: trans_error.mean(),
+        }
+        return stats, (euler_pred, rot_error, trans_error)
+
+    def update(self, src, target, rotation_ab, translation_ab, rotation_ba, translation_ba, euler_ab, euler_ba,
+               rotation_ab_pred, translation_ab_pred, rotation_ba_pred, translation_ba_pred, **losses):
+        batch_size = src.size(0)
+        with torch.no_grad():
+            stats_ab, per_sample_ab = self._direction('ab', src, target, rotation_ab, translation_ab, euler_ab,
+                                                      rotation_ab_pred, translation_ab_pred, 'zyx')
+            stats_ba, per_sample_ba = self._direction('ba', target, src, rotation_ba, translation_ba, euler_ba,
+                                                      rotation_ba_pred, translation_ba_pred, 'xyz')
+        self.acc.update(batch_size, **losses, **stats_ab, **stats_ba)
+        if self.dump is not None:
+            records = self.dump[self.num_examples:self.num_examples + batch_size]
+            records['rotation_ab_pred'] = rotation_ab_pred.detach().cpu().numpy()
+            records['translation_ab_pred'] = translation_ab_pred.detach().cpu().numpy()
+            records['rotation_ba_pred'] = rotation_ba_pred.detach().cpu().numpy()
+            records['translation_ba_pred'] = translation_ba_pred.detach().cpu().numpy()
+            for name, (euler_pred, rot_error, trans_error) in (('ab', per_sample_ab), ('ba', per_sample_ba)):
+                records['euler_%s_pred' % name] = euler_pred.cpu().numpy()
+                records['rot_error_%s' % name] = rot_error.cpu().numpy()
+                records['trans_error_%s' % name] = trans_error.cpu().numpy()
+        self.num_examples += batch_size
+
+    def summary(self):
+        stats = self.acc.sync()
+        for name in ('ab', 'ba'):
+            stats['rmse_' + name] = np.sqrt(stats['mse_' + name])
+            stats['rot_rmse_' + name] = np.sqrt(stats['rot_mse_' + name])
+            stats['trans_rmse_' + name] = np.sqrt(stats['trans_mse_' + name])
+            if self.max_rot_error[name] is not None:
+                stats['rot_geodesic_max_' + name] = all_reduce_max(self.max_rot_error[name]).item()
+        if self.dump is not None:
+            self.dump.flush()
+        return stats
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Closed-loop load generator for serve.py: --concurrency connections each send
+one pair, wait for the answer and send the next. Reports client-side latency
+percentiles and throughput, then the server's own summary.
+
+    python load_gen.py --concurrency 16 --requests 2000 --num_points 1024
+"""
+
+
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+from scipy.spatial.transform import Rotation
+from serve import read_frame, write_frame, encode_request, decode_response, REQUEST, OP_STATS
+
+
+def make_pairs(args):
+    """Random clouds and their rigidly transformed copies, or ModelNet40 test pairs with --dataset."""
+    if args.dataset:
+        from data import ModelNet40
+        dataset = ModelNet40(num_points=args.num_points, partition='test')
+        count = min(args.num_pairs, len(dataset))
+        return [(dataset[i][0].T.copy(), dataset[i][1].T.copy()) for i in range(count)]
+    rng = np.random.RandomState(args.seed)
+    pairs = []
+    for _ in range(args.num_pairs):
+        src = rng.uniform(-1, 1, size=(args.num_points, 3)).astype('float32')
+        rotation = Rotation.from_euler('zyx', rng.uniform(0, np.pi / 4, size=3))
+        tgt = rotation.apply(src) + rng.uniform(-0.5, 0.5, size=3)
+        pairs.append((src, tgt[rng.permutation(args.num_points)].astype('float32')))
+    return pairs
+
+
+async def client(args, payloads, counter, latencies, errors):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        while counter[0] < args.requests:
+            payload = payloads[counter[0] % len(payloads)]
+            counter[0] += 1
+            start = time.perf_counter()
+            write_frame(writer, payload)
+            await writer.drain()
+            response = await read_frame(reader)
+            try:
+                decode_response(response)
+                latencies.append(time.perf_counter() - start)
+            except RuntimeError as e:
+                errors.append(str(e))
+    finally:
+        writer.close()
+
+
+async def server_stats(args):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    write_frame(writer, REQUEST.pack(OP_STATS, 0, 0))
+    await writer.drain()
+    response = await read_frame(reader)
+    writer.close()
+    return json.loads(response[1:].decode('utf-8'))
+
+
+async def run(args):
+    pairs = make_pairs(args)
+    if args.fixed_source:
+        # one reference scan against many targets, the case serve.py --cache_mb is for
+        pairs = [(pairs[0][0], tgt) for _, tgt in pairs]
+    payloads = [encode_request(src, tgt) for src, tgt in pairs]
+    counter, latencies, errors = [0], [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args, payloads, counter, latencies, errors) for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    print('%d requests (%d errors) from %d connections in %.2fs: %.1f req/s'
+          % (len(latencies), len(errors), args.concurrency, elapsed, len(latencies) / elapsed))
+    if len(latencies):
+        print('client latency p50 %.1f ms, p99 %.1f ms, mean %.1f ms'
+              % (np.percentile(latencies, 50), np.percentile(latencies, 99), latencies.mean()))
+    if errors:
+        print('first error: %s' % errors[0])
+    print('server: %s' % json.dumps(await server_stats(args)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for the registration server')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--concurrency', type=int, default=16, metavar='N',
+                        help='Concurrent connections, each with one request in flight')
+    parser.add_argument('--requests', type=int, default=1000, metavar='N',
+                        help='Total requests sent')
+    parser.add_argument('--num_points', type=int, default=1024, metavar='N',
+                        help='Points per cloud')
+    parser.add_argument('--num_pairs', type=int, default=64, metavar='N',
+                        help='Distinct pairs cycled through')
+    parser.add_argument('--dataset', action='store_true', default=False,
+                        help='Send ModelNet40 test pairs instead of random clouds')
+    parser.add_argument('--fixed_source', action='store_true', default=False,
+                        help='Register every target against the same source cloud')
+    parser.add_argument('--seed', type=int, default=1234, metavar='S')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,21 +2,29 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 import os
+import sys
 import gc
 import argparse
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
 import torch.optim as optim
 from torch.optim.lr_scheduler import MultiStepLR
-from data import ModelNet40
+from data import ModelNet40, SyntheticModelNet40
 from RegModel import RegModel
-from util import transform_point_cloud, npmat2euler
+from evaluator import RegistrationEvaluator
+from refine import coarse_to_fine, icp_refine
+from util import compute_loss
 import numpy as np
-from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from tensorboardX import SummaryWriter
 from tqdm import tqdm
-import matplotlib.pyplot as plt
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metric_logger import MetricLogger, MetricAccumulator
+from loader import add_loader_args, build_loader, set_loader_epoch
+from sampling import add_sampling_args
+import profiling
+from distributed import init_distributed, wrap_model, unwrap_model, is_main_process, cleanup
+from memory import add_memory_args, auto_batch, accumulation_context
 
 
 # Part of the code is referred from: https://github.com/floodsung/LearningToCompare_FSL
@@ -46,249 +54,122 @@ def _init_(args):
     os.system('cp data.py checkpoints' + '/' + args.exp_name + '/' + 'data.py.backup')
 
 
-def test_one_epoch(args, net, test_loader):
+def test_one_epoch(args, net, test_loader, dump_path=None):
     net.eval()
-    mse_ab = 0
-    mae_ab = 0
-    mse_ba = 0
-    mae_ba = 0
-
-    total_loss = 0
-    total_cycle_loss = 0
-    total_rotation_loss = 0
-    total_translation_loss = 0
-    num_examples = 0
-    rotations_ab = []
-    translations_ab = []
-    rotations_ab_pred = []
-    translations_ab_pred = []
-
-    rotations_ba = []
-    translations_ba = []
-    rotations_ba_pred = []
-    translations_ba_pred = []
-
-    eulers_ab = []
-    eulers_ba = []
-
-    for src, target, rotation_ab, translation_ab, rotation_ba, translation_ba, euler_ab, euler_ba in tqdm(test_loader):
-        src = src.cuda()
-        target = target.cuda()
-        rotation_ab = rotation_ab.cuda()
-        translation_ab = translation_ab.cuda()
-        rotation_ba = rotation_ba.cuda()
-        translation_ba = translation_ba.cuda()
-
-        batch_size = src.size(0)
-        num_examples += batch_size
-        rotation_ab_pred, translation_ab_pred, rotation_ba_pred, translation_ba_pred = net(src, target)
-
-        ## save rotation and translation
-        rotations_ab.append(rotation_ab.detach().cpu().numpy())
-        translations_ab.append(translation_ab.detach().cpu().numpy())
-        rotations_ab_pred.append(rotation_ab_pred.detach().cpu().numpy())
-        translations_ab_pred.append(translation_ab_pred.detach().cpu().numpy())
-        eulers_ab.append(euler_ab.numpy())
-        ##
-        rotations_ba.append(rotation_ba.detach().cpu().numpy())
-        translations_ba.append(translation_ba.detach().cpu().numpy())
-        rotations_ba_pred.append(rotation_ba_pred.detach().cpu().numpy())
-        translations_ba_pred.append(translation_ba_pred.detach().cpu().numpy())
-        eulers_ba.append(euler_ba.numpy())
-
-        transformed_src = transform_point_cloud(src, rotation_ab_pred, translation_ab_pred)
-
-        transformed_target = transform_point_cloud(target, rotation_ba_pred, translation_ba_pred)
-
-        ###########################
-        identity = torch.eye(3).cuda().unsqueeze(0).repeat(batch_size, 1, 1)
-        rotation_loss = F.mse_loss(torch.matmul(rotation_ab_pred.transpose(2, 1), rotation_ab), identity)
-        translation_loss = F.mse_loss(translation_ab_pred, translation_ab)
-        loss = rotation_loss + translation_loss
-        if args.cycle:
-            rotation_loss = F.mse_loss(torch.matmul(rotation_ba_pred, rotation_ab_pred), identity.clone())
-            translation_loss = torch.mean((torch.matmul(rotation_ba_pred.transpose(2, 1),
-                                                        translation_ab_pred.view(batch_size, 3, 1)).view(batch_size, 3)
-                                           + translation_ba_pred) ** 2, dim=[0, 1])
-            cycle_loss = rotation_loss + translation_loss
-
-            loss = loss + cycle_loss * 0.1
-
-        total_loss += loss.item() * batch_size
-        total_rotation_loss += rotation_loss.item() * batch_size
-        total_translation_loss += translation_loss.item() * batch_size
-        if args.cycle:
-            total_cycle_loss = total_cycle_loss + cycle_loss.item() * 0.1 * batch_size
-
-        mse_ab += torch.mean((transformed_src - target) ** 2, dim=[0, 1, 2]).item() * batch_size
-        mae_ab += torch.mean(torch.abs(transformed_src - target), dim=[0, 1, 2]).item() * batch_size
-
-        mse_ba += torch.mean((transformed_target - src) ** 2, dim=[0, 1, 2]).item() * batch_size
-        mae_ba += torch.mean(torch.abs(transformed_target - src), dim=[0, 1, 2]).item() * batch_size
-
-    rotations_ab = np.concatenate(rotations_ab, axis=0)
-    translations_ab = np.concatenate(translations_ab, axis=0)
-    rotations_ab_pred = np.concatenate(rotations_ab_pred, axis=0)
-    translations_ab_pred = np.concatenate(translations_ab_pred, axis=0)
-
-    rotations_ba = np.concatenate(rotations_ba, axis=0)
-    translations_ba = np.concatenate(translations_ba, axis=0)
-    rotations_ba_pred = np.concatenate(rotations_ba_pred, axis=0)
-    translations_ba_pred = np.concatenate(translations_ba_pred, axis=0)
-
-    eulers_ab = np.concatenate(eulers_ab, axis=0)
-    eulers_ba = np.concatenate(eulers_ba, axis=0)
-
-    return total_loss * 1.0 / num_examples, total_cycle_loss / num_examples, \
-           total_rotation_loss * 1.0 / num_examples, total_translation_loss * 1.0 / num_examples, \
-           mse_ab * 1.0 / num_examples, mae_ab * 1.0 / num_examples, \
-           mse_ba * 1.0 / num_examples, mae_ba * 1.0 / num_examples, rotations_ab, \
-           translations_ab, rotations_ab_pred, translations_ab_pred, rotations_ba, \
-           translations_ba, rotations_ba_pred, translations_ba_pred, eulers_ab, eulers_ba
-
-
-def train_one_epoch(args, net, train_loader, opt):
+    evaluator = RegistrationEvaluator(len(test_loader.dataset), dump_path, distributed=args.distributed)
+    icp_iterations, icp_time_ms = [], []
+
+    with torch.no_grad():
+        for src, target, rotation_ab, translation_ab, rotation_ba, translation_ba, euler_ab, euler_ba in tqdm(test_loader):
+            src = src.to(args.device, non_blocking=True)
+            target = target.to(args.device, non_blocking=True)
+            rotation_ab = rotation_ab.to(args.device, non_blocking=True)
+            translation_ab = translation_ab.to(args.device, non_blocking=True)
+            rotation_ba = rotation_ba.to(args.device, non_blocking=True)
+            translation_ba = translation_ba.to(args.device, non_blocking=True)
+            euler_ab = euler_ab.to(args.device, non_blocking=True)
+            euler_ba = euler_ba.to(args.device, non_blocking=True)
+
+            if args.coarse_points > 0:
+                rotation_ab_pred, translation_ab_pred = coarse_to_fine(net, src, target, args.coarse_points,
+                                                                       args.refine_iters,
+                                                                       tolerance=args.icp_tolerance)
+                rotation_ba_pred = rotation_ab_pred.transpose(2, 1).contiguous()
+                translation_ba_pred = -torch.matmul(rotation_ba_pred, translation_ab_pred.unsqueeze(2)).squeeze(2)
+            else:
+                rotation_ab_pred, translation_ab_pred, rotation_ba_pred, translation_ba_pred = net(src, target)
+                if args.icp_iters > 0:
+                    rotation_ab_pred, translation_ab_pred, info = icp_refine(
+                        src, target, rotation_ab_pred, translation_ab_pred, args.icp_iters, args.icp_tolerance)
+                    rotation_ba_pred = rotation_ab_pred.transpose(2, 1).contiguous()
+                    translation_ba_pred = -torch.matmul(rotation_ba_pred,
+                                                        translation_ab_pred.unsqueeze(2)).squeeze(2)
+                    icp_iterations.append(info['iterations'])
+                    icp_time_ms.append(info['time_ms'])
+            loss, cycle_loss, rotation_loss, translation_loss = compute_loss(
+                args, rotation_ab_pred, translation_ab_pred, rotation_ba_pred, translation_ba_pred,
+                rotation_ab, translation_ab)
+
+            evaluator.update(src, target, rotation_ab, translation_ab, rotation_ba, translation_ba, euler_ab, euler_ba,
+                             rotation_ab_pred, translation_ab_pred, rotation_ba_pred, translation_ba_pred,
+                             loss=loss, cycle_loss=cycle_loss * 0.1,
+                             rotation_loss=rotation_loss, translation_loss=translation_loss)
+
+    if icp_iterations and is_main_process():
+        per_iteration = [np.mean([times[i] for times in icp_time_ms if len(times) > i])
+                         for i in range(max(icp_iterations))]
+        print('ICP: %.2f iterations per batch, ms per iteration: %s'
+              % (np.mean(icp_iterations), ', '.join('%.2f' % ms for ms in per_iteration)))
+    return evaluator.summary()
+
+
+def train_one_epoch(args, net, train_loader, opt, logger=None, epoch=0):
     net.train()
-
-    mse_ab = 0
-    mae_ab = 0
-    mse_ba = 0
-    mae_ba = 0
-
-    total_loss = 0
-    total_cycle_loss = 0
-    total_translation_loss = 0
-    total_rotation_loss = 0
-    num_examples = 0
-    rotations_ab = []
-    translations_ab = []
-    rotations_ab_pred = []
-    translations_ab_pred = []
-
-    rotations_ba = []
-    translations_ba = []
-    rotations_ba_pred = []
-    translations_ba_pred = []
-
-    eulers_ab = []
-    eulers_ba = []
-
-    for src, target, rotation_ab, translation_ab, rotation_ba, translation_ba, euler_ab, euler_ba in tqdm(train_loader):
-        src = src.cuda()
-        target = target.cuda()
-        rotation_ab = rotation_ab.cuda()
-        translation_ab = translation_ab.cuda()
-        rotation_ba = rotation_ba.cuda()
-        translation_ba = translation_ba.cuda()
+    evaluator = RegistrationEvaluator(distributed=args.distributed)
+    step_acc = MetricAccumulator()
+    step = epoch * len(train_loader)
+
+    for i, (src, target, rotation_ab, translation_ab, rotation_ba, translation_ba, euler_ab, euler_ba) in \
+            enumerate(tqdm(train_loader)):
+        src = src.to(args.device, non_blocking=True)
+        target = target.to(args.device, non_blocking=True)
+        rotation_ab = rotation_ab.to(args.device, non_blocking=True)
+        translation_ab = translation_ab.to(args.device, non_blocking=True)
+        rotation_ba = rotation_ba.to(args.device, non_blocking=True)
+        translation_ba = translation_ba.to(args.device, non_blocking=True)
+        euler_ab = euler_ab.to(args.device, non_blocking=True)
+        euler_ba = euler_ba.to(args.device, non_blocking=True)
 
         batch_size = src.size(0)
-        opt.zero_grad()
-        num_examples += batch_size
-        rotation_ab_pred, translation_ab_pred, rotation_ba_pred, translation_ba_pred = net(src, target)
-
-        ## save rotation and translation
-        rotations_ab.append(rotation_ab.detach().cpu().numpy())
-        translations_ab.append(translation_ab.detach().cpu().numpy())
-        rotations_ab_pred.append(rotation_ab_pred.detach().cpu().numpy())
-        translations_ab_pred.append(translation_ab_pred.detach().cpu().numpy())
-        eulers_ab.append(euler_ab.numpy())
-        ##
-        rotations_ba.append(rotation_ba.detach().cpu().numpy())
-        translations_ba.append(translation_ba.detach().cpu().numpy())
-        rotations_ba_pred.append(rotation_ba_pred.detach().cpu().numpy())
-        translations_ba_pred.append(translation_ba_pred.detach().cpu().numpy())
-        eulers_ba.append(euler_ba.numpy())
-
-        transformed_src = transform_point_cloud(src, rotation_ab_pred, translation_ab_pred)
-
-        transformed_target = transform_point_cloud(target, rotation_ba_pred, translation_ba_pred)
-        ###########################
-        identity = torch.eye(3).cuda().unsqueeze(0).repeat(batch_size, 1, 1)
-        rotation_loss = F.mse_loss(torch.matmul(rotation_ab_pred.transpose(2, 1), rotation_ab), identity)
-        translation_loss = F.mse_loss(translation_ab_pred, translation_ab) 
-        loss = rotation_loss + translation_loss
-        if args.cycle:
-            rotation_loss = F.mse_loss(torch.matmul(rotation_ba_pred, rotation_ab_pred), identity.clone())
-            translation_loss = torch.mean((torch.matmul(rotation_ba_pred.transpose(2, 1),
-                                                        translation_ab_pred.view(batch_size, 3, 1)).view(batch_size, 3)
-                                           + translation_ba_pred) ** 2, dim=[0, 1])
-            cycle_loss = rotation_loss + translation_loss
-
-            loss = loss + cycle_loss * 0.1
-
-        loss.backward()
-        opt.step()
-        total_loss += loss.item() * batch_size
-        total_rotation_loss += rotation_loss.item() * batch_size
-        total_translation_loss += translation_loss.item() * batch_size
-        if args.cycle:
-            total_cycle_loss = total_cycle_loss + cycle_loss.item() * 0.1 * batch_size
-
-        mse_ab += torch.mean((transformed_src - target) ** 2, dim=[0, 1, 2]).item() * batch_size
-        mae_ab += torch.mean(torch.abs(transformed_src - target), dim=[0, 1, 2]).item() * batch_size
-
-        mse_ba += torch.mean((transformed_target - src) ** 2, dim=[0, 1, 2]).item() * batch_size
-        mae_ba += torch.mean(torch.abs(transformed_target - src), dim=[0, 1, 2]).item() * batch_size
-
-    rotations_ab = np.concatenate(rotations_ab, axis=0)
-    translations_ab = np.concatenate(translations_ab, axis=0)
-    rotations_ab_pred = np.concatenate(rotations_ab_pred, axis=0)
-    translations_ab_pred = np.concatenate(translations_ab_pred, axis=0)
-
-    rotations_ba = np.concatenate(rotations_ba, axis=0)
-    translations_ba = np.concatenate(translations_ba, axis=0)
-    rotations_ba_pred = np.concatenate(rotations_ba_pred, axis=0)
-    translations_ba_pred = np.concatenate(translations_ba_pred, axis=0)
-
-    eulers_ab = np.concatenate(eulers_ab, axis=0)
-    eulers_ba = np.concatenate(eulers_ba, axis=0)
-
-    return total_loss * 1.0 / num_examples, total_cycle_loss / num_examples, \
-           total_rotation_loss * 1.0 / num_examples, total_translation_loss * 1.0 / num_examples, \
-           mse_ab * 1.0 / num_examples, mae_ab * 1.0 / num_examples, \
-           mse_ba * 1.0 / num_examples, mae_ba * 1.0 / num_examples, rotations_ab, \
-           translations_ab, rotations_ab_pred, translations_ab_pred, rotations_ba, \
-           translations_ba, rotations_ba_pred, translations_ba_pred, eulers_ab, eulers_ba
-
-
-def test(args, net, test_loader, boardio, textio):
-
-    test_loss, test_cycle_loss, \
-    test_mse_ab, test_mae_ab, test_mse_ba, test_mae_ba, test_rotations_ab, test_translations_ab, \
-    test_rotations_ab_pred, \
-    test_translations_ab_pred, test_rotations_ba, test_translations_ba, test_rotations_ba_pred, \
-    test_translations_ba_pred, test_eulers_ab, test_eulers_ba = test_one_epoch(args, net, test_loader)
-    test_rmse_ab = np.sqrt(test_mse_ab)
-    test_rmse_ba = np.sqrt(test_mse_ba)
-
-    test_rotations_ab_pred_euler = npmat2euler(test_rotations_ab_pred)
-    test_r_mse_ab = np.mean((test_rotations_ab_pred_euler - np.degrees(test_eulers_ab)) ** 2)
-    test_r_rmse_ab = np.sqrt(test_r_mse_ab)
-    test_r_mae_ab = np.mean(np.abs(test_rotations_ab_pred_euler - np.degrees(test_eulers_ab)))
-    test_t_mse_ab = np.mean((test_translations_ab - test_translations_ab_pred) ** 2)
-    test_t_rmse_ab = np.sqrt(test_t_mse_ab)
-    test_t_mae_ab = np.mean(np.abs(test_translations_ab - test_translations_ab_pred))
-
-    test_rotations_ba_pred_euler = npmat2euler(test_rotations_ba_pred, 'xyz')
-    test_r_mse_ba = np.mean((test_rotations_ba_pred_euler - np.degrees(test_eulers_ba)) ** 2)
-    test_r_rmse_ba = np.sqrt(test_r_mse_ba)
-    test_r_mae_ba = np.mean(np.abs(test_rotations_ba_pred_euler - np.degrees(test_eulers_ba)))
-    test_t_mse_ba = np.mean((test_translations_ba - test_translations_ba_pred) ** 2)
-    test_t_rmse_ba = np.sqrt(test_t_mse_ba)
-    test_t_mae_ba = np.mean(np.abs(test_translations_ba - test_translations_ba_pred))
-
-    textio.cprint('==FINAL TEST==')
+        if i % args.accumulation_steps == 0:
+            opt.zero_grad()
+            # the last group of an epoch can hold fewer micro-batches
+            group_size = min(args.accumulation_steps, len(train_loader) - i)
+        sync = (i + 1) % args.accumulation_steps == 0 or i + 1 == len(train_loader)
+        with accumulation_context(net, args, sync):
+            rotation_ab_pred, translation_ab_pred, rotation_ba_pred, translation_ba_pred = net(src, target)
+            loss, cycle_loss, rotation_loss, translation_loss = compute_loss(
+                args, rotation_ab_pred, translation_ab_pred, rotation_ba_pred, translation_ba_pred,
+                rotation_ab, translation_ab)
+
+            (loss / group_size).backward()
+        if sync:
+            opt.step()
+        step += 1
+        losses = dict(loss=loss, cycle_loss=cycle_loss * 0.1,
+                      rotation_loss=rotation_loss, translation_loss=translation_loss)
+        evaluator.update(src, target, rotation_ab, translation_ab, rotation_ba, translation_ba, euler_ab, euler_ba,
+                         rotation_ab_pred, translation_ab_pred, rotation_ba_pred, translation_ba_pred, **losses)
+        if logger is not None:
+            step_acc.update(batch_size, **losses)
+            if step % args.log_interval == 0:
+                logger.log('train', epoch, step=step, **step_acc.sync())
+                step_acc.reset()
+
+    return evaluator.summary()
+
+
+def print_stats(textio, title, epoch, stats):
+    if textio is None:
+        return
+    textio.cprint(title)
     textio.cprint('A--------->B')
     textio.cprint('EPOCH:: %d, Loss: %f, Cycle Loss: %f, MSE: %f, RMSE: %f, MAE: %f, rot_MSE: %f, rot_RMSE: %f, '
                   'rot_MAE: %f, trans_MSE: %f, trans_RMSE: %f, trans_MAE: %f'
-                  % (-1, test_loss, test_cycle_loss, test_mse_ab, test_rmse_ab, test_mae_ab,
-                     test_r_mse_ab, test_r_rmse_ab,
-                     test_r_mae_ab, test_t_mse_ab, test_t_rmse_ab, test_t_mae_ab))
+                  % (epoch, stats['loss'], stats['cycle_loss'], stats['mse_ab'], stats['rmse_ab'], stats['mae_ab'],
+                     stats['rot_mse_ab'], stats['rot_rmse_ab'], stats['rot_mae_ab'],
+                     stats['trans_mse_ab'], stats['trans_rmse_ab'], stats['trans_mae_ab']))
     textio.cprint('B--------->A')
     textio.cprint('EPOCH:: %d, Loss: %f, MSE: %f, RMSE: %f, MAE: %f, rot_MSE: %f, rot_RMSE: %f, '
                   'rot_MAE: %f, trans_MSE: %f, trans_RMSE: %f, trans_MAE: %f'
-                  % (-1, test_loss, test_mse_ba, test_rmse_ba, test_mae_ba, test_r_mse_ba, test_r_rmse_ba,
-                     test_r_mae_ba, test_t_mse_ba, test_t_rmse_ba, test_t_mae_ba))
+                  % (epoch, stats['loss'], stats['mse_ba'], stats['rmse_ba'], stats['mae_ba'],
+                     stats['rot_mse_ba'], stats['rot_rmse_ba'], stats['rot_mae_ba'],
+                     stats['trans_mse_ba'], stats['trans_rmse_ba'], stats['trans_mae_ba']))
+
+
+def test(args, net, test_loader, boardio, textio):
+    test_stats = test_one_epoch(args, net, test_loader, args.eval_dump or None)
+    print_stats(textio, '==FINAL TEST==', -1, test_stats)
 
 
 def train(args, net, train_loader, test_loader, boardio, textio):
@@ -300,201 +181,40 @@ def train(args, net, train_loader, test_loader, boardio, textio):
         opt = optim.Adam(net.parameters(), lr=args.lr, weight_decay=1e-4)
     scheduler = MultiStepLR(opt, milestones=[75, 150, 200], gamma=0.1)
 
+    best_test_stats = None
+    logger = None
+    if is_main_process():
+        logger = MetricLogger('checkpoints/' + args.exp_name + '/metrics.jsonl', writer=boardio)
 
-    best_test_loss = np.inf
-    best_test_cycle_loss = np.inf
-    best_test_mse_ab = np.inf
-    best_test_rmse_ab = np.inf
-    best_test_mae_ab = np.inf
-
-    best_test_r_mse_ab = np.inf
-    best_test_r_rmse_ab = np.inf
-    best_test_r_mae_ab = np.inf
-    best_test_t_mse_ab = np.inf
-    best_test_t_rmse_ab = np.inf
-    best_test_t_mae_ab = np.inf
-
-    best_test_mse_ba = np.inf
-    best_test_rmse_ba = np.inf
-    best_test_mae_ba = np.inf
-
-    best_test_r_mse_ba = np.inf
-    best_test_r_rmse_ba = np.inf
-    best_test_r_mae_ba = np.inf
-    best_test_t_mse_ba = np.inf
-    best_test_t_rmse_ba = np.inf
-    best_test_t_mae_ba = np.inf
-
-    train_loss_list = []
-    train_rotation_loss_list = []
-    train_translation_loss_list = []
-    test_loss_list = []
-    test_rotation_loss_list = []
-    test_translation_loss_list = []    
-
+    profiler = profiling.enable() if args.profile_stages else None
     for epoch in range(args.epochs):
-        
-        train_loss, train_cycle_loss, \
-        train_rotation_loss, train_translation_loss,\
-        train_mse_ab, train_mae_ab, train_mse_ba, train_mae_ba, train_rotations_ab, train_translations_ab, \
-        train_rotations_ab_pred, \
-        train_translations_ab_pred, train_rotations_ba, train_translations_ba, train_rotations_ba_pred, \
-        train_translations_ba_pred, train_eulers_ab, train_eulers_ba = train_one_epoch(args, net, train_loader, opt)
-
-        test_loss, test_cycle_loss, \
-        test_rotation_loss, test_translation_loss,\
-        test_mse_ab, test_mae_ab, test_mse_ba, test_mae_ba, test_rotations_ab, test_translations_ab, \
-        test_rotations_ab_pred, \
-        test_translations_ab_pred, test_rotations_ba, test_translations_ba, test_rotations_ba_pred, \
-        test_translations_ba_pred, test_eulers_ab, test_eulers_ba = test_one_epoch(args, net, test_loader)
-
-        train_rmse_ab = np.sqrt(train_mse_ab)
-        test_rmse_ab = np.sqrt(test_mse_ab)
-
-        train_rmse_ba = np.sqrt(train_mse_ba)
-        test_rmse_ba = np.sqrt(test_mse_ba)
-
-        train_rotations_ab_pred_euler = npmat2euler(train_rotations_ab_pred)
-        train_r_mse_ab = np.mean((train_rotations_ab_pred_euler - np.degrees(train_eulers_ab)) ** 2)
-        train_r_rmse_ab = np.sqrt(train_r_mse_ab)  #1
-        train_r_mae_ab = np.mean(np.abs(train_rotations_ab_pred_euler - np.degrees(train_eulers_ab)))
-        train_t_mse_ab = np.mean((train_translations_ab - train_translations_ab_pred) ** 2)
-        train_t_rmse_ab = np.sqrt(train_t_mse_ab)  # 2
-        train_t_mae_ab = np.mean(np.abs(train_translations_ab - train_translations_ab_pred))
-
-        train_rotations_ba_pred_euler = npmat2euler(train_rotations_ba_pred, 'xyz')
-        train_r_mse_ba = np.mean((train_rotations_ba_pred_euler - np.degrees(train_eulers_ba)) ** 2)
-        train_r_rmse_ba = np.sqrt(train_r_mse_ba)
-        train_r_mae_ba = np.mean(np.abs(train_rotations_ba_pred_euler - np.degrees(train_eulers_ba)))
-        train_t_mse_ba = np.mean((train_translations_ba - train_translations_ba_pred) ** 2)
-        train_t_rmse_ba = np.sqrt(train_t_mse_ba)
-        train_t_mae_ba = np.mean(np.abs(train_translations_ba - train_translations_ba_pred))
-
-        test_rotations_ab_pred_euler = npmat2euler(test_rotations_ab_pred)
-        test_r_mse_ab = np.mean((test_rotations_ab_pred_euler - np.degrees(test_eulers_ab)) ** 2)
-        test_r_rmse_ab = np.sqrt(test_r_mse_ab)  #3
-        test_r_mae_ab = np.mean(np.abs(test_rotations_ab_pred_euler - np.degrees(test_eulers_ab)))
-        test_t_mse_ab = np.mean((test_translations_ab - test_translations_ab_pred) ** 2)
-        test_t_rmse_ab = np.sqrt(test_t_mse_ab)  #4
-        test_t_mae_ab = np.mean(np.abs(test_translations_ab - test_translations_ab_pred))
-
-        test_rotations_ba_pred_euler = npmat2euler(test_rotations_ba_pred, 'xyz')
-        test_r_mse_ba = np.mean((test_rotations_ba_pred_euler - np.degrees(test_eulers_ba)) ** 2)
-        test_r_rmse_ba = np.sqrt(test_r_mse_ba)
-        test_r_mae_ba = np.mean(np.abs(test_rotations_ba_pred_euler - np.degrees(test_eulers_ba)))
-        test_t_mse_ba = np.mean((test_translations_ba - test_translations_ba_pred) ** 2)
-        test_t_rmse_ba = np.sqrt(test_t_mse_ba)
-        test_t_mae_ba = np.mean(np.abs(test_translations_ba - test_translations_ba_pred))
-
-        train_loss_list.append(train_loss)
-        train_rotation_loss_list.append(train_rotation_loss)
-        train_translation_loss_list.append(train_translation_loss)
-        test_loss_list.append(test_loss)
-        test_rotation_loss_list.append(test_rotation_loss)
-        test_translation_loss_list.append(test_translation_loss)  
-
-        if best_test_loss >= test_loss:
-            best_test_loss = test_loss
-            best_test_cycle_loss = test_cycle_loss
-
-            best_test_mse_ab = test_mse_ab
-            best_test_rmse_ab = test_rmse_ab
-            best_test_mae_ab = test_mae_ab
-
-            best_test_r_mse_ab = test_r_mse_ab
-            best_test_r_rmse_ab = test_r_rmse_ab
-            best_test_r_mae_ab = test_r_mae_ab
-
-            best_test_t_mse_ab = test_t_mse_ab
-            best_test_t_rmse_ab = test_t_rmse_ab
-            best_test_t_mae_ab = test_t_mae_ab
-
-            best_test_mse_ba = test_mse_ba
-            best_test_rmse_ba = test_rmse_ba
-            best_test_mae_ba = test_mae_ba
-
-            best_test_r_mse_ba = test_r_mse_ba
-            best_test_r_rmse_ba = test_r_rmse_ba
-            best_test_r_mae_ba = test_r_mae_ba
-
-            best_test_t_mse_ba = test_t_mse_ba
-            best_test_t_rmse_ba = test_t_rmse_ba
-            best_test_t_mae_ba = test_t_mae_ba
-
-            if torch.cuda.device_count() > 1:
-                torch.save(net.module.state_dict(), 'checkpoints/%s/models/model.best.t7' % args.exp_name)
-            else:
-                torch.save(net.state_dict(), 'checkpoints/%s/models/model.best.t7' % args.exp_name)
-
-        textio.cprint('==TRAIN==')
-        textio.cprint('A--------->B')
-        textio.cprint('EPOCH:: %d, Loss: %f, Cycle Loss:, %f, MSE: %f, RMSE: %f, MAE: %f, rot_MSE: %f, rot_RMSE: %f, '
-                      'rot_MAE: %f, trans_MSE: %f, trans_RMSE: %f, trans_MAE: %f'
-                      % (epoch, train_loss, train_cycle_loss, train_mse_ab, train_rmse_ab, train_mae_ab, train_r_mse_ab,
-                         train_r_rmse_ab, train_r_mae_ab, train_t_mse_ab, train_t_rmse_ab, train_t_mae_ab))
-        textio.cprint('B--------->A')
-        textio.cprint('EPOCH:: %d, Loss: %f, MSE: %f, RMSE: %f, MAE: %f, rot_MSE: %f, rot_RMSE: %f, '
-                      'rot_MAE: %f, trans_MSE: %f, trans_RMSE: %f, trans_MAE: %f'
-                      % (epoch, train_loss, train_mse_ba, train_rmse_ba, train_mae_ba, train_r_mse_ba, train_r_rmse_ba,
-                         train_r_mae_ba, train_t_mse_ba, train_t_rmse_ba, train_t_mae_ba))
-
-        textio.cprint('==TEST==')
-        textio.cprint('A--------->B')
-        textio.cprint('EPOCH:: %d, Loss: %f, Cycle Loss: %f, MSE: %f, RMSE: %f, MAE: %f, rot_MSE: %f, rot_RMSE: %f, '
-                      'rot_MAE: %f, trans_MSE: %f, trans_RMSE: %f, trans_MAE: %f'
-                      % (epoch, test_loss, test_cycle_loss, test_mse_ab, test_rmse_ab, test_mae_ab, test_r_mse_ab,
-                         test_r_rmse_ab, test_r_mae_ab, test_t_mse_ab, test_t_rmse_ab, test_t_mae_ab))
-        textio.cprint('B--------->A')
-        textio.cprint('EPOCH:: %d, Loss: %f, MSE: %f, RMSE: %f, MAE: %f, rot_MSE: %f, rot_RMSE: %f, '
-                      'rot_MAE: %f, trans_MSE: %f, trans_RMSE: %f, trans_MAE: %f'
-                      % (epoch, test_loss, test_mse_ba, test_rmse_ba, test_mae_ba, test_r_mse_ba, test_r_rmse_ba,
-                         test_r_mae_ba, test_t_mse_ba, test_t_rmse_ba, test_t_mae_ba))
-
-        textio.cprint('==BEST TEST==')
-        textio.cprint('A--------->B')
-        textio.cprint('EPOCH:: %d, Loss: %f, Cycle Loss: %f, MSE: %f, RMSE: %f, MAE: %f, rot_MSE: %f, rot_RMSE: %f, '
-                      'rot_MAE: %f, trans_MSE: %f, trans_RMSE: %f, trans_MAE: %f'
-                      % (epoch, best_test_loss, best_test_cycle_loss, best_test_mse_ab, best_test_rmse_ab,
-                         best_test_mae_ab, best_test_r_mse_ab, best_test_r_rmse_ab,
-                         best_test_r_mae_ab, best_test_t_mse_ab, best_test_t_rmse_ab, best_test_t_mae_ab))
-        textio.cprint('B--------->A')
-        textio.cprint('EPOCH:: %d, Loss: %f, MSE: %f, RMSE: %f, MAE: %f, rot_MSE: %f, rot_RMSE: %f, '
-                      'rot_MAE: %f, trans_MSE: %f, trans_RMSE: %f, trans_MAE: %f'
-                      % (epoch, best_test_loss, best_test_mse_ba, best_test_rmse_ba, best_test_mae_ba,
-                         best_test_r_mse_ba, best_test_r_rmse_ba,
-                         best_test_r_mae_ba, best_test_t_mse_ba, best_test_t_rmse_ba, best_test_t_mae_ba))
-        if torch.cuda.device_count() > 1:
-            torch.save(net.module.state_dict(), 'checkpoints/%s/models/model.%d.t7' % (args.exp_name, epoch))
-        else:
-            torch.save(net.state_dict(), 'checkpoints/%s/models/model.%d.t7' % (args.exp_name, epoch))
+        set_loader_epoch(train_loader, epoch)
+        train_stats = train_one_epoch(args, net, train_loader, opt, logger, epoch)
+        if profiler is not None:
+            if is_main_process():
+                textio.cprint(profiler.format())
+                profiler.export('checkpoints/' + args.exp_name + '/stages.jsonl', epoch)
+            profiler.reset()
+        test_stats = test_one_epoch(args, net, test_loader)
         gc.collect()
         scheduler.step()
+        if not is_main_process():
+            continue
+        logger.log('train', epoch, **train_stats)
+        logger.log('test', epoch, **test_stats)
+
+        if best_test_stats is None or best_test_stats['loss'] >= test_stats['loss']:
+            best_test_stats = test_stats
+            torch.save(unwrap_model(net).state_dict(), 'checkpoints/%s/models/model.best.t7' % args.exp_name)
+
+        print_stats(textio, '==TRAIN==', epoch, train_stats)
+        print_stats(textio, '==TEST==', epoch, test_stats)
+        print_stats(textio, '==BEST TEST==', epoch, best_test_stats)
+        torch.save(unwrap_model(net).state_dict(), 'checkpoints/%s/models/model.%d.t7' % (args.exp_name, epoch))
+
+    if logger is not None:
+        logger.close()
 
-        save_loss([train_loss_list, train_rotation_loss_list, train_translation_loss_list],
-                    [test_loss_list, test_rotation_loss_list, test_translation_loss_list], 
-                    epoch + 1)
-
-def save_loss(train_list, test_list, epoch):
-    h = len(train_list)
-    fig = plt.figure(figsize=(20, 15))
-    loss_name = ["total loss", "rotation_loss", "translation_loss"]
-    for i in range(h):
-        ax = fig.add_subplot(h,2, 2 * i + 1)
-        ax.plot(range(epoch), train_list[i])
-        ax.set_title(loss_name[i] + ' for training')
-        ax.set_xlabel("epoch")
-        ax.set_ylabel("loss")
-    for i in range(h):
-        ax = fig.add_subplot(h,2, 2 * i + 2)
-        ax.plot(range(epoch), test_list[i])
-        ax.set_title(loss_name[i] + ' for testing')   
-        ax.set_xlabel("epoch")     
-        ax.set_ylabel("loss")
-    # Save the full figure...
-    if os.path.exists('Loss_reg.jpg'):
-        os.remove('Loss_reg.jpg')
-    fig.savefig('Loss_reg.jpg')
-    plt.close()
 
 def main():
     parser = argparse.ArgumentParser(description='Point Cloud Registration')
@@ -558,39 +278,88 @@ def main():
                         help='Num of nearest neighbors to use')
     parser.add_argument('--pre_model_path', type=str, default='', metavar='N',
                         help='Pretrained DGCNN path')
+    parser.add_argument('--log_interval', type=int, default=50, metavar='N',
+                        help='Log per-step losses every N steps')
+    parser.add_argument('--eval_dump', type=str, default='', metavar='N',
+                        help='Write per-sample test predictions to this .npy file (memory-mapped)')
+    parser.add_argument('--synthetic', type=int, default=0, metavar='N',
+                        help='Train on N random shapes instead of data_raw, the pretrained DGCNN is then optional '
+                             '(0: off)')
+    parser.add_argument('--profile_stages', action='store_true', default=False,
+                        help='Time the named forward stages and print/export a table per training epoch')
+    parser.add_argument('--coarse_points', type=int, default=0, metavar='N',
+                        help='Test coarse-to-fine: run the network on this many farthest point samples '
+                             'and refine on the full cloud (0: off)')
+    parser.add_argument('--refine_iters', type=int, default=1, metavar='N',
+                        help='Nearest-neighbour refinement steps of --coarse_points')
+    parser.add_argument('--icp_iters', type=int, default=0, metavar='N',
+                        help='Test: refine the network pose with at most N ICP iterations (0: off)')
+    parser.add_argument('--icp_tolerance', type=float, default=1e-6,
+                        help='Stop refining a pair once its mean nearest-neighbour distance changes by less than this')
+    add_loader_args(parser, num_workers=0)
+    add_sampling_args(parser)
+    add_memory_args(parser)
+    parser.add_argument('--distributed', action='store_true', default=False,
+                        help='DistributedDataParallel training, launch with torchrun')
+    parser.add_argument('--dist_backend', type=str, default='', metavar='N',
+                        help='Process group backend, default nccl on GPU and gloo on CPU')
 
     args = parser.parse_args()
+    if args.eval_dump and args.distributed:
+        parser.error('--eval_dump is single process only, run the test without --distributed')
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
     torch.backends.cudnn.deterministic = True
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed_all(args.seed)
     np.random.seed(args.seed)
 
-    boardio = SummaryWriter(log_dir='checkpoints/' + args.exp_name)
-    _init_(args)
-
-    textio = IOStream('checkpoints/' + args.exp_name + '/run.log')
-    textio.cprint(str(args))
-
-    if args.dataset == 'modelnet40':
-        train_loader = DataLoader(
-            ModelNet40(num_points=args.num_points, partition='train', gaussian_noise=args.gaussian_noise,
-                       unseen=args.unseen, factor=args.factor),
-            batch_size=args.batch_size, shuffle=True, drop_last=True)
-        test_loader = DataLoader(
-            ModelNet40(num_points=args.num_points, partition='test', gaussian_noise=args.gaussian_noise,
-                       unseen=args.unseen, factor=args.factor),
-            batch_size=args.test_batch_size, shuffle=False, drop_last=False)
+    if args.distributed:
+        args.device = init_distributed(args)
+    else:
+        args.device = torch.device('cuda' if args.cuda else 'cpu')
+    if args.memory_budget > 0:
+        # args.batch_size stays the effective batch, the loader gets the micro-batch
+        auto_batch(args, 'reg', args.device)
+
+    boardio = None
+    textio = None
+    if is_main_process():
+        boardio = SummaryWriter(log_dir='checkpoints/' + args.exp_name)
+        _init_(args)
+
+        textio = IOStream('checkpoints/' + args.exp_name + '/run.log')
+        textio.cprint(str(args))
+
+    if args.synthetic > 0:
+        train_set = SyntheticModelNet40(args.num_points, 'train', args.gaussian_noise, args.factor, args.synthetic,
+                                        args.seed)
+        test_set = SyntheticModelNet40(args.num_points, 'test', args.gaussian_noise, args.factor,
+                                       max(args.synthetic // 4, 1), args.seed)
+    elif args.dataset == 'modelnet40':
+        train_set = ModelNet40(num_points=args.num_points, partition='train', gaussian_noise=args.gaussian_noise,
+                               unseen=args.unseen, factor=args.factor,
+                               sampling=args.sampling, voxel_size=args.voxel_size)
+        test_set = ModelNet40(num_points=args.num_points, partition='test', gaussian_noise=args.gaussian_noise,
+                              unseen=args.unseen, factor=args.factor,
+                              sampling=args.sampling, voxel_size=args.voxel_size)
     else:
         raise Exception("not implemented")
-
-    net = RegModel(args).cuda()
+    train_sampler = DistributedSampler(train_set, shuffle=True) if args.distributed else None
+    test_sampler = DistributedSampler(test_set, shuffle=False) if args.distributed else None
+    train_loader = build_loader(train_set, args, args.batch_size, shuffle=True, drop_last=True,
+                                sampler=train_sampler)
+    test_loader = build_loader(test_set, args, args.test_batch_size, shuffle=False, drop_last=False,
+                               sampler=test_sampler)
+
+    net = RegModel(args).to(args.device)
     # ximin
-    pre_model_dict = torch.load(args.pre_model_path)
-    # print(pre_model_dict['DGCNN_state_dict'].keys())
-    # del_keys = ["linear1.weight", "bn6.weight", "bn6.bias", "bn6.running_mean", "bn6.running_var", "bn6.num_batches_tracked", "linear2.weight", "linear2.bias", "bn7.weight", "bn7.bias", "bn7.running_mean", "bn7.running_var", "bn7.num_batches_tracked", "linear3.weight", "linear3.bias"]
-    # for key in del_keys:
-    #     del pre_model_dict[key]
-    net.emb_nn.load_state_dict(pre_model_dict['DGCNN_state_dict'])
+    if args.pre_model_path or not args.synthetic:
+        pre_model_dict = torch.load(args.pre_model_path, map_location=args.device)
+        # print(pre_model_dict['DGCNN_state_dict'].keys())
+        # del_keys = ["linear1.weight", "bn6.weight", "bn6.bias", "bn6.running_mean", "bn6.running_var", "bn6.num_batches_tracked", "linear2.weight", "linear2.bias", "bn7.weight", "bn7.bias", "bn7.running_mean", "bn7.running_var", "bn7.num_batches_tracked", "linear3.weight", "linear3.bias"]
+        # for key in del_keys:
+        #     del pre_model_dict[key]
+        net.emb_nn.load_state_dict(pre_model_dict['DGCNN_state_dict'])
 
     if args.eval:
         if args.model_path == '':
@@ -602,10 +371,8 @@ def main():
             print("can't find pretrained model")
             return
 
-        net.load_state_dict(torch.load(model_path), strict=False)
-    if torch.cuda.device_count() > 1:
-        net = nn.DataParallel(net)
-        print("Let's use", torch.cuda.device_count(), "GPUs!")
+        net.load_state_dict(torch.load(model_path, map_location=args.device), strict=False)
+    net = wrap_model(net, args)
 
     if args.eval:
         test(args, net, test_loader, boardio, textio)
@@ -614,7 +381,9 @@ def main():
 
 
     print('FINISH')
-    boardio.close()
+    if boardio is not None:
+        boardio.close()
+    cleanup()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Coarse-to-fine registration: estimate (R, t) with the network on a farthest
+point sampled subset, then refine it on the full clouds with nearest-neighbour
+correspondences and the batched Kabsch solve. icp_refine is the same loop as
+a post-stage for any (R, t) prediction, until convergence.
+"""
+
+
+import os
+import sys
+import time
+import torch
+from util import kabsch, transform_point_cloud
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sampling import farthest_point_sample, gather_points
+
+
+def nearest_neighbor(src, dst, block_size=4096):
+    """
+    Batched _model.nearest_neighbor: squared distances and indices (b*n) of the
+    closest dst point (b*3*m) to every src point (b*3*n). The n*m distance
+    matrix is built block_size source points at a time.
+    """
+    dst_sq = (dst ** 2).sum(dim=1, keepdim=True)
+    distances, indices = [], []
+    for start in range(0, src.size(2), block_size):
+        block = src[:, :, start:start + block_size]
+        inner = -2 * torch.matmul(block.transpose(2, 1).contiguous(), dst)
+        pairwise = (block ** 2).sum(dim=1).unsqueeze(2) + inner + dst_sq
+        distance, index = pairwise.min(dim=2)
+        distances.append(distance.clamp(min=0))
+        indices.append(index)
+    return torch.cat(distances, dim=1), torch.cat(indices, dim=1)
+
+
+def icp_refine(src, tgt, rotation_ab, translation_ab, max_iterations=10, tolerance=1e-6, block_size=4096):
+    """
+    Batched ICP from an initial (R_ab, t_ab): nearest-neighbour correspondences
+    of the moved source, then a Kabsch solve, for at most max_iterations. A pair
+    stops once its mean nearest-neighbour distance changes by less than
+    tolerance; later iterations only process the pairs still moving. Returns
+    R_ab, t_ab and per-iteration 'time_ms' and 'error' (mean distance of the
+    active pairs) plus the number of 'iterations' run.
+    """
+    batch_size = src.size(0)
+    active = torch.arange(batch_size, device=src.device)
+    previous = torch.full((batch_size,), float('inf'), device=src.device)
+    info = {'iterations': 0, 'time_ms': [], 'error': []}
+    for _ in range(max_iterations):
+        start = time.perf_counter()
+        src_active, tgt_active = src[active], tgt[active]
+        moved = transform_point_cloud(src_active, rotation_ab[active], translation_ab[active])
+        distances, idx = nearest_neighbor(moved, tgt_active, block_size)
+        rotation, translation = kabsch(src_active, gather_points(tgt_active, idx))
+        rotation_ab = rotation_ab.index_copy(0, active, rotation)
+        translation_ab = translation_ab.index_copy(0, active, translation)
+        error = distances.sqrt().mean(dim=1)
+        moving = (previous[active] - error).abs() >= tolerance
+        previous = previous.index_copy(0, active, error)
+        info['error'].append(error.mean().item())
+        info['time_ms'].append((time.perf_counter() - start) * 1000)
+        info['iterations'] += 1
+        active = active[moving]
+        if active.numel() == 0:
+            break
+    return rotation_ab, translation_ab, info
+
+
+def refine(src, tgt, rotation_ab, translation_ab, iterations=1, block_size=4096, tolerance=0.0):
+    """icp_refine for a fixed number of iterations (or until tolerance), without the timing info."""
+    return icp_refine(src, tgt, rotation_ab, translation_ab, iterations, tolerance, block_size)[:2]
+
+
+def coarse_to_fine(net, src, tgt, num_coarse=512, iterations=1, block_size=4096, tolerance=0.0):
+    """
+    (R_ab, t_ab) of net (RegModel or DCP) run on num_coarse farthest point
+    samples of each cloud, refined on the full clouds.
+    """
+    if src.size(2) > num_coarse:
+        src_coarse = gather_points(src, farthest_point_sample(src, num_coarse))
+    else:
+        src_coarse = src
+    if tgt.size(2) > num_coarse:
+        tgt_coarse = gather_points(tgt, farthest_point_sample(tgt, num_coarse))
+    else:
+        tgt_coarse = tgt
+    rotation_ab, translation_ab = net(src_coarse, tgt_coarse)[:2]
+    return refine(src, tgt, rotation_ab, translation_ab, iterations, block_size, tolerance)
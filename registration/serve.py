@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Registration inference server. Clients send pairs of point clouds over a
+plain TCP socket and get rotation_ab / translation_ab back. Requests that
+arrive together are micro-batched into one RegModel.forward call.
+
+    python serve.py --model_path checkpoints/dcp_v2/models/model.best.t7 --max_batch 16 --max_wait_ms 5
+    python load_gen.py --concurrency 16 --requests 2000
+
+Wire format: every message is a little-endian uint32 length followed by the
+payload. A request payload is REQUEST (op, n_src, n_tgt) followed by the two
+clouds as float32 (n, 3) arrays; the response is RESPONSE (status, R, t).
+OP_STATS returns the server latency/throughput summary as JSON.
+"""
+
+
+import os
+import sys
+import json
+import time
+import struct
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from RegModel import RegModel
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fuse import fuse_for_inference
+from embedding_cache import EmbeddingCache
+from sampling import farthest_point_sample, gather_points
+
+
+FRAME = struct.Struct('<I')
+REQUEST = struct.Struct('<BII')
+RESPONSE = struct.Struct('<B12f')
+OP_REGISTER, OP_STATS = 0, 1
+STATUS_OK, STATUS_ERROR = 0, 1
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(FRAME.size)
+    return await reader.readexactly(FRAME.unpack(header)[0])
+
+
+def write_frame(writer, payload):
+    writer.write(FRAME.pack(len(payload)) + payload)
+
+
+def encode_request(src, tgt):
+    src = np.ascontiguousarray(src, dtype='<f4')
+    tgt = np.ascontiguousarray(tgt, dtype='<f4')
+    return REQUEST.pack(OP_REGISTER, src.shape[0], tgt.shape[0]) + src.tobytes() + tgt.tobytes()
+
+
+def decode_request(payload):
+    op, n_src, n_tgt = REQUEST.unpack_from(payload)
+    if op != OP_REGISTER:
+        return op, None, None
+    expected = REQUEST.size + 12 * (n_src + n_tgt)
+    if len(payload) != expected:
+        raise ValueError('expected %d bytes for %d + %d points, got %d' % (expected, n_src, n_tgt, len(payload)))
+    points = np.frombuffer(payload, dtype='<f4', offset=REQUEST.size).reshape(-1, 3)
+    return op, points[:n_src], points[n_src:]
+
+
+def encode_response(rotation, translation):
+    return RESPONSE.pack(STATUS_OK, *np.concatenate((rotation.ravel(), translation.ravel())).tolist())
+
+
+def encode_error(message):
+    return struct.pack('<B', STATUS_ERROR) + message.encode('utf-8')
+
+
+def decode_response(payload):
+    """(rotation (3, 3), translation (3,)), raises RuntimeError for an error response."""
+    if payload[0] != STATUS_OK:
+        raise RuntimeError(payload[1:].decode('utf-8'))
+    values = np.array(RESPONSE.unpack(payload)[1:], dtype='float32')
+    return values[:9].reshape(3, 3), values[9:]
+
+
+class LatencyStats:
+    """Request latencies over a sliding window plus running throughput and batch size."""
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.batches = 0
+
+    def record_batch(self, latencies):
+        self.latencies.extend(latencies)
+        self.requests += len(latencies)
+        self.batches += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        stats = {'requests': self.requests, 'batches': self.batches,
+                 'throughput': self.requests / elapsed if elapsed > 0 else 0.0,
+                 'mean_batch': self.requests / self.batches if self.batches else 0.0}
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000
+            stats.update(p50_ms=float(np.percentile(latencies, 50)), p99_ms=float(np.percentile(latencies, 99)),
+                         mean_ms=float(latencies.mean()))
+        return stats
+
+
+class MicroBatcher:
+    """
+    Collects queued requests until max_batch of them are waiting or max_wait_ms
+    has passed since the first one, then runs them through the model in a
+    worker thread, one forward per point-count group. With an EmbeddingCache,
+    clouds seen before (e.g. a reference scan registered against many targets)
+    skip the encoder.
+    """
+
+    def __init__(self, net, device, max_batch=16, max_wait_ms=5.0, cache=None, max_points=0):
+        self.net = net
+        self.max_points = max_points
+        self.cache = cache
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = LatencyStats()
+
+    async def submit(self, src, tgt):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((src, tgt, future, time.perf_counter()))
+        return await future
+
+    def forward(self, items):
+        src = torch.from_numpy(np.stack([item[0] for item in items])).to(self.device)
+        tgt = torch.from_numpy(np.stack([item[1] for item in items])).to(self.device)
+        src, tgt = src.transpose(2, 1), tgt.transpose(2, 1)
+        with torch.inference_mode():
+            if self.max_points > 0:
+                # farthest point sampling is deterministic, so a repeated cloud still hits the cache
+                if src.size(2) > self.max_points:
+                    src = gather_points(src, farthest_point_sample(src, self.max_points))
+                if tgt.size(2) > self.max_points:
+                    tgt = gather_points(tgt, farthest_point_sample(tgt, self.max_points))
+            if self.cache is None:
+                rotation_ab, translation_ab, _, _ = self.net(src, tgt)
+            else:
+                rotation_ab, translation_ab, _, _ = self.net.forward_embeddings(
+                    src, tgt, self.net.encode(src, self.cache), self.net.encode(tgt, self.cache))
+        return rotation_ab.cpu().numpy(), translation_ab.cpu().numpy()
+
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect()
+            groups = {}
+            for item in batch:
+                groups.setdefault((item[0].shape[0], item[1].shape[0]), []).append(item)
+            for items in groups.values():
+                try:
+                    rotation, translation = await loop.run_in_executor(self.executor, self.forward, items)
+                except Exception as e:
+                    for item in items:
+                        if not item[2].done():
+                            item[2].set_exception(e)
+                    continue
+                now = time.perf_counter()
+                for i, item in enumerate(items):
+                    if not item[2].done():
+                        item[2].set_result((rotation[i], translation[i]))
+                self.stats.record_batch([now - item[3] for item in items])
+
+
+async def handle_client(batcher, reader, writer):
+    try:
+        while True:
+            try:
+                payload = await read_frame(reader)
+            except asyncio.IncompleteReadError:
+                break
+            try:
+                op, src, tgt = decode_request(payload)
+                if op == OP_STATS:
+                    stats = batcher.stats.summary()
+                    if batcher.cache is not None:
+                        stats['cache'] = batcher.cache.stats()
+                    response = struct.pack('<B', STATUS_OK) + json.dumps(stats).encode('utf-8')
+                elif op == OP_REGISTER:
+                    response = encode_response(*await batcher.submit(src, tgt))
+                else:
+                    response = encode_error('unknown op %d' % op)
+            except Exception as e:
+                response = encode_error('%s: %s' % (type(e).__name__, e))
+            write_frame(writer, response)
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def report(batcher, interval):
+    while True:
+        await asyncio.sleep(interval)
+        stats = batcher.stats.summary()
+        if 'p50_ms' in stats:
+            print('%(requests)d requests, %(throughput).1f req/s, mean batch %(mean_batch).1f, '
+                  'p50 %(p50_ms).1f ms, p99 %(p99_ms).1f ms' % stats, flush=True)
+
+
+def build_model(args, device):
+    net = RegModel(args).to(device)
+    if args.model_path:
+        net.load_state_dict(torch.load(args.model_path, map_location=device), strict=False)
+        print("=> loaded checkpoint '{}'".format(args.model_path))
+    net = fuse_for_inference(net)
+    if args.warmup > 0:
+        points = torch.randn(args.max_batch, 3, args.num_points, device=device)
+        with torch.inference_mode():
+            for _ in range(args.warmup):
+                net(points, points)
+    return net
+
+
+async def serve(args):
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    cache = EmbeddingCache(args.cache_mb * 2 ** 20) if args.cache_mb > 0 else None
+    batcher = MicroBatcher(build_model(args, device), device, args.max_batch, args.max_wait_ms, cache,
+                           args.max_points)
+    server = await asyncio.start_server(lambda r, w: handle_client(batcher, r, w), args.host, args.port)
+    print('Serving on %s:%d (max_batch %d, max_wait %.1f ms, %s)'
+          % (args.host, args.port, args.max_batch, args.max_wait_ms, device), flush=True)
+    tasks = [asyncio.ensure_future(batcher.run())]
+    if args.report_interval > 0:
+        tasks.append(asyncio.ensure_future(report(batcher, args.report_interval)))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+        print(json.dumps(batcher.stats.summary()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Point Cloud Registration server')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--max_batch', type=int, default=16, metavar='N',
+                        help='Most requests run in one forward pass')
+    parser.add_argument('--max_wait_ms', type=float, default=5.0,
+                        help='How long the first request of a batch waits for others')
+    parser.add_argument('--report_interval', type=float, default=10.0,
+                        help='Print latency/throughput every N seconds (0: only on exit)')
+    parser.add_argument('--cache_mb', type=float, default=0, metavar='N',
+                        help='Cache encoder outputs of repeated clouds, up to N MiB (0: off)')
+    parser.add_argument('--threads', type=int, default=0, metavar='N',
+                        help='torch intra-op threads (0: torch default)')
+    parser.add_argument('--warmup', type=int, default=2, metavar='N',
+                        help='Forward passes at --num_points before accepting requests')
+    parser.add_argument('--num_points', type=int, default=1024, metavar='N',
+                        help='Num of points used for the warm-up')
+    parser.add_argument('--max_points', type=int, default=0, metavar='N',
+                        help='Farthest point sample larger clouds down to N points (0: use every point)')
+    parser.add_argument('--no_cuda', action='store_true', default=False,
+                        help='Serve on the CPU even if CUDA is available')
+    parser.add_argument('--emb_dims', type=int, default=1024, metavar='N',
+                        help='Dimension of embeddings')
+    parser.add_argument('--n_blocks', type=int, default=1, metavar='N',
+                        help='Num of blocks of encoder&decoder')
+    parser.add_argument('--n_heads', type=int, default=4, metavar='N',
+                        help='Num of heads in multiheadedattention')
+    parser.add_argument('--ff_dims', type=int, default=1024, metavar='N',
+                        help='Num of dimensions of fc in transformer')
+    parser.add_argument('--dropout', type=float, default=0.0, metavar='N',
+                        help='Dropout ratio in transformer')
+    parser.add_argument('--cycle', type=bool, default=False, metavar='N',
+                        help='Whether to use cycle consistency')
+    parser.add_argument('--k', type=int, default=20, metavar='N',
+                        help='Num of nearest neighbors to use')
+    parser.add_argument('--model_path', type=str, default='', metavar='N',
+                        help='Pretrained model path')
+    args = parser.parse_args()
+    args.cuda = not args.no_cuda and torch.cuda.is_available()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -38,9 +38,122 @@ def transform_point_cloud(point_cloud, rotation, translation):
     return torch.matmul(rot_mat, point_cloud) + translation.unsqueeze(2)
 
 
+def svd_rotation(H):
+    """
+    Batched R = V U^T for H = U S V^T (B, 3, 3), with the sign of the last
+    column of V flipped where det(R) < 0 so that R is a proper rotation.
+    """
+    U, S, V = torch.svd(H)
+    Ut = U.transpose(2, 1)
+    det = torch.det(torch.matmul(V, Ut))
+    ones = torch.ones_like(det)
+    D = torch.diag_embed(torch.stack((ones, ones, torch.where(det < 0, -ones, ones)), dim=1))
+    return torch.matmul(torch.matmul(V, D), Ut)
+
+
+def kabsch(src, tgt, weights=None):
+    """
+    Least-squares rigid transform tgt ~ R src + t between corresponding (B, 3, N)
+    point sets, optionally weighted per point by (B, N) weights. Returns
+    R (B, 3, 3) and t (B, 3).
+    """
+    if weights is None:
+        src_mean = src.mean(dim=2, keepdim=True)
+        tgt_mean = tgt.mean(dim=2, keepdim=True)
+        src_centered = src - src_mean
+    else:
+        w = (weights / weights.sum(dim=1, keepdim=True).clamp(min=1e-8)).unsqueeze(1)
+        src_mean = (src * w).sum(dim=2, keepdim=True)
+        tgt_mean = (tgt * w).sum(dim=2, keepdim=True)
+        src_centered = (src - src_mean) * w
+    H = torch.matmul(src_centered, (tgt - tgt_mean).transpose(2, 1))
+    R = svd_rotation(H)
+    t = tgt_mean - torch.matmul(R, src_mean)
+    return R, t.view(-1, 3)
+
+
+def _as_tensor(x):
+    if isinstance(x, np.ndarray):
+        return torch.from_numpy(x), True
+    return x, False
+
+
+def mat2euler(mats, seq='zyx'):
+    """
+    Closed-form extrinsic Euler angles in degrees for a batch of rotation
+    matrices (N, 3, 3), matching Rotation.from_matrix(...).as_euler(seq).
+    Works on NumPy arrays and on torch tensors on any device.
+    """
+    mats, is_numpy = _as_tensor(mats)
+    eps = 1e-6
+    if seq == 'zyx':
+        # R = Rx(x) Ry(y) Rz(z)
+        s = mats[:, 0, 2].clamp(-1, 1)
+        second = torch.asin(s)
+        locked = s.abs() > 1 - eps
+        first = torch.where(locked, torch.atan2(mats[:, 1, 0], mats[:, 1, 1]),
+                            torch.atan2(-mats[:, 0, 1], mats[:, 0, 0]))
+        third = torch.where(locked, torch.zeros_like(second), torch.atan2(-mats[:, 1, 2], mats[:, 2, 2]))
+    elif seq == 'xyz':
+        # R = Rz(z) Ry(y) Rx(x)
+        s = (-mats[:, 2, 0]).clamp(-1, 1)
+        second = torch.asin(s)
+        locked = s.abs() > 1 - eps
+        first = torch.where(locked, torch.zeros_like(second), torch.atan2(mats[:, 2, 1], mats[:, 2, 2]))
+        third = torch.where(locked, torch.atan2(-mats[:, 0, 1], mats[:, 1, 1]),
+                            torch.atan2(mats[:, 1, 0], mats[:, 0, 0]))
+    else:
+        raise ValueError('Unsupported euler sequence: %s' % seq)
+    eulers = torch.rad2deg(torch.stack([first, second, third], dim=1))
+    if is_numpy:
+        return eulers.numpy()
+    return eulers
+
+
+def rotation_error(rotation_pred, rotation_gt):
+    """Geodesic angle in degrees between two batches of rotation matrices, shape (N,)."""
+    rotation_pred, is_numpy = _as_tensor(rotation_pred)
+    rotation_gt, _ = _as_tensor(rotation_gt)
+    R = torch.matmul(rotation_pred.transpose(2, 1), rotation_gt)
+    cos = (R[:, 0, 0] + R[:, 1, 1] + R[:, 2, 2] - 1) / 2
+    angle = torch.rad2deg(torch.acos(cos.clamp(-1, 1)))
+    if is_numpy:
+        return angle.numpy()
+    return angle
+
+
+def translation_error(translation_pred, translation_gt):
+    """Euclidean distance between two batches of translations, shape (N,)."""
+    translation_pred, is_numpy = _as_tensor(translation_pred)
+    translation_gt, _ = _as_tensor(translation_gt)
+    error = torch.norm(translation_pred - translation_gt, dim=-1)
+    if is_numpy:
+        return error.numpy()
+    return error
+
+
+def compute_loss(args, rotation_ab_pred, translation_ab_pred, rotation_ba_pred, translation_ba_pred,
+                 rotation_ab, translation_ab):
+    """RegModel training loss, plus the cycle-consistency term when args.cycle (registration/main.py)."""
+    batch_size = rotation_ab.size(0)
+    identity = torch.eye(3, device=rotation_ab.device).unsqueeze(0).repeat(batch_size, 1, 1)
+    rotation_loss = F.mse_loss(torch.matmul(rotation_ab_pred.transpose(2, 1), rotation_ab), identity)
+    translation_loss = F.mse_loss(translation_ab_pred, translation_ab)
+    loss = rotation_loss + translation_loss
+    cycle_loss = 0
+    if args.cycle:
+        rotation_loss = F.mse_loss(torch.matmul(rotation_ba_pred, rotation_ab_pred), identity.clone())
+        translation_loss = torch.mean((torch.matmul(rotation_ba_pred.transpose(2, 1),
+                                                    translation_ab_pred.view(batch_size, 3, 1)).view(batch_size, 3)
+                                       + translation_ba_pred) ** 2, dim=[0, 1])
+        cycle_loss = rotation_loss + translation_loss
+
+        loss = loss + cycle_loss * 0.1
+    return loss, cycle_loss, rotation_loss, translation_loss
+
+
 def npmat2euler(mats, seq='zyx'):
-    eulers = []
-    for i in range(mats.shape[0]):
-        r = Rotation.from_matrix(mats[i])
-        eulers.append(r.as_euler(seq, degrees=True))
-    return np.asarray(eulers, dtype='float32')
\ No newline at end of file
+    if seq in ('zyx', 'xyz'):
+        return mat2euler(np.asarray(mats), seq).astype('float32')
+    r = Rotation.from_matrix(mats)
+    return np.asarray(r.as_euler(seq, degrees=True), dtype='float32')
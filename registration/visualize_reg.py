@@ -1,36 +1,23 @@
 import os
+import sys
 import argparse
 from torch.utils.data import DataLoader
 from data import ModelNet40
 import torch
-import open3d as o3d
 from RegModel import RegModel
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fuse import fuse_for_inference
+from correspondence import correspondence_geometry, draw_geometry, export_geometry
 
-def visualize(pc, trans_pc, M):
-    colors = (((pc.T - pc.min())/(pc.max() - pc.min()))*0.5 + 0.5).to(torch.float64)
-    pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(pc.T)
-    pcd.colors = o3d.utility.Vector3dVector(colors)
-    trans_pcd = o3d.geometry.PointCloud()
-    trans_pcd.points = o3d.utility.Vector3dVector(trans_pc.T)
-    trans_pcd.colors = o3d.utility.Vector3dVector(colors)
-    prob, correspoinding = torch.max(M, axis = 1)
-    points = torch.concat((pc.T, trans_pc.T)).tolist()
-    lines = []
-    line_num = 0
-    line_num_max = 100
-    colors_lines = []
-    for index_main, index_trans in enumerate(correspoinding):
-        if prob[index_main] > 0.4 and line_num < line_num_max:
-            line_num += 1
-            lines.append([index_main, index_trans.item() + pc.shape[1]])
-            colors_lines.append(colors[index_trans].tolist())
-    line_set = o3d.geometry.LineSet()
-    line_set.points = o3d.utility.Vector3dVector(points)
-    line_set.lines = o3d.utility.Vector2iVector(lines)
-    line_set.colors = o3d.utility.Vector3dVector(colors_lines)
-    o3d.visualization.draw_geometries([pcd, trans_pcd, line_set])
+
+def visualize(pc, trans_pc, M, threshold=0.4, max_matches=100, export_path=None):
+    # pc, trans_pc: 3*n, M: n*n. Opens an Open3D window, or writes a .ply/.npz when export_path is given
+    geometry = correspondence_geometry(pc.T, trans_pc.T, M, threshold, max_matches)
+    if export_path:
+        export_geometry(export_path, geometry)
+    else:
+        draw_geometry(geometry)
         
 
 if __name__ == "__main__":
@@ -96,34 +83,53 @@ if __name__ == "__main__":
                         help='Num of nearest neighbors to use')
     parser.add_argument('--pre_model_path', type=str, default='', metavar='N',
                         help='Pretrained DGCNN path')
+    parser.add_argument('--threshold', type=float, default=0.4,
+                        help='Minimum match probability drawn')
+    parser.add_argument('--max_matches', type=int, default=100, metavar='N',
+                        help='Most confident matches drawn per pair')
+    parser.add_argument('--export_dir', type=str, default='', metavar='N',
+                        help='Write every pair to this directory instead of opening a window')
+    parser.add_argument('--export_format', type=str, default='ply', choices=['ply', 'npz'],
+                        help='File format for --export_dir')
+    parser.add_argument('--max_samples', type=int, default=0, metavar='N',
+                        help='Stop after N pairs (0: whole dataset)')
     args = parser.parse_args()
 
     train_loader = DataLoader(
             ModelNet40(num_points=args.num_points, partition='train', gaussian_noise=args.gaussian_noise,
                        unseen=args.unseen, factor=args.factor),
             batch_size=args.batch_size, shuffle=True, drop_last=True)
-    device = torch.device("cuda" if args.cuda else "cpu")
-    net = RegModel(args).cuda()
+    device = torch.device("cuda" if args.cuda and torch.cuda.is_available() else "cpu")
+    net = RegModel(args).to(device)
     if args.model_path:
         if os.path.isfile(args.model_path):
             print("=> loading checkpoint '{}'".format(args.model_path))
-            checkpoint = torch.load(args.model_path)
+            checkpoint = torch.load(args.model_path, map_location=device)
             net.load_state_dict(checkpoint)
             # model.load_state_dict(checkpoint['state_dict'])
             print("=> loaded checkpoint '{}'"
                   .format(args.model_path))
         else:
             print("=> no checkpoint found at '{}'".format(args.model_path))
-    with torch.no_grad():
-        for pointcloud, transformed_point_cloud, index in train_loader:
-            pointcloud = pointcloud.to(device)  #b*1024*3
+    net = fuse_for_inference(net)
+    sample = 0
+    with torch.inference_mode():
+        for pointcloud, transformed_point_cloud, *_ in train_loader:
+            pointcloud = pointcloud.to(device)  #b*3*1024
             transformed_point_cloud = transformed_point_cloud.to(device)
-            pointcloud = pointcloud.permute(0, 2, 1) #b*3*1024
-            transformed_point_cloud = transformed_point_cloud.permute(0, 2, 1)
-            batch_size = pointcloud.size()[0]  
-            _, _, _, _, M = model(pointcloud, transformed_point_cloud)
-            M_host = torch.squeeze(M.to("cpu"))
-            pointcloud_host = torch.squeeze(pointcloud.to("cpu"))
-            transformed_point_cloud_host = torch.squeeze(transformed_point_cloud.to("cpu"))
-            visualize(pointcloud_host, transformed_point_cloud_host - 1.1, M_host)
-            pass
\ No newline at end of file
+            M = net.correspondence(pointcloud, transformed_point_cloud).cpu()
+            pointcloud_host = pointcloud.cpu()
+            transformed_point_cloud_host = transformed_point_cloud.cpu()
+            for b in range(M.size(0)):
+                export_path = None
+                if args.export_dir:
+                    export_path = os.path.join(args.export_dir, '%06d.%s' % (sample, args.export_format))
+                visualize(pointcloud_host[b], transformed_point_cloud_host[b] - 1.1, M[b],
+                          args.threshold, args.max_matches, export_path)
+                sample += 1
+                if args.max_samples and sample >= args.max_samples:
+                    break
+            if args.max_samples and sample >= args.max_samples:
+                break
+    if args.export_dir:
+        print("%d pairs written to %s" % (sample, args.export_dir))
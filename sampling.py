@@ -0,0 +1,106 @@
+"""
+Batched point sampling on b*3*n torch tensors: farthest point sampling,
+voxel-grid downsampling and random sampling. Every method returns b*m
+indices, so the same selection can be applied to a second, index-aligned
+cloud (e.g. the transformed copy of an FM3D pair).
+"""
+import numpy as np
+import torch
+
+METHODS = ('fps', 'voxel', 'random', 'first')
+
+
+def gather_points(points, idx):
+    """points b*c*n, idx b*m -> b*c*m"""
+    return torch.gather(points, 2, idx.unsqueeze(1).expand(-1, points.size(1), -1))
+
+
+def farthest_point_sample(points, num_samples, random_start=False):
+    """
+    Indices b*num_samples of a farthest point sampling of points b*3*n, starting
+    from point 0 (or a random point with random_start). Each step is one
+    vectorised distance update over the whole batch, so the cost is
+    O(num_samples * b * n) with no per-cloud Python loop.
+    """
+    batch_size, _, num_points = points.size()
+    if num_samples >= num_points:
+        return torch.arange(num_points, device=points.device).expand(batch_size, -1)
+    idx = torch.zeros(batch_size, num_samples, dtype=torch.long, device=points.device)
+    distances = torch.full((batch_size, num_points), float('inf'), device=points.device, dtype=points.dtype)
+    if random_start:
+        farthest = torch.randint(num_points, (batch_size,), device=points.device)
+    else:
+        farthest = torch.zeros(batch_size, dtype=torch.long, device=points.device)
+    for i in range(num_samples):
+        idx[:, i] = farthest
+        centroid = gather_points(points, farthest.unsqueeze(1))
+        distances = torch.minimum(distances, ((points - centroid) ** 2).sum(dim=1))
+        farthest = distances.argmax(dim=1)
+    return idx
+
+
+def random_sample(points, num_samples, generator=None):
+    """Indices b*num_samples drawn without replacement, independently per cloud."""
+    batch_size, _, num_points = points.size()
+    scores = torch.rand(batch_size, num_points, generator=generator).to(points.device)
+    return scores.argsort(dim=1)[:, :num_samples]
+
+
+def voxel_sample(points, num_samples, voxel_size=0.05, generator=None):
+    """
+    Indices b*num_samples covering the occupied cells of a voxel_size grid: one
+    point per cell first, in random order, then the remaining points when a
+    cloud has fewer cells than num_samples. All clouds are handled in one
+    torch.unique over (cloud, cell) keys.
+    """
+    batch_size, _, num_points = points.size()
+    cells = torch.floor(points / voxel_size).long()
+    cells = cells - cells.min(dim=2, keepdim=True)[0]
+    dims = cells.max(dim=2)[0].max(dim=0)[0] + 1
+    batch = torch.arange(batch_size, device=points.device).unsqueeze(1)
+    keys = ((batch * dims[0] + cells[:, 0]) * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    _, inverse = torch.unique(keys.view(-1), return_inverse=True)
+    flat = torch.arange(batch_size * num_points, device=points.device)
+    first = torch.full((int(inverse.max()) + 1,), batch_size * num_points, device=points.device, dtype=torch.long)
+    first = first.scatter_reduce(0, inverse, flat, reduce='amin')
+    representative = (first[inverse] == flat).view(batch_size, num_points)
+    scores = torch.rand(batch_size, num_points, generator=generator).to(points.device)
+    return (scores + (~representative).float()).argsort(dim=1)[:, :num_samples]
+
+
+def sample_points(points, num_samples, method='fps', voxel_size=0.05, generator=None):
+    """b*num_samples indices of points b*3*n with one of METHODS; 'first' keeps the leading points."""
+    if method == 'fps':
+        return farthest_point_sample(points, num_samples)
+    if method == 'voxel':
+        return voxel_sample(points, num_samples, voxel_size, generator)
+    if method == 'random':
+        return random_sample(points, num_samples, generator)
+    if method == 'first':
+        return torch.arange(min(num_samples, points.size(2)), device=points.device).expand(points.size(0), -1)
+    raise ValueError('unknown sampling method %s, expected one of %s' % (method, ', '.join(METHODS)))
+
+
+def subsample(clouds, num_samples, method='fps', voxel_size=0.05, chunk_size=256, device='cpu'):
+    """
+    Numpy front end for the datasets: indices (B, num_samples) into clouds
+    (B, N, 3), computed chunk_size clouds at a time. Clouds with at most
+    num_samples points keep all of them.
+    """
+    if clouds.shape[1] <= num_samples:
+        return np.broadcast_to(np.arange(clouds.shape[1]), clouds.shape[:2])
+    indices = []
+    for start in range(0, clouds.shape[0], chunk_size):
+        points = torch.from_numpy(np.ascontiguousarray(clouds[start:start + chunk_size], dtype='float32'))
+        points = points.to(device).transpose(2, 1)
+        indices.append(sample_points(points, num_samples, method, voxel_size).cpu().numpy())
+    return np.concatenate(indices)
+
+
+def add_sampling_args(parser, default='first'):
+    parser.add_argument('--sampling', type=str, default=default, choices=METHODS,
+                        help='How clouds larger than --num_points are reduced: farthest point sampling, '
+                             'voxel grid, random, or the first points')
+    parser.add_argument('--voxel_size', type=float, default=0.05,
+                        help='Grid cell size of --sampling voxel')
+    return parser
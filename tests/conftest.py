@@ -0,0 +1,12 @@
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REG_DIR = os.path.join(ROOT_DIR, 'registration')
+
+# the registration helpers are imported as top-level modules (util, RegModel), like registration/main.py does;
+# the root goes first so that data.py / main.py of the root package win, as in benchmarks/common.py
+for path in (REG_DIR, ROOT_DIR):
+    if path in sys.path:
+        sys.path.remove(path)
+    sys.path.insert(0, path)
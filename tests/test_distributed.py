@@ -0,0 +1,103 @@
+"""One DDP training step of FM3D on CPU with the gloo backend and two processes."""
+import os
+import socket
+import argparse
+import importlib.util
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.utils.data.distributed import DistributedSampler
+
+WORLD_SIZE = 2
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _model_args():
+    return argparse.Namespace(k=4, emb_dims=32, dropout=0.0, similarity_metric='exponential', alpha1=0.1,
+                              alpha2=0.1, distributed=True, cuda=False, local_rank=0)
+
+
+def _root_data():
+    # by path: with registration/ on sys.path a plain 'import data' can pick registration/data.py
+    spec = importlib.util.spec_from_file_location('fm3d_data', os.path.join(ROOT_DIR, 'data.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _worker(rank, port):
+    SyntheticModelNet40 = _root_data().SyntheticModelNet40
+    from model import FM3D, contrastive_loss
+    from metric_logger import MetricAccumulator
+    from distributed import wrap_model, unwrap_model, convert_sync_batchnorm, all_reduce_max, cleanup
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=WORLD_SIZE)
+    try:
+        torch.manual_seed(0)
+        args = _model_args()
+
+        # shared BatchNorm modules stay shared after conversion
+        converted = convert_sync_batchnorm(FM3D(args))
+        assert isinstance(converted.DGCNN.bn1, nn.SyncBatchNorm)
+        assert converted.DGCNN.conv1[1] is converted.DGCNN.bn1
+        assert converted.predictor[1] is converted.bn1
+
+        # every rank reads a disjoint shard and together they cover the dataset
+        dataset = SyntheticModelNet40(64, 'train', num_pairs=8, seed=0)
+        sampler = DistributedSampler(dataset, shuffle=True, seed=0)
+        sampler.set_epoch(0)
+        shard = list(sampler)
+        shards = [None] * WORLD_SIZE
+        dist.all_gather_object(shards, shard)
+        assert not set(shards[0]) & set(shards[1])
+        assert sorted(shards[0] + shards[1]) == list(range(len(dataset)))
+
+        # one optimizer step on this rank's shard
+        model = wrap_model(FM3D(args), args)
+        loss_function = contrastive_loss(args)
+        opt = torch.optim.Adam(model.parameters(), lr=1e-3)
+        src, tgt = dataset.get_batch(shard)
+        src, tgt = src.permute(0, 2, 1), tgt.permute(0, 2, 1)
+        model.train()
+        opt.zero_grad()
+        final_loss, FB_loss, M_loss1, M_loss2 = loss_function(*model(src, tgt))
+        final_loss.backward()
+        opt.step()
+
+        acc = MetricAccumulator(distributed=True)
+        acc.update(src.size(0), final_loss=final_loss, FB_loss=FB_loss)
+        metrics = acc.sync()
+        local = MetricAccumulator()
+        local.update(src.size(0), final_loss=final_loss, FB_loss=FB_loss)
+        local_metrics = local.sync()
+        rank_max = all_reduce_max(torch.tensor(float(rank)))
+        weights = torch.cat([p.detach().reshape(-1) for p in unwrap_model(model).parameters()])
+
+        gathered = [None] * WORLD_SIZE
+        dist.all_gather_object(gathered, (metrics, local_metrics, rank_max.item(), weights))
+        if rank == 0:
+            expected = {key: sum(g[1][key] for g in gathered) / WORLD_SIZE for key in metrics}
+            for other in gathered[1:]:
+                assert other[0] == gathered[0][0]
+                # DDP averages the gradients, so the replicas stay identical
+                assert torch.allclose(other[3], gathered[0][3])
+            for key, value in expected.items():
+                assert abs(gathered[0][0][key] - value) < 1e-5
+            assert all(g[2] == WORLD_SIZE - 1 for g in gathered)
+    finally:
+        cleanup()
+
+
+def test_ddp_step_on_gloo():
+    if not dist.is_available() or not dist.is_gloo_available():
+        pytest.skip('torch.distributed with gloo is not available')
+    mp.spawn(_worker, args=(_free_port(),), nprocs=WORLD_SIZE, join=True)
@@ -0,0 +1,43 @@
+"""embedding_cache.EmbeddingCache: the byte bound counts the storage the entries really hold."""
+import torch
+from embedding_cache import EmbeddingCache
+
+
+def _storage_bytes(tensors):
+    storages = {}
+    for tensor in tensors:
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+def _encoder(points):
+    return points.repeat(1, 4, 1) * 2
+
+
+def test_entries_do_not_share_the_batch_storage():
+    cache = EmbeddingCache(max_bytes=2 ** 20)
+    points = torch.randn(8, 3, 64)
+    embeddings = cache.embed(points, _encoder)
+    torch.testing.assert_close(embeddings, _encoder(points))
+    assert cache.stats()['misses'] == 8
+    assert _storage_bytes(cache.entries.values()) == cache.bytes == 8 * 12 * 64 * 4
+
+
+def test_eviction_frees_storage():
+    entry_bytes = 12 * 64 * 4
+    cache = EmbeddingCache(max_bytes=3 * entry_bytes)
+    cache.embed(torch.randn(8, 3, 64), _encoder)
+    assert len(cache.entries) == 3
+    assert _storage_bytes(cache.entries.values()) == cache.bytes <= cache.max_bytes
+
+
+def test_hits_reuse_entries():
+    cache = EmbeddingCache()
+    points = torch.randn(4, 3, 32)
+    first = cache.embed(points, _encoder)
+    calls = []
+    second = cache.embed(points, lambda x: calls.append(x) or _encoder(x))
+    assert not calls
+    torch.testing.assert_close(first, second)
+    assert cache.stats()['hits'] == 4
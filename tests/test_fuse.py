@@ -0,0 +1,26 @@
+"""fuse.fuse_for_inference folds every BatchNorm without changing the outputs (checked in float64)."""
+import argparse
+import pytest
+import torch
+from fuse import check_cases, check_fusion
+
+pytest.importorskip('h5py')  # registration/_model.py (PointNet) imports it
+
+
+def _args():
+    return argparse.Namespace(batch_size=2, num_points=128, emb_dims=64, k=8, dropout=0.5,
+                              similarity_metric='exponential')
+
+
+def _cases():
+    torch.manual_seed(0)
+    return check_cases(_args())
+
+
+@pytest.mark.parametrize('index', range(4))
+def test_fusion_is_exact_in_float64(index):
+    name, module, inputs = _cases()[index]
+    error, remaining = check_fusion(module, inputs)
+    assert remaining == 0, name
+    assert error < 1e-9, name
+
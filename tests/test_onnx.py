@@ -0,0 +1,33 @@
+"""onnx_backend: a DGCNN exported with dynamic axes matches torch under onnxruntime."""
+import argparse
+import pytest
+import torch
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from model import DGCNN
+from fuse import fuse_for_inference
+from onnx_backend import export_dgcnn, ORTEncoder, check_parity
+
+
+@pytest.fixture(scope='module')
+def exported(tmp_path_factory):
+    torch.manual_seed(0)
+    args = argparse.Namespace(k=8, emb_dims=64, dropout=0.5)
+    dgcnn = fuse_for_inference(DGCNN(args))
+    path = export_dgcnn(dgcnn, str(tmp_path_factory.mktemp('onnx') / 'dgcnn.onnx'), num_points=128)
+    return dgcnn, ORTEncoder(path, intra_op_threads=1)
+
+
+def test_parity_over_batch_sizes_and_point_counts(exported):
+    dgcnn, encoder = exported
+    results, ok = check_parity(dgcnn, encoder, batch_sizes=(1, 2, 5), point_counts=(64, 128, 300), atol=1e-4)
+    assert len(results) == 9
+    assert ok, results
+
+
+def test_output_shape(exported):
+    dgcnn, encoder = exported
+    features = encoder(torch.randn(3, 3, 96))
+    assert features.shape == (3, 64, 96)
@@ -0,0 +1,97 @@
+"""registration/util.py against the per-sample scipy and SVDHead code it replaced."""
+import numpy as np
+import pytest
+import torch
+from scipy.spatial.transform import Rotation
+from util import mat2euler, npmat2euler, kabsch, rotation_error
+
+
+def _random_rotations(n, seed=0):
+    return Rotation.random(n, random_state=seed).as_matrix()
+
+
+def _gimbal_locked(seq, n=8, seed=0):
+    # middle angle at +-90 degrees, the branch where the first and third angles are coupled
+    rng = np.random.RandomState(seed)
+    angles = rng.uniform(-180, 180, size=(n, 3))
+    angles[:, 1] = np.where(np.arange(n) % 2 == 0, 90.0, -90.0)
+    return Rotation.from_euler(seq, angles, degrees=True).as_matrix()
+
+
+@pytest.mark.parametrize('seq', ['zyx', 'xyz'])
+def test_mat2euler_matches_scipy(seq):
+    mats = _random_rotations(256)
+    expected = Rotation.from_matrix(mats).as_euler(seq, degrees=True)
+    np.testing.assert_allclose(mat2euler(mats, seq), expected, atol=1e-6)
+    np.testing.assert_allclose(npmat2euler(mats, seq), expected, atol=1e-3)
+    eulers = mat2euler(torch.from_numpy(mats), seq)
+    assert isinstance(eulers, torch.Tensor)
+    np.testing.assert_allclose(eulers.numpy(), expected, atol=1e-6)
+
+
+@pytest.mark.parametrize('seq', ['zyx', 'xyz'])
+def test_mat2euler_gimbal_lock(seq):
+    mats = _gimbal_locked(seq)
+    eulers = mat2euler(mats, seq)
+    # only the sum/difference of the outer angles is defined, so compare the rotations they describe
+    np.testing.assert_allclose(np.abs(eulers[:, 1]), 90.0, atol=1e-4)
+    np.testing.assert_allclose(Rotation.from_euler(seq, eulers, degrees=True).as_matrix(), mats, atol=1e-6)
+
+
+def test_rotation_error():
+    mats = _random_rotations(64)
+    angles = np.random.RandomState(1).uniform(0, 170, size=64)
+    axes = Rotation.random(64, random_state=2).as_rotvec()
+    axes /= np.linalg.norm(axes, axis=1, keepdims=True)
+    perturbed = Rotation.from_rotvec(axes * np.deg2rad(angles)[:, None]).as_matrix() @ mats
+    np.testing.assert_allclose(rotation_error(perturbed, mats), angles, atol=1e-4)
+    np.testing.assert_allclose(rotation_error(mats, mats), 0.0, atol=1e-3)
+
+
+def _svdhead_solve(src, tgt):
+    """The per-sample loop of the original SVDHead.forward."""
+    reflect = torch.eye(3, dtype=src.dtype)
+    reflect[2, 2] = -1
+    src_centered = src - src.mean(dim=2, keepdim=True)
+    tgt_centered = tgt - tgt.mean(dim=2, keepdim=True)
+    H = torch.matmul(src_centered, tgt_centered.transpose(2, 1))
+    R = []
+    for i in range(src.size(0)):
+        u, s, v = torch.svd(H[i])
+        r = torch.matmul(v, u.transpose(1, 0))
+        if torch.det(r) < 0:
+            r = torch.matmul(torch.matmul(v, reflect), u.transpose(1, 0))
+        R.append(r)
+    R = torch.stack(R, dim=0)
+    t = torch.matmul(-R, src.mean(dim=2, keepdim=True)) + tgt.mean(dim=2, keepdim=True)
+    return R, t.view(-1, 3)
+
+
+def test_kabsch_round_trip():
+    generator = torch.Generator().manual_seed(0)
+    src = torch.randn(16, 3, 64, generator=generator, dtype=torch.float64)
+    R = torch.from_numpy(_random_rotations(16, seed=3))
+    t = torch.randn(16, 3, generator=generator, dtype=torch.float64)
+    tgt = torch.matmul(R, src) + t.unsqueeze(2)
+    R_pred, t_pred = kabsch(src, tgt)
+    torch.testing.assert_close(R_pred, R)
+    torch.testing.assert_close(t_pred, t)
+    weights = torch.rand(16, 64, generator=generator, dtype=torch.float64)
+    R_weighted, t_weighted = kabsch(src, tgt, weights)
+    torch.testing.assert_close(R_weighted, R)
+    torch.testing.assert_close(t_weighted, t)
+
+
+def test_kabsch_reflection():
+    # a mirrored target: the unconstrained least-squares solution has det -1
+    generator = torch.Generator().manual_seed(1)
+    src = torch.randn(8, 3, 64, generator=generator, dtype=torch.float64)
+    mirror = torch.diag(torch.tensor([1.0, 1.0, -1.0], dtype=torch.float64))
+    R = torch.from_numpy(_random_rotations(8, seed=4))
+    tgt = torch.matmul(torch.matmul(R, mirror), src) + 0.01 * torch.randn(8, 3, 64, generator=generator,
+                                                                          dtype=torch.float64)
+    R_pred, t_pred = kabsch(src, tgt)
+    torch.testing.assert_close(torch.det(R_pred), torch.ones(8, dtype=torch.float64))
+    R_ref, t_ref = _svdhead_solve(src, tgt)
+    torch.testing.assert_close(R_pred, R_ref)
+    torch.testing.assert_close(t_pred, t_ref)